@@ -0,0 +1,386 @@
+"""
+Offline end-to-end latency benchmark of the Lambda request pipeline.
+
+Replays a versioned query corpus through index.get_response with local stand-ins
+for Bedrock, Kendra, S3 and Athena (see stubs.py; pricing SQL runs on the
+SQLite backend over assets/sagemaker_source). Reports p50/p95/p99 latency per
+request, per intent and per stage, with the LLM calls and tokens, and writes
+everything as JSON so that two runs can be compared:
+
+    python -m benchmarks.run_benchmark --output results.json
+    python -m benchmarks.run_benchmark --baseline results.json
+
+Stage latencies are scaled by --latency-scale (1.0 approximates the deployed
+services; the default keeps a run under a minute). The pricing query engine is
+built before the first request, as in a warm container, unless --cold-start is
+given. Environment variables of the Lambda function, e.g. ANSWER_CACHE_ENABLED
+or AGENT_TOOL_MODE, apply as usual.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT_DIR, "code", "lambda-container")
+PRICING_DATA_DIR = os.path.join(ROOT_DIR, "assets", "sagemaker_source")
+KENDRA_DOCUMENTS_ZIP = os.path.join(ROOT_DIR, "assets", "kendra_documents", "sm_dg.zip")
+DEFAULT_CORPUS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "corpus", "queries_v1.jsonl"
+)
+PERCENTILES = (50, 95, 99)
+
+# The Lambda modules read their configuration at import time
+BENCHMARK_ENVIRONMENT = {
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "DATA_SOURCE_BUCKET_NAME": "benchmark-kendra-data-source",
+    "PRICING_DATA_SOURCE_BUCKET_NAME": "benchmark-sagemaker-pricing",
+    "KENDRA_INDEX_ID": "benchmark-index",
+    "SAGEMAKER_PRICING_DATABASE": "benchmark-pricing-db",
+    "LOG_LEVEL": "WARNING",
+    "PRICING_SQL_BACKEND": "sqlite",
+    "PRICING_DATA_DIR": PRICING_DATA_DIR,
+    "SESSION_BACKEND": "memory",
+}
+
+
+def load_corpus(path):
+    """
+    Load the query corpus and its version.
+
+    Output:
+        (entries, version): list of dicts, and the file name with the sha256 of
+        its content
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    entries = [json.loads(line) for line in content.decode().splitlines() if line]
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return entries, f"{os.path.basename(path)}@{digest}"
+
+
+def percentiles(values):
+    """
+    p50/p95/p99, mean and count of a list of seconds, in milliseconds.
+    """
+    if not values:
+        return {"count": 0}
+    millis = np.asarray(values) * 1000
+    summary = {f"p{p}": round(float(np.percentile(millis, p)), 2) for p in PERCENTILES}
+    summary["mean"] = round(float(millis.mean()), 2)
+    summary["count"] = len(values)
+    return summary
+
+
+class Patcher:
+    """
+    Set attributes for the duration of a run and restore them afterwards.
+    """
+
+    def __init__(self):
+        self._saved = []
+
+    def set(self, obj, name, value):
+        self._saved.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def restore(self):
+        while self._saved:
+            obj, name, value = self._saved.pop()
+            setattr(obj, name, value)
+
+
+class BenchmarkHarness:
+    """
+    Install the stubs into the Lambda modules and replay a corpus.
+    """
+
+    def __init__(
+        self, corpus, latency, documents_zip=KENDRA_DOCUMENTS_ZIP, cold_start=False
+    ):
+        from benchmarks import stubs
+
+        self.corpus = corpus
+        self.latency = latency
+        self.cold_start = cold_start
+        self.query_engine_build_s = {}
+        self.recorder = stubs.StageRecorder()
+        self.documents = stubs.load_documents(documents_zip)
+        self._patcher = Patcher()
+        self._remove_sql_latency = None
+
+    def install(self):
+        from benchmarks import stubs
+
+        if LAMBDA_DIR not in sys.path:
+            sys.path.insert(0, LAMBDA_DIR)
+        for key, value in BENCHMARK_ENVIRONMENT.items():
+            os.environ.setdefault(key, value)
+
+        import answer_cache
+        import data_version
+        import intent_classifier
+        import output_budget
+        import pricing_cache
+        import sagemaker_agent
+        import sagemaker_dg_rag
+        import sagemaker_pricing
+        import session_memory
+        from connections import Connections
+
+        patch = self._patcher.set
+        bedrock = stubs.StubBedrockRuntime(self.corpus, self.latency, self.recorder)
+        s3 = stubs.StubS3Resource(self.documents, self.latency, self.recorder)
+        kendra = stubs.StubKendra(
+            self.documents,
+            Connections.s3_rawdata_bucket_name,
+            Connections.region_name,
+            self.latency,
+            self.recorder,
+        )
+        # the stub answers behind the same gateway as the Bedrock client
+        patch(
+            Connections,
+            "bedrock_client",
+            Connections.bedrock_client.with_client(bedrock),
+        )
+        patch(Connections, "kendra_client", kendra)
+        patch(Connections, "s3_resource", s3)
+        patch(Connections, "pricing_sql_backend", "sqlite")
+        patch(Connections, "pricing_data_dir", PRICING_DATA_DIR)
+        patch(sagemaker_dg_rag, "s3_resource", s3)
+        patch(sagemaker_dg_rag, "_retrievers", {})
+        provider = sagemaker_pricing.QueryEngineProvider()
+        patch(sagemaker_pricing, "query_engine_provider", provider)
+        patch(answer_cache, "_answer_cache", None)
+        patch(sagemaker_agent, "_agents", {})
+        patch(session_memory, "_store", session_memory.InMemorySessionStore())
+        patch(output_budget, "output_budget", output_budget.OutputBudget())
+
+        # Every run starts cold
+        for cache in (
+            sagemaker_dg_rag.retrieval_cache,
+            sagemaker_dg_rag.source_link_cache,
+            intent_classifier.intent_cache,
+        ):
+            cache.invalidate()
+        pricing_cache.pricing_query_cache.refresh()
+        data_version.kendra_data_version.refresh()
+        if not self.cold_start:
+            # Schema reflection and sample rows are not part of any request
+            provider.get()
+            self.query_engine_build_s = {
+                step: round(seconds, 3)
+                for step, seconds in provider.build_timings.items()
+            }
+        self._remove_sql_latency = stubs.install_sql_latency(
+            self.latency, self.recorder
+        )
+
+    def uninstall(self):
+        if self._remove_sql_latency:
+            self._remove_sql_latency()
+            self._remove_sql_latency = None
+        self._patcher.restore()
+
+    def run_query(self, entry):
+        """
+        Answer one corpus entry and measure it.
+
+        Output:
+            dict with the latency, stages, LLM usage and answer of the request
+        """
+        import index
+        from intent_classifier import get_cached_or_local_intent
+        from llm_usage import track_usage
+
+        self.recorder.start_request()
+        start = time.perf_counter()
+        error = None
+        with track_usage() as usage:
+            try:
+                output = index.get_response(entry["query"], entry.get("session"))
+            except Exception as e:
+                logging.exception("Benchmark query %s failed", entry.get("id"))
+                output, error = {}, repr(e)
+        latency = time.perf_counter() - start
+        stages = self.recorder.end_request()
+        return {
+            "id": entry.get("id"),
+            "intent": entry.get("intent"),
+            "predicted_intent": get_cached_or_local_intent(entry["query"]),
+            "latency_ms": round(latency * 1000, 2),
+            "stages": {
+                stage: {
+                    "calls": value["calls"],
+                    "ms": round(value["seconds"] * 1000, 2),
+                }
+                for stage, value in sorted(stages.items())
+            },
+            "llm": usage.summary()["total"],
+            "answer_chars": len(output.get("answer") or ""),
+            "error": error,
+        }
+
+    def run(self, repeat=1):
+        self.install()
+        try:
+            return [
+                self.run_query(entry) for _ in range(repeat) for entry in self.corpus
+            ]
+        finally:
+            self.uninstall()
+
+
+def summarize(requests):
+    """
+    Aggregate the per-request measurements.
+    """
+    by_intent = {}
+    for request in requests:
+        by_intent.setdefault(request["intent"], []).append(request["latency_ms"] / 1000)
+
+    stage_names = sorted({stage for r in requests for stage in r["stages"]})
+    stages = {}
+    for stage in stage_names:
+        timings = [
+            r["stages"][stage]["ms"] / 1000 for r in requests if stage in r["stages"]
+        ]
+        stages[stage] = percentiles(timings)
+        stages[stage]["calls"] = sum(
+            r["stages"][stage]["calls"] for r in requests if stage in r["stages"]
+        )
+
+    llm = {}
+    for request in requests:
+        for key, value in request["llm"].items():
+            llm[key] = llm.get(key, 0) + value
+    if "cost_usd" in llm:
+        llm["cost_usd"] = round(llm["cost_usd"], 6)
+
+    return {
+        "requests": len(requests),
+        "errors": sum(1 for r in requests if r["error"]),
+        "latency_ms": percentiles([r["latency_ms"] / 1000 for r in requests]),
+        "latency_ms_by_intent": {
+            intent: percentiles(values) for intent, values in sorted(by_intent.items())
+        },
+        "stages_ms": stages,
+        "llm": llm,
+    }
+
+
+def compare(summary, baseline):
+    """
+    Relative change of the latency percentiles and LLM usage against a baseline.
+    """
+
+    def change(new, old):
+        if not old:
+            return None
+        return round((new - old) / old * 100, 1)
+
+    report = {"latency_ms": {}, "stages_ms": {}, "llm": {}}
+    for p in PERCENTILES:
+        key = f"p{p}"
+        report["latency_ms"][key] = change(
+            summary["latency_ms"].get(key, 0), baseline["latency_ms"].get(key, 0)
+        )
+    for stage, values in summary["stages_ms"].items():
+        old = baseline.get("stages_ms", {}).get(stage, {})
+        report["stages_ms"][stage] = {
+            f"p{p}": change(values.get(f"p{p}", 0), old.get(f"p{p}", 0))
+            for p in PERCENTILES
+        }
+    for key, value in summary["llm"].items():
+        report["llm"][key] = change(value, baseline.get("llm", {}).get(key, 0))
+    return report
+
+
+def run_benchmark(
+    corpus_path=DEFAULT_CORPUS,
+    latency_scale=0.1,
+    seed=0,
+    repeat=1,
+    latencies=None,
+    cold_start=False,
+):
+    """
+    Replay the corpus and return the JSON-serializable results.
+    """
+    from benchmarks.stubs import LatencyModel
+
+    corpus, version = load_corpus(corpus_path)
+    latency = LatencyModel(latencies, scale=latency_scale, seed=seed)
+    harness = BenchmarkHarness(corpus, latency, cold_start=cold_start)
+    started = time.time()
+    requests = harness.run(repeat=repeat)
+    return {
+        "corpus": {"path": os.path.relpath(corpus_path, ROOT_DIR), "version": version},
+        "config": {
+            "latency_scale": latency_scale,
+            "latencies_s": latency.latencies,
+            "seed": seed,
+            "repeat": repeat,
+            "cold_start": cold_start,
+            "query_engine_build_s": harness.query_engine_build_s,
+            "python": platform.python_version(),
+            "started_at": started,
+        },
+        "summary": summarize(requests),
+        "requests": requests,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--latency-scale", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--cold-start",
+        action="store_true",
+        help="build the pricing query engine during the first pricing request",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    results = run_benchmark(
+        args.corpus,
+        latency_scale=args.latency_scale,
+        seed=args.seed,
+        repeat=args.repeat,
+        cold_start=args.cold_start,
+    )
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["comparison"] = compare(results["summary"], json.load(f)["summary"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    report = {
+        key: results[key]
+        for key in ("corpus", "summary", "comparison")
+        if key in results
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
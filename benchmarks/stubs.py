@@ -0,0 +1,453 @@
+"""
+Deterministic local stand-ins for the AWS services used by the Lambda function.
+
+Every stub sleeps for a configurable, seeded latency and records the time spent
+per pipeline stage, so the request pipeline can be replayed offline. Claude calls
+also sleep in proportion to their input tokens, as prompt processing does:
+
+- StubBedrockRuntime: Claude through InvokeModel (intent, RAG synthesis, agent
+  steps) and Converse (text-to-SQL and SQL synthesis), Cohere embeddings
+- StubKendra: Retrieve over the SageMaker Developer Guide documents
+- StubS3Resource: the Kendra source documents and their listing
+- install_sql_latency: latency added to every SQL statement, as Athena would
+"""
+
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from urllib.parse import quote, unquote
+
+from botocore.exceptions import ClientError
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Median latency in seconds of each stage, before scaling
+DEFAULT_LATENCIES = {
+    "intent": 0.4,
+    "embedding": 0.08,
+    "retrieval": 0.3,
+    "s3": 0.03,
+    "sql_generation": 1.5,
+    "sql_execution": 1.2,
+    "synthesis": 2.0,
+    "agent_step": 2.5,
+    # prompt processing time of the Claude stages, per input token
+    "input_token": 0.0002,
+}
+
+EMBEDDING_DIMENSIONS = 64
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:\.[a-z0-9]+)*")
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class LatencyModel:
+    """
+    Seeded log-normal latency per stage.
+
+    The jitter of a call only depends on the seed, the stage and the call's
+    key, so runs are reproducible whatever order concurrent calls run in.
+    """
+
+    def __init__(self, latencies=None, scale=1.0, seed=0, sigma=0.3):
+        self.latencies = {**DEFAULT_LATENCIES, **(latencies or {})}
+        self.scale = scale
+        self.seed = seed
+        self.sigma = sigma
+
+    def delay(self, stage, key="", input_tokens=0):
+        digest = hashlib.sha256(f"{self.seed}:{stage}:{key}".encode()).digest()
+        rng = random.Random(int.from_bytes(digest[:8], "big"))
+        return (
+            (
+                self.latencies.get(stage, 0.0)
+                + input_tokens * self.latencies.get("input_token", 0.0)
+            )
+            * self.scale
+            * rng.lognormvariate(0, self.sigma)
+        )
+
+    def sleep(self, stage, key="", input_tokens=0):
+        seconds = self.delay(stage, key, input_tokens)
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class StageRecorder:
+    """
+    Time spent and calls made per stage by the request being replayed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = None
+
+    def start_request(self):
+        with self._lock:
+            self._current = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+
+    def end_request(self):
+        with self._lock:
+            stages, self._current = self._current, None
+        return {stage: dict(value) for stage, value in (stages or {}).items()}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            if self._current is None:
+                return
+            self._current[stage]["calls"] += 1
+            self._current[stage]["seconds"] += seconds
+
+
+class _Body(io.BytesIO):
+    pass
+
+
+def _text_of(content):
+    if isinstance(content, str):
+        return content
+    return "\n".join(
+        block.get("text", "") if isinstance(block, dict) else str(block)
+        for block in content or []
+    )
+
+
+def hashed_embedding(text):
+    """
+    Bag-of-words embedding, so that paraphrases are close to each other.
+    """
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    for word in WORD_PATTERN.findall(text.lower()):
+        digest = hashlib.sha256(word.encode()).digest()
+        vector[digest[0] % EMBEDDING_DIMENSIONS] += 1.0 if digest[1] % 2 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+class _BedrockExceptions:
+    """
+    The modeled errors of bedrock-runtime, which the llama-index retries catch.
+    """
+
+    ThrottlingException = type("ThrottlingException", (ClientError,), {})
+    InternalServerException = type("InternalServerException", (ClientError,), {})
+    ServiceUnavailableException = type(
+        "ServiceUnavailableException", (ClientError,), {}
+    )
+    ModelTimeoutException = type("ModelTimeoutException", (ClientError,), {})
+
+
+class StubBedrockRuntime:
+    """
+    bedrock-runtime client answering from the benchmark corpus.
+
+    Inputs:
+        corpus (list): corpus entries; "intent" answers the classifier, "sql"
+            the text-to-SQL prompt and "tools" the agent's first step
+
+    inject_throttles(count) makes the next count calls fail with a
+    ThrottlingException, as Bedrock does above the account quotas.
+    """
+
+    DEFAULT_SQL = (
+        "SELECT instance_type, price_per_hour FROM training_price "
+        "ORDER BY price_per_hour ASC LIMIT 5"
+    )
+
+    exceptions = _BedrockExceptions
+
+    def __init__(self, corpus, latency, recorder):
+        self.entries = {entry["query"]: entry for entry in corpus}
+        self.latency = latency
+        self.recorder = recorder
+        self.throttles = 0
+        self.throttled_calls = 0
+        self._throttle_lock = threading.Lock()
+
+    def inject_throttles(self, count, operations=("InvokeModel", "Converse")):
+        """
+        Fail the next count calls of the given operations with a throttle.
+        """
+        with self._throttle_lock:
+            self.throttles = count
+            self._throttled_operations = frozenset(operations)
+
+    def _throttle(self, operation):
+        with self._throttle_lock:
+            if not self.throttles or operation not in self._throttled_operations:
+                return
+            self.throttles -= 1
+            self.throttled_calls += 1
+        raise self.exceptions.ThrottlingException(
+            {"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}},
+            operation,
+        )
+
+    def _timed(self, stage, key, func, input_tokens=0):
+        start = time.perf_counter()
+        self.latency.sleep(stage, key, input_tokens)
+        result = func()
+        self.recorder.record(stage, time.perf_counter() - start)
+        return result
+
+    # InvokeModel: Claude through ChatBedrock and Cohere embeddings
+    def invoke_model(self, **kwargs):
+        self._throttle("InvokeModel")
+        body = json.loads(kwargs["body"])
+        if "texts" in body:
+            texts = body["texts"]
+            payload = {"embeddings": {"float": [hashed_embedding(t) for t in texts]}}
+            return self._timed(
+                "embedding", texts[0], lambda: self._response(payload, 0, 0)
+            )
+
+        stage, text, tool_calls = self._claude_reply(body)
+        content = [{"type": "text", "text": text}] if text else []
+        for index, (name, tool_query) in enumerate(tool_calls):
+            content.append(
+                {
+                    "type": "tool_use",
+                    "id": f"toolu_{index}",
+                    "name": name,
+                    "input": {"query": tool_query},
+                }
+            )
+        payload = {
+            "content": content,
+            "stop_reason": "tool_use" if tool_calls else "end_turn",
+        }
+        input_tokens = estimate_tokens(kwargs["body"])
+        output_tokens = estimate_tokens(json.dumps(content))
+        return self._timed(
+            stage,
+            kwargs["body"][-512:],
+            lambda: self._response(payload, input_tokens, output_tokens),
+            input_tokens,
+        )
+
+    @staticmethod
+    def _response(payload, input_tokens, output_tokens):
+        return {
+            "body": _Body(json.dumps(payload).encode("utf-8")),
+            "ResponseMetadata": {
+                "HTTPHeaders": {
+                    "x-amzn-bedrock-input-token-count": str(input_tokens),
+                    "x-amzn-bedrock-output-token-count": str(output_tokens),
+                }
+            },
+        }
+
+    def _claude_reply(self, body):
+        system = _text_of(body.get("system"))
+        messages = body.get("messages", [])
+        first = _text_of(messages[0]["content"]) if messages else ""
+        last = _text_of(messages[-1]["content"]) if messages else ""
+
+        if "classifying intents" in system:
+            entry = self.entries.get(last.strip(), {})
+            return "intent", entry.get("intent", "UseCase1"), []
+
+        if body.get("tools") or "run out of time" in last:
+            entry = self.entries.get(first.strip(), {})
+            has_results = any(
+                isinstance(block, dict) and block.get("type") == "tool_result"
+                for message in messages
+                for block in (
+                    message["content"] if isinstance(message["content"], list) else []
+                )
+            )
+            if entry.get("tools") and not has_results and "run out of time" not in last:
+                return "agent_step", "", [tuple(call) for call in entry["tools"]]
+            answer = {
+                "text": f"Benchmark answer to: {first.strip()}",
+                "source": "[Amazon SageMaker Pricing](https://aws.amazon.com/sagemaker/pricing/)",
+            }
+            return "agent_step", json.dumps(answer), []
+
+        return "synthesis", "Benchmark documentation answer. " * 20, []
+
+    # Converse: text-to-SQL and SQL synthesis through llama-index
+    def converse(self, **kwargs):
+        self._throttle("Converse")
+        text = "\n".join(
+            _text_of(
+                [
+                    {"text": block.get("text", "")}
+                    for block in message.get("content", [])
+                ]
+            )
+            for message in kwargs.get("messages", [])
+        )
+        if "<SQL Response>" in text:
+            stage, reply = "synthesis", "According to the latest information, \\$1."
+        else:
+            question = text.rpartition("Question:")[2].partition("SQLQuery:")[0]
+            entry = self.entries.get(question.strip(), {})
+            stage, reply = "sql_generation", entry.get("sql", self.DEFAULT_SQL)
+        system = " ".join(block.get("text", "") for block in kwargs.get("system", []))
+        input_tokens = estimate_tokens(system + text)
+        output_tokens = estimate_tokens(reply)
+        response = {
+            "output": {"message": {"role": "assistant", "content": [{"text": reply}]}},
+            "stopReason": "end_turn",
+            "usage": {
+                "inputTokens": input_tokens,
+                "outputTokens": output_tokens,
+                "totalTokens": input_tokens + output_tokens,
+            },
+        }
+        return self._timed(stage, text[-512:], lambda: response, input_tokens)
+
+
+def load_documents(zip_path):
+    """
+    Read the Kendra source documents: S3 key -> (raw bytes, title, content).
+    """
+    documents = {}
+    with zipfile.ZipFile(zip_path) as archive:
+        for name in archive.namelist():
+            if not name.endswith(".txt"):
+                continue
+            raw = archive.read(name)
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                continue
+            documents[name] = (raw, data.get("Topic", ""), data.get("Concent", ""))
+    return documents
+
+
+class StubKendra:
+    """
+    Kendra client ranking the documents by word overlap with their title.
+    """
+
+    def __init__(self, documents, bucket, region, latency, recorder):
+        self.latency = latency
+        self.recorder = recorder
+        self.bucket = bucket
+        self.region = region
+        self._index = [
+            (key, title, set(WORD_PATTERN.findall(title.lower())), content)
+            for key, (_, title, content) in sorted(documents.items())
+        ]
+
+    def retrieve(self, **kwargs):
+        start = time.perf_counter()
+        query = kwargs["QueryText"]
+        self.latency.sleep("retrieval", query)
+        words = set(WORD_PATTERN.findall(query.lower()))
+        ranked = sorted(self._index, key=lambda doc: (-len(words & doc[2]), doc[0]))[
+            : kwargs.get("PageSize", 5)
+        ]
+        items = [
+            {
+                "Id": str(rank),
+                "DocumentId": key,
+                "DocumentURI": (
+                    f"https://s3.{self.region}.amazonaws.com/{self.bucket}/"
+                    f"{quote(key)}"
+                ),
+                "DocumentTitle": " ".join(title.split()),
+                "Content": " ".join(content.split())[:600],
+                "ScoreAttributes": {"ScoreConfidence": "HIGH"},
+                "DocumentAttributes": [],
+            }
+            for rank, (key, title, _, content) in enumerate(ranked, start=1)
+        ]
+        self.recorder.record("retrieval", time.perf_counter() - start)
+        return {
+            "QueryId": hashlib.sha256(query.encode()).hexdigest(),
+            "ResultItems": items,
+        }
+
+
+class _StubObjectSummary:
+    def __init__(self, key, raw):
+        self.key = key
+        self.e_tag = '"%s"' % hashlib.md5(raw).hexdigest()
+
+
+class _StubObject:
+    def __init__(self, resource, key):
+        self._resource = resource
+        self.key = key
+
+    def get(self, Range=None):
+        start = time.perf_counter()
+        self._resource.latency.sleep("s3", self.key)
+        raw = self._resource.documents[self.key][0]
+        if Range:
+            first, _, last = Range.partition("=")[2].partition("-")
+            raw = raw[int(first) : int(last) + 1]
+        self._resource.recorder.record("s3", time.perf_counter() - start)
+        return {"Body": _Body(raw)}
+
+
+class _StubObjects:
+    def __init__(self, resource):
+        self._resource = resource
+
+    def filter(self, Prefix=""):
+        return [
+            _StubObjectSummary(key, raw)
+            for key, (raw, _, _) in self._resource.documents.items()
+            if key.startswith(Prefix)
+        ]
+
+
+class _StubBucket:
+    def __init__(self, resource):
+        self.objects = _StubObjects(resource)
+
+
+class StubS3Resource:
+    """
+    S3 resource serving the Kendra source documents.
+    """
+
+    def __init__(self, documents, latency, recorder):
+        self.documents = documents
+        self.latency = latency
+        self.recorder = recorder
+
+    def Bucket(self, name):
+        return _StubBucket(self)
+
+    def Object(self, bucket, key):
+        return _StubObject(self, unquote(key))
+
+
+def install_sql_latency(latency, recorder):
+    """
+    Add the "sql_execution" latency to every SQL statement and record it.
+
+    Output:
+        function removing the event listeners
+    """
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("benchmark_start", []).append(time.perf_counter())
+        latency.sleep("sql_execution", statement)
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["benchmark_start"].pop()
+        recorder.record("sql_execution", time.perf_counter() - start)
+
+    event.listen(Engine, "before_cursor_execute", before)
+    event.listen(Engine, "after_cursor_execute", after)
+
+    def remove():
+        event.remove(Engine, "before_cursor_execute", before)
+        event.remove(Engine, "after_cursor_execute", after)
+
+    return remove
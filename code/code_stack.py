@@ -1,3 +1,4 @@
+import json
 import os
 import os.path as path
 from aws_cdk import (
@@ -16,13 +17,40 @@ from aws_cdk import (
     aws_lambda as lambda_,
     aws_s3_deployment as s3deploy,
     aws_ecs_patterns as ecs_patterns,
+    aws_dynamodb as dynamodb,
 )
 from constructs import Construct
 from aws_cdk.aws_ecr_assets import Platform
 from cdk_nag import NagSuppressions
 
+from code.source_manifest import write_source_manifest
+
 SAGEMAKER_PRICING_DESTINATION_PREFIX = "source_data"
 ASSETS_FOLDER_NAME = "assets"
+KENDRA_DOCUMENTS_ZIP = "kendra_documents/sm_dg.zip"
+SOURCE_MANIFEST_FILE_NAME = "source_manifest.json"
+TABLE_INDEX_MANIFEST = path.join("table_index", "manifest.json")
+
+
+def check_table_index(lambda_code_dir):
+    """
+    Fail the synthesis when the prebuilt table-schema index is missing from the
+    Lambda build context; it is embedded with Amazon Bedrock by
+    build_table_index.py, which cannot run inside the image build.
+    """
+    manifest_path = path.join(lambda_code_dir, TABLE_INDEX_MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    if not manifest.get("fingerprint"):
+        raise FileNotFoundError(
+            f"No prebuilt table index in {path.dirname(manifest_path)}. Run "
+            "`python build_table_index.py` from code/lambda-container with AWS "
+            "credentials, or set the require_table_index context to false to "
+            "embed the table descriptions in every new container instead."
+        )
 
 
 class CodeStack(Stack):
@@ -30,11 +58,24 @@ class CodeStack(Stack):
         super().__init__(scope, construct_id, **kwargs)
 
         logging_context = dict(self.node.try_get_context("logging"))
+        pricing_sql_backend = (
+            self.node.try_get_context("pricing_sql_backend") or "athena"
+        )
+        response_streaming = self.node.try_get_context("response_streaming")
+        response_streaming = response_streaming in (None, True, "true")
+        session_backend = self.node.try_get_context("session_backend") or "dynamodb"
+        require_table_index = self.node.try_get_context("require_table_index")
+        require_table_index = require_table_index in (None, True, "true")
         kms_key = self.create_kms_key()
         kendra_bucket, sagemaker_bucket = self.create_data_source_bucket(kms_key)
         kendra_index = self.create_kendra_index(kendra_bucket, kms_key)
         self.upload_files_to_s3(kendra_bucket, sagemaker_bucket, kms_key)
         glue_database, _ = self.create_glue_database(sagemaker_bucket, kms_key)
+        session_table = (
+            self.create_session_table(kms_key)
+            if session_backend == "dynamodb"
+            else None
+        )
         lambda_function = self.create_lambda_function(
             kendra_index,
             kendra_bucket,
@@ -42,8 +83,14 @@ class CodeStack(Stack):
             kms_key,
             glue_database,
             logging_context,
+            pricing_sql_backend,
+            response_streaming,
+            session_table,
+            require_table_index,
+        )
+        self.create_streamlit_app(
+            lambda_function, logging_context, response_streaming
         )
-        self.create_streamlit_app(lambda_function, logging_context)
 
     def create_kms_key(self):
         # Creating new KMS key and configure it for S3 object encryption
@@ -82,6 +129,29 @@ class CodeStack(Stack):
 
         return kms_key
 
+    def create_session_table(self, kms_key):
+        # Conversation history of the chat sessions, expired through TTL
+        session_table = dynamodb.Table(
+            self,
+            "SessionTable",
+            table_name=f"{Aws.STACK_NAME}-chat-sessions",
+            partition_key=dynamodb.Attribute(
+                name="session_id", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            encryption=dynamodb.TableEncryption.CUSTOMER_MANAGED,
+            encryption_key=kms_key,
+            time_to_live_attribute="expires_at",
+            point_in_time_recovery_specification=(
+                dynamodb.PointInTimeRecoverySpecification(
+                    point_in_time_recovery_enabled=True
+                )
+            ),
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        CfnOutput(self, "SessionTableName", value=session_table.table_name)
+        return session_table
+
     def create_data_source_bucket(self, kms_key):
         # creating kendra source bucket
         kendra_bucket = s3.Bucket(
@@ -231,9 +301,7 @@ class CodeStack(Stack):
             "KendraDocumentDeployment",
             sources=[
                 s3deploy.Source.asset(
-                    path.join(
-                        os.getcwd(), ASSETS_FOLDER_NAME, "kendra_documents/sm_dg.zip"
-                    )
+                    path.join(os.getcwd(), ASSETS_FOLDER_NAME, KENDRA_DOCUMENTS_ZIP)
                 )
             ],
             destination_bucket=kendra_bucket,
@@ -350,11 +418,28 @@ class CodeStack(Stack):
         kms_key,
         glue_database,
         logging_context,
+        pricing_sql_backend="athena",
+        response_streaming=True,
+        session_table=None,
+        require_table_index=True,
     ):
-        # Create AWS Lambda function
+        lambda_code_dir = path.join(os.getcwd(), "code", "lambda-container")
+        if require_table_index:
+            check_table_index(lambda_code_dir)
+        # Map Kendra documents to their web URLs so citations resolve without S3
+        write_source_manifest(
+            path.join(os.getcwd(), ASSETS_FOLDER_NAME, KENDRA_DOCUMENTS_ZIP),
+            path.join(lambda_code_dir, SOURCE_MANIFEST_FILE_NAME),
+        )
+
+        # Create AWS Lambda function. The streaming runtime sends streamed
+        # answers as they are generated and buffers every other response.
         ecr_image = lambda_.EcrImageCode.from_asset_image(
-            directory=path.join(os.getcwd(), "code", "lambda-container"),
+            directory=lambda_code_dir,
             platform=Platform.LINUX_ARM64,
+            entrypoint=(
+                ["python3", "-m", "streaming_runtime"] if response_streaming else None
+            ),
         )
 
         # Create IAM role for Lambda function
@@ -396,6 +481,9 @@ class CodeStack(Stack):
                 "PRICING_DATA_SOURCE_BUCKET_NAME": sagemaker_bucket.bucket_name,
                 "SAGEMAKER_PRICING_DATABASE": glue_database.ref,
                 "LOG_LEVEL": logging_context["lambda_log_level"],
+                "PRICING_SQL_BACKEND": pricing_sql_backend,
+                "SESSION_BACKEND": "dynamodb" if session_table else "memory",
+                "SESSION_TABLE_NAME": session_table.table_name if session_table else "",
             },
             environment_encryption=kms_key,
             role=lambda_role,
@@ -403,6 +491,8 @@ class CodeStack(Stack):
             memory_size=2048,
         )
 
+        if session_table:
+            session_table.grant_read_write_data(lambda_role)
         sagemaker_bucket.grant_read_write(lambda_role)
         kendra_bucket.grant_read_write(lambda_role)
         lambda_role.add_to_policy(
@@ -416,7 +506,9 @@ class CodeStack(Stack):
         CfnOutput(self, "LambdaName", value=lambda_function.function_name)
         return lambda_function
 
-    def create_streamlit_app(self, lambda_function, logging_context):
+    def create_streamlit_app(
+        self, lambda_function, logging_context, response_streaming=True
+    ):
         # Create a VPC
         vpc = ec2.Vpc(
             self, "DemoVPC", max_azs=2, vpc_name=f"{Aws.STACK_NAME}-vpc"
@@ -457,6 +549,7 @@ class CodeStack(Stack):
                     "LAMBDA_FUNCTION_NAME": lambda_function.function_name,
                     "LAMBDA_FUNCTION_ARN": lambda_function.function_arn,
                     "LOG_LEVEL": logging_context["streamlit_log_level"],
+                    "RESPONSE_STREAMING": str(response_streaming).lower(),
                 },
             ),
             service_name=f"{Aws.STACK_NAME}-chat-service",
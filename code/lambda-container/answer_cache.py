@@ -0,0 +1,354 @@
+"""
+This script is to serve repeated questions from a semantic cache of answers.
+
+Questions are embedded and compared by cosine similarity with the questions
+already answered for the same intent. A cached answer is returned when the
+closest question is at least ANSWER_CACHE_SIMILARITY similar and mentions the
+same instance types and numbers. Entries expire after ANSWER_CACHE_TTL_SECONDS
+and are all dropped when the pricing data or the Kendra documents change (see
+data_version.py). Documentation answers are generated with the session history
+in the prompt, so they are neither served nor cached once a session has
+history; follow-up questions of the other intents skip the cache too.
+"""
+
+import contextvars
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_aws import BedrockEmbeddings
+
+from caching import LRUTTLCache
+from connections import Connections
+from data_version import kendra_data_version
+from metrics import record_cache_lookup
+from pricing_data import pricing_data_version
+from sagemaker_pricing import EMBEDDING_MODEL_ID
+from session_memory import get_by_session_id
+from utils import normalize_question
+
+# Off by default: the cache is shared by every user of a container, and whether
+# two questions have the same answer is only judged by heuristics. Questions
+# at least ANSWER_CACHE_SIMILARITY similar are told apart only by the tokens
+# holding a digit (ENTITY_PATTERN), so "how do I create an endpoint" and "how do
+# I delete an endpoint" can share an answer, and follow-ups are recognized from
+# their wording (FOLLOW_UP_PATTERN) only. Enable it for traffic whose repeated
+# questions have been reviewed, with a threshold tuned on the logged similarity
+# histogram.
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.92"))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "86400"))
+
+# Intents whose answers can be cached; refusals are cheap and never cached
+CACHEABLE_INTENTS = frozenset({"UseCase1", "UseCase2", "UseCase3"})
+# Intents answered with the session history in the prompt (sagemaker_dg_rag.py)
+HISTORY_INTENTS = frozenset({"UseCase1"})
+
+# Tokens holding a digit: instance types (ml.p4d.24xlarge), sizes, years...
+# Two questions differing only in such a token embed almost identically but
+# have different answers.
+ENTITY_PATTERN = re.compile(r"[a-z0-9.\-]*\d[a-z0-9.\-]*")
+
+# Questions that refer back to an earlier turn of the conversation
+FOLLOW_UP_PATTERN = re.compile(
+    r"^\s*(and|also|what about|how about|then)\b"
+    r"|\b(it|its|they|them|their|this|that|these|those|above|previous|same)\b",
+    re.IGNORECASE,
+)
+
+SIMILARITY_BIN_WIDTH = 0.05
+
+# Questions are embedded while their intent is classified, see start_embedding()
+_embedding_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="answer-embedding"
+)
+
+CacheLookup = namedtuple("CacheLookup", ["answer", "embedding", "similarity"])
+_Entry = namedtuple("_Entry", ["vector", "entities", "answer", "latency"])
+
+
+def question_entities(query):
+    """
+    Return the set of tokens of a question that contain a digit.
+    """
+    return frozenset(ENTITY_PATTERN.findall(query.lower()))
+
+
+def has_history(session_id):
+    """
+    Whether a chat session already has earlier turns; True if unknown.
+    """
+    if not session_id:
+        return False
+    try:
+        return bool(get_by_session_id(session_id).messages)
+    except Exception:
+        logging.exception("Could not read the history of session %s", session_id)
+        return True
+
+
+def is_follow_up(query, session_id):
+    """
+    Whether a question refers back to a conversation that has history.
+
+    The history is only read when the wording looks like a follow-up.
+    """
+    return bool(FOLLOW_UP_PATTERN.search(query)) and has_history(session_id)
+
+
+def data_version():
+    """
+    Version stamp of the data every cached answer was computed from, or None
+    while either version is not known yet.
+    """
+    versions = (kendra_data_version.get(), pricing_data_version.get())
+    return None if None in versions else versions
+
+
+class SemanticAnswerCache:
+    """
+    LRU/TTL cache of answers looked up by question similarity within a scope.
+
+    Inputs:
+        embed (callable): str -> list of floats
+        threshold (float): minimum cosine similarity of a hit
+        version (callable): returns the data version stamp, or None while it
+            is not known; the cache is bypassed until it is
+    """
+
+    def __init__(
+        self,
+        embed,
+        threshold=ANSWER_CACHE_SIMILARITY,
+        maxsize=ANSWER_CACHE_SIZE,
+        ttl=ANSWER_CACHE_TTL_SECONDS,
+        version=None,
+        clock=time.monotonic,
+    ):
+        self._embed = embed
+        self.threshold = threshold
+        self._version = version
+        self._entries = LRUTTLCache(
+            maxsize=maxsize,
+            ttl=ttl,
+            name="answer",
+            clock=clock,
+            track_metrics=False,
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.latency_saved = 0.0
+        self.similarities = Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _record(self, similarity):
+        if similarity is None:
+            return
+        bin_start = math.floor(similarity / SIMILARITY_BIN_WIDTH) * SIMILARITY_BIN_WIDTH
+        self.similarities[f"{bin_start:.2f}"] += 1
+
+    def embed(self, query):
+        """
+        Return the normalized embedding of a question.
+        """
+        return self._normalize(self._embed(query))
+
+    def lookup(self, query, scope, pending_embedding=None):
+        """
+        Find the answer of the most similar question asked in the same scope.
+
+        The embedding is only needed when the question is not an exact repeat.
+
+        Inputs:
+            query (str): question from the user
+            scope (str): cache scope, e.g. the question intent
+            pending_embedding (Future): the embedding of the question started
+                with start_embedding(), or None to embed it here
+        Output:
+            CacheLookup(answer, embedding, similarity): answer is None on a
+            miss, embedding is passed back to store() to avoid a second call.
+            None when the data version is not known yet.
+        """
+        if self._version is not None:
+            version = self._version()
+            if version is None:
+                self.bypass()
+                return None
+            self._entries.ensure_version(version)
+
+        key = (scope, normalize_question(query))
+        entry = self._entries.get(key)
+        embedding = None
+        similarity = None
+        if entry is None:
+            if pending_embedding is None:
+                embedding = self.embed(query)
+            else:
+                embedding = pending_embedding.result()
+            entity_set = question_entities(query)
+            candidates = [
+                (cached_key, cached)
+                for cached_key, cached in self._entries.items()
+                if cached_key[0] == scope
+            ]
+            if candidates:
+                matrix = np.stack([cached.vector for _, cached in candidates])
+                scores = matrix @ embedding
+                best = int(np.argmax(scores))
+                similarity = float(scores[best])
+                cached_key, cached = candidates[best]
+                if similarity >= self.threshold and cached.entities == entity_set:
+                    # Refresh the recency of the entry that served the hit
+                    entry = self._entries.get(cached_key)
+        else:
+            similarity = 1.0
+
+        record_cache_lookup("answer", entry is not None)
+        with self._lock:
+            self._record(similarity)
+            if entry is None:
+                self.misses += 1
+                return CacheLookup(None, embedding, similarity)
+            self.hits += 1
+            self.latency_saved += entry.latency
+        return CacheLookup(entry.answer, embedding, similarity)
+
+    def store(self, query, scope, answer, latency, embedding=None):
+        """
+        Cache the answer of a question.
+
+        Inputs:
+            latency (float): seconds it took to compute the answer, counted as
+                saved on every later hit
+            embedding: the embedding returned by lookup(), if any
+        """
+        if embedding is None:
+            embedding = self.embed(query)
+        entry = _Entry(embedding, question_entities(query), answer, latency)
+        self._entries.set((scope, normalize_question(query)), entry)
+
+    def bypass(self):
+        """
+        Count a question that skipped the cache, e.g. a follow-up.
+        """
+        with self._lock:
+            self.bypassed += 1
+
+    def invalidate(self):
+        self._entries.invalidate()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "latency_saved_seconds": round(self.latency_saved, 3),
+                "similarity_histogram": dict(sorted(self.similarities.items())),
+            }
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """
+    Return the container-wide answer cache, or None when it is disabled.
+    """
+    global _answer_cache
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            embeddings = BedrockEmbeddings(
+                client=Connections.bedrock_client,
+                model_id=EMBEDDING_MODEL_ID,
+            )
+            _answer_cache = SemanticAnswerCache(
+                embeddings.embed_query, version=data_version
+            )
+        return _answer_cache
+
+
+def start_embedding(cache, query):
+    """
+    Start embedding a question in the background, so that a cache miss does not
+    wait for the embedding call after the intent is classified.
+
+    Output:
+        Future of the embedding, or None when the cache is disabled
+    """
+    if cache is None:
+        return None
+    return _embedding_executor.submit(
+        contextvars.copy_context().run, cache.embed, query
+    )
+
+
+def lookup_answer(cache, query, scope, session_id, embedding=None):
+    """
+    Look up a cached answer, treating cache errors as misses.
+
+    Inputs:
+        embedding (Future): the embedding started with start_embedding(), if any
+    Output:
+        CacheLookup, or None when the question must not use the cache
+    """
+    if cache is None or scope not in CACHEABLE_INTENTS:
+        return None
+    # an answer generated with the history must not be served to anyone else
+    if (scope in HISTORY_INTENTS and has_history(session_id)) or is_follow_up(
+        query, session_id
+    ):
+        cache.bypass()
+        return None
+    try:
+        result = cache.lookup(query, scope, embedding)
+    except Exception:
+        logging.exception("Answer cache lookup failed")
+        return None
+    if result is None:
+        logging.info("Answer cache bypassed until the data version is known")
+        return None
+    logging.info(
+        "Answer cache %s for %s (similarity %s): %s",
+        "hit" if result.answer is not None else "miss",
+        scope,
+        None if result.similarity is None else round(result.similarity, 3),
+        cache.stats(),
+    )
+    return result
+
+
+def store_answer(cache, lookup, query, scope, answer, latency):
+    """
+    Cache an answer after a miss; empty answers, and degraded answers given
+    when the request ran out of time (see deadline.py), are not cached.
+    """
+    if lookup is None or not answer.get("answer") or answer.get("degraded"):
+        return
+    try:
+        cache.store(query, scope, answer, latency, embedding=lookup.embedding)
+    except Exception:
+        logging.exception("Could not cache the answer")
@@ -0,0 +1,462 @@
+"""
+This script is to answer a batch of questions through index.get_response, e.g.
+for regression checks or to warm the caches.
+
+The questions are read from a JSONL file, one {"query", "id", "session_id"}
+object per line; "id" defaults to the line number and "session_id" to a session
+of its own per question. A bounded pool of BATCH_CONCURRENCY workers answers
+them, and each result is appended to the output JSONL as soon as it is known:
+{"id", "query", "status", "answer", "source", "latency_ms", "attempts",
+"throttles", "usage", "error"}, where "usage" has the LLM calls, tokens and cost
+of the question.
+
+Runs are resumable: questions whose id already has an "ok" line in the output
+are skipped, and the others (errors, or not reached) are answered again. When a
+question is answered twice, its last line wins.
+
+Workers take a token from an AdaptiveTokenBucket before each attempt. The bucket
+starts at BATCH_RATE questions per second. A Bedrock ThrottlingException halves
+the rate, and the question is retried after an exponential backoff with jitter,
+up to BATCH_MAX_RETRIES times. Each answered question raises the rate by
+BATCH_RATE_INCREASE, up to BATCH_MAX_RATE.
+
+From code/lambda-container:
+
+    python batch_questions.py questions.jsonl answers.jsonl --concurrency 4
+
+As a Lambda event, with S3 URIs or paths in the container:
+
+    {"batch": {"input": "s3://bucket/questions.jsonl",
+               "output": "s3://bucket/answers.jsonl", "concurrency": 4}}
+
+The Lambda function stops starting questions BATCH_STOP_MARGIN_SECONDS before
+its timeout, uploads the output and returns "complete": false; invoking it
+again with the same event resumes the batch.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from connections import Connections
+from index import get_response
+
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_RATE = float(os.environ.get("BATCH_RATE", "1.0"))
+BATCH_MAX_RATE = float(os.environ.get("BATCH_MAX_RATE", "4.0"))
+BATCH_MIN_RATE = float(os.environ.get("BATCH_MIN_RATE", "0.05"))
+BATCH_RATE_INCREASE = float(os.environ.get("BATCH_RATE_INCREASE", "0.05"))
+BATCH_MAX_RETRIES = int(os.environ.get("BATCH_MAX_RETRIES", "5"))
+BATCH_BACKOFF_SECONDS = float(os.environ.get("BATCH_BACKOFF_SECONDS", "1.0"))
+BATCH_MAX_BACKOFF_SECONDS = float(os.environ.get("BATCH_MAX_BACKOFF_SECONDS", "30"))
+BATCH_STOP_MARGIN_SECONDS = float(os.environ.get("BATCH_STOP_MARGIN_SECONDS", "120"))
+
+THROTTLING_ERROR_CODES = frozenset(
+    {
+        "ThrottlingException",
+        "TooManyRequestsException",
+        "ServiceQuotaExceededException",
+    }
+)
+
+
+def is_throttling_error(error):
+    """
+    Whether an exception, or one it was raised from, is a Bedrock throttle.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, ClientError):
+            if error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+                return True
+        elif type(error).__name__ in THROTTLING_ERROR_CODES:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class AdaptiveTokenBucket:
+    """
+    Token bucket whose rate backs off on throttles and recovers on successes.
+
+    The rate is halved (decrease) at most once per cooldown seconds, so that
+    the throttles of the requests already in flight count as one, and grows by
+    increase per success (additive increase, multiplicative decrease).
+    """
+
+    def __init__(
+        self,
+        rate=BATCH_RATE,
+        max_rate=BATCH_MAX_RATE,
+        min_rate=BATCH_MIN_RATE,
+        increase=BATCH_RATE_INCREASE,
+        decrease=0.5,
+        cooldown=1.0,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.rate = rate
+        self.max_rate = max(max_rate, rate)
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = 1.0
+        self._updated = clock()
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(1.0, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Block until a request may start.
+        """
+        while True:
+            with self._lock:
+                self._refill(self._clock())
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            self._sleep(wait)
+
+    def on_throttle(self):
+        with self._lock:
+            now = self._clock()
+            if (
+                self._last_decrease is not None
+                and now - self._last_decrease < self.cooldown
+            ):
+                return
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+            self._last_decrease = now
+        logging.warning("Throttled by Bedrock, batch rate now %.2f/s", self.rate)
+
+    def on_success(self):
+        with self._lock:
+            self._refill(self._clock())
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+def load_questions(path):
+    """
+    Read the questions of a JSONL file.
+
+    Output:
+        list of dicts with a str "id" and a "query"
+    """
+    questions = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            item["id"] = str(item.get("id", line_number))
+            questions.append(item)
+    return questions
+
+
+def load_completed(path):
+    """
+    Ids answered successfully in an existing output file.
+
+    A partial last line, left by an interrupted run, is ignored.
+    """
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                completed.add(str(record["id"]))
+            else:
+                completed.discard(str(record["id"]))
+    return completed
+
+
+class JsonlWriter:
+    """
+    Thread-safe appender of JSON lines, flushed after every line.
+    """
+
+    def __init__(self, path):
+        ends_with_newline = True
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                ends_with_newline = f.read(1) == b"\n"
+        self._file = open(path, "a")
+        if not ends_with_newline:
+            # terminate the partial line of an interrupted run
+            self._file.write("\n")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class BatchRunner:
+    """
+    Answer questions with a bounded worker pool and an adaptive rate.
+
+    Inputs:
+        answer (callable): (query, session_id) -> get_response output
+        bucket (AdaptiveTokenBucket): rate of the attempts
+        concurrency (int): number of workers
+        max_retries (int): retries of a throttled question
+        backoff (float): first backoff after a throttle, in seconds
+        should_stop (callable): () -> bool, checked before each question
+    """
+
+    def __init__(
+        self,
+        answer=None,
+        bucket=None,
+        concurrency=BATCH_CONCURRENCY,
+        max_retries=BATCH_MAX_RETRIES,
+        backoff=BATCH_BACKOFF_SECONDS,
+        max_backoff=BATCH_MAX_BACKOFF_SECONDS,
+        should_stop=None,
+        sleep=time.sleep,
+    ):
+        self.answer = answer or (
+            lambda query, session_id: get_response(query, session_id, True)
+        )
+        self.bucket = bucket or AdaptiveTokenBucket()
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.should_stop = should_stop or (lambda: False)
+        self._sleep = sleep
+
+    def answer_question(self, item, run_id):
+        """
+        Answer one question, retrying it on throttles.
+
+        Output:
+            the output record of the question (dict)
+        """
+        session_id = item.get("session_id") or f"batch-{run_id}-{item['id']}"
+        record = {"id": item["id"], "query": item["query"], "throttles": 0}
+        start = time.perf_counter()
+        for attempt in range(1, self.max_retries + 2):
+            self.bucket.acquire()
+            try:
+                output = self.answer(item["query"], session_id)
+            except Exception as e:
+                if is_throttling_error(e) and attempt <= self.max_retries:
+                    record["throttles"] += 1
+                    self.bucket.on_throttle()
+                    delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                    self._sleep(delay * random.uniform(0.5, 1.0))
+                    continue
+                logging.exception("Batch question %s failed", item["id"])
+                record.update(status="error", error=repr(e))
+                break
+            self.bucket.on_success()
+            usage = output.get("usage") or {}
+            record.update(
+                status="ok",
+                answer=output.get("answer"),
+                source=output.get("source"),
+                usage=usage.get("total"),
+            )
+            break
+        record["attempts"] = attempt
+        record["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return record
+
+    def run(self, questions, writer, run_id="run"):
+        """
+        Answer the questions and write each result as it completes.
+
+        Output:
+            dict: counts of the run, and whether every question was reached
+        """
+        pending = iter(questions)
+        pending_lock = threading.Lock()
+        counts = {"ok": 0, "errors": 0, "throttles": 0, "stopped": False}
+        counts_lock = threading.Lock()
+
+        def next_question():
+            with pending_lock:
+                if counts["stopped"]:
+                    return None
+                if self.should_stop():
+                    counts["stopped"] = True
+                    return None
+                return next(pending, None)
+
+        def worker():
+            while True:
+                item = next_question()
+                if item is None:
+                    return
+                record = self.answer_question(item, run_id)
+                writer.write(record)
+                with counts_lock:
+                    counts["ok" if record["status"] == "ok" else "errors"] += 1
+                    counts["throttles"] += record["throttles"]
+
+        with ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="batch"
+        ) as executor:
+            workers = [executor.submit(worker) for _ in range(self.concurrency)]
+            for future in workers:
+                future.result()
+        counts["complete"] = not counts.pop("stopped")
+        return counts
+
+
+def run_batch(input_path, output_path, runner=None, run_id=None):
+    """
+    Answer the questions of input_path not yet answered in output_path.
+
+    Output:
+        dict: summary of the run
+    """
+    runner = runner or BatchRunner()
+    questions = load_questions(input_path)
+    completed = load_completed(output_path)
+    remaining = [item for item in questions if item["id"] not in completed]
+    logging.info(
+        "Batch of %d questions, %d already answered",
+        len(questions),
+        len(questions) - len(remaining),
+    )
+
+    start = time.perf_counter()
+    writer = JsonlWriter(output_path)
+    try:
+        counts = runner.run(remaining, writer, run_id or str(int(time.time())))
+    finally:
+        writer.close()
+    summary = {
+        "total": len(questions),
+        "skipped": len(questions) - len(remaining),
+        **counts,
+        "elapsed_s": round(time.perf_counter() - start, 3),
+        "final_rate": round(runner.bucket.rate, 3),
+        "output": output_path,
+    }
+    logging.info("Batch summary: %s", summary)
+    return summary
+
+
+def _split_s3_uri(uri):
+    bucket, _, key = uri[len("s3://") :].partition("/")
+    return bucket, key
+
+
+def _download(uri, path):
+    """
+    Copy an S3 object to path; False when it does not exist.
+    """
+    bucket, key = _split_s3_uri(uri)
+    try:
+        body = Connections.s3_resource.Object(bucket, key).get()["Body"].read()
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return False
+        raise
+    with open(path, "wb") as f:
+        f.write(body)
+    return True
+
+
+def run_batch_event(batch, context=None):
+    """
+    Run a batch from a Lambda event (see the module docstring).
+
+    Inputs:
+        batch (dict): "input" and "output" S3 URIs or local paths, and
+            optionally "concurrency" and "run_id"
+        context: Lambda context, whose remaining time bounds the run
+    Output:
+        dict: summary of the run
+    """
+    should_stop = None
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        margin_ms = BATCH_STOP_MARGIN_SECONDS * 1000
+
+        def should_stop():
+            return context.get_remaining_time_in_millis() < margin_ms
+
+    runner = BatchRunner(
+        concurrency=int(batch.get("concurrency", BATCH_CONCURRENCY)),
+        should_stop=should_stop,
+    )
+    input_uri, output_uri = batch["input"], batch["output"]
+    run_id = batch.get("run_id") or getattr(context, "aws_request_id", None)
+    if not input_uri.startswith("s3://") and not output_uri.startswith("s3://"):
+        return run_batch(input_uri, output_uri, runner, run_id)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path, output_path = input_uri, output_uri
+        if input_uri.startswith("s3://"):
+            input_path = os.path.join(tmp, "questions.jsonl")
+            _download(input_uri, input_path)
+        if output_uri.startswith("s3://"):
+            output_path = os.path.join(tmp, "answers.jsonl")
+            _download(output_uri, output_path)
+        try:
+            summary = run_batch(input_path, output_path, runner, run_id)
+        finally:
+            if output_uri.startswith("s3://") and os.path.exists(output_path):
+                bucket, key = _split_s3_uri(output_uri)
+                with open(output_path, "rb") as f:
+                    Connections.s3_resource.Object(bucket, key).put(Body=f.read())
+        summary["output"] = output_uri
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input", help="JSONL file of questions")
+    parser.add_argument("output", help="JSONL file of answers, appended to")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument(
+        "--rate", type=float, default=BATCH_RATE, help="initial questions/second"
+    )
+    parser.add_argument("--max-rate", type=float, default=BATCH_MAX_RATE)
+    parser.add_argument("--max-retries", type=int, default=BATCH_MAX_RETRIES)
+    args = parser.parse_args()
+    logging.basicConfig(level=Connections.log_level)
+
+    runner = BatchRunner(
+        bucket=AdaptiveTokenBucket(rate=args.rate, max_rate=args.max_rate),
+        concurrency=args.concurrency,
+        max_retries=args.max_retries,
+    )
+    print(json.dumps(run_batch(args.input, args.output, runner), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+"""
+This script is to route every Bedrock runtime call of the container through one
+gateway with a shared concurrency, retry, timeout and failover policy.
+
+ChatBedrock (connections.py), BedrockConverse (sagemaker_pricing.py) and
+BedrockEmbeddings all take Connections.bedrock_client, a BedrockGateway wrapping
+the boto3 bedrock-runtime client. For each call, the gateway applies:
+- a concurrency limit per model id (BEDROCK_MAX_CONCURRENCY, or the limits of
+  BEDROCK_MODEL_CONCURRENCY, a JSON object of model id -> limit); calls over
+  the limit wait for a slot
+- retries of throttles, server errors and timeouts, up to BEDROCK_MAX_ATTEMPTS
+  attempts, with exponential backoff and full jitter. Botocore's own retries
+  are disabled, so that attempts are not multiplied.
+- a timeout per attempt (BEDROCK_CALL_TIMEOUT_SECONDS, or the time left
+  before the request deadline, see deadline.py), waiting for a slot included;
+  no attempt starts past the deadline, which raises DeadlineExceeded
+- a circuit breaker per model id: after BEDROCK_BREAKER_FAILURES failed
+  attempts in a row, calls fail fast for BEDROCK_BREAKER_RESET_SECONDS, then
+  one trial call decides whether the circuit closes again. While the circuit
+  of a model is open, its calls go to its fallback model, if it has one.
+
+BEDROCK_FALLBACK_MODELS pairs models with their fallback model, e.g.
+"ClaudeSonnet:ClaudeHaiku". With BEDROCK_HEDGING=true, an InvokeModel or
+Converse call of such a model that takes longer than the
+BEDROCK_HEDGE_PERCENTILE of its recent latencies (for the same max_tokens) is
+hedged: the same request is sent to the fallback model, and the first answer
+wins. Both calls are billed, and the tokens of a winning hedge are counted
+under the primary model.
+
+Streaming calls get the concurrency limit, retries and circuit breaker until
+the stream is returned; they are neither timed out nor hedged.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+
+import numpy as np
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError,
+    ConnectionError as BotocoreConnectionError,
+    ReadTimeoutError,
+)
+
+from deadline import DeadlineExceeded, bounded, check, expired
+from metrics import increment
+
+BEDROCK_MAX_CONCURRENCY = int(os.environ.get("BEDROCK_MAX_CONCURRENCY", "16"))
+BEDROCK_MODEL_CONCURRENCY = json.loads(
+    os.environ.get("BEDROCK_MODEL_CONCURRENCY", "{}")
+)
+BEDROCK_MAX_ATTEMPTS = int(os.environ.get("BEDROCK_MAX_ATTEMPTS", "4"))
+BEDROCK_BACKOFF_SECONDS = float(os.environ.get("BEDROCK_BACKOFF_SECONDS", "0.5"))
+BEDROCK_MAX_BACKOFF_SECONDS = float(os.environ.get("BEDROCK_MAX_BACKOFF_SECONDS", "8"))
+# 4096 output tokens of Claude Sonnet take about a minute
+BEDROCK_CALL_TIMEOUT_SECONDS = float(
+    os.environ.get("BEDROCK_CALL_TIMEOUT_SECONDS", "120")
+)
+BEDROCK_CONNECT_TIMEOUT_SECONDS = float(
+    os.environ.get("BEDROCK_CONNECT_TIMEOUT_SECONDS", "5")
+)
+BEDROCK_BREAKER_FAILURES = int(os.environ.get("BEDROCK_BREAKER_FAILURES", "5"))
+BEDROCK_BREAKER_RESET_SECONDS = float(
+    os.environ.get("BEDROCK_BREAKER_RESET_SECONDS", "30")
+)
+BEDROCK_FALLBACK_MODELS = os.environ.get("BEDROCK_FALLBACK_MODELS", "")
+BEDROCK_HEDGING = os.environ.get("BEDROCK_HEDGING", "false").lower() == "true"
+BEDROCK_HEDGE_PERCENTILE = float(os.environ.get("BEDROCK_HEDGE_PERCENTILE", "95"))
+BEDROCK_HEDGE_MIN_SAMPLES = int(os.environ.get("BEDROCK_HEDGE_MIN_SAMPLES", "20"))
+
+RETRYABLE_ERROR_CODES = frozenset(
+    {
+        "ThrottlingException",
+        "TooManyRequestsException",
+        "ServiceUnavailableException",
+        "InternalServerException",
+        "ModelTimeoutException",
+        "ModelNotReadyException",
+    }
+)
+HEDGED_OPERATIONS = frozenset({"invoke_model", "converse"})
+SAMPLING_PARAMS = ("temperature", "top_p", "top_k", "topP", "topK")
+LATENCY_WINDOW = 200
+
+
+class CircuitOpenError(ClientError):
+    """
+    Raised without calling Bedrock while the circuit of the model is open.
+    """
+
+    def __init__(self, model_id, operation_name):
+        super().__init__(
+            {
+                "Error": {
+                    "Code": "ServiceUnavailableException",
+                    "Message": f"Circuit open for {model_id}",
+                }
+            },
+            operation_name,
+        )
+
+
+class CallTimeoutError(ClientError):
+    """
+    Raised when an attempt, waiting for a slot included, exceeds its timeout.
+    """
+
+    def __init__(self, model_id, operation_name, timeout):
+        super().__init__(
+            {
+                "Error": {
+                    "Code": "ModelTimeoutException",
+                    "Message": f"{model_id} did not answer within {timeout:.0f}s",
+                }
+            },
+            operation_name,
+        )
+
+
+def create_client_config(max_pool_connections=None):
+    """
+    Botocore config of the bedrock-runtime client wrapped by the gateway.
+
+    Retries are left to the gateway, and the connection pool fits the
+    concurrency limits.
+    """
+    return Config(
+        connect_timeout=BEDROCK_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=BEDROCK_CALL_TIMEOUT_SECONDS,
+        retries={"mode": "standard", "max_attempts": 1},
+        max_pool_connections=max_pool_connections or 4 * BEDROCK_MAX_CONCURRENCY,
+    )
+
+
+def parse_fallback_models(value, model_ids):
+    """
+    Parse "Primary:Fallback,..." model names into a model id -> model id dict.
+    """
+    fallbacks = {}
+    for pair in value.split(","):
+        if not pair.strip():
+            continue
+        primary, _, fallback = pair.partition(":")
+        primary, fallback = primary.strip(), fallback.strip()
+        fallbacks[model_ids.get(primary, primary)] = model_ids.get(fallback, fallback)
+    return fallbacks
+
+
+def is_retryable(error):
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES
+    return isinstance(error, (ReadTimeoutError, BotocoreConnectionError))
+
+
+class CircuitBreaker:
+    """
+    Closed, open or half-open state of one model id.
+    """
+
+    def __init__(
+        self,
+        failures=BEDROCK_BREAKER_FAILURES,
+        reset_seconds=BEDROCK_BREAKER_RESET_SECONDS,
+        clock=time.monotonic,
+    ):
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Whether a call may go to the model now.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if (
+                self.state == "open"
+                and self._clock() - self._opened_at >= self.reset_seconds
+            ):
+                # a single trial call
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self.state == "half_open" or self._consecutive_failures >= self.failures:
+                if self.state != "open":
+                    logging.warning("Opening the Bedrock circuit")
+                self.state = "open"
+                self._opened_at = self._clock()
+
+
+def _max_tokens(operation, kwargs):
+    if operation == "converse":
+        return (kwargs.get("inferenceConfig") or {}).get("maxTokens")
+    try:
+        return json.loads(kwargs.get("body") or "{}").get("max_tokens")
+    except (TypeError, ValueError):
+        return None
+
+
+class BedrockGateway:
+    """
+    bedrock-runtime client applying the gateway policy to its model calls.
+
+    Other attributes (meta, exceptions, ...) are those of the wrapped client.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_concurrency=BEDROCK_MAX_CONCURRENCY,
+        model_concurrency=None,
+        max_attempts=BEDROCK_MAX_ATTEMPTS,
+        backoff=BEDROCK_BACKOFF_SECONDS,
+        max_backoff=BEDROCK_MAX_BACKOFF_SECONDS,
+        call_timeout=BEDROCK_CALL_TIMEOUT_SECONDS,
+        breaker_failures=BEDROCK_BREAKER_FAILURES,
+        breaker_reset_seconds=BEDROCK_BREAKER_RESET_SECONDS,
+        fallback_models=None,
+        hedging=BEDROCK_HEDGING,
+        hedge_percentile=BEDROCK_HEDGE_PERCENTILE,
+        hedge_min_samples=BEDROCK_HEDGE_MIN_SAMPLES,
+        models_without_sampling_params=(),
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self._client = client
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = dict(
+            BEDROCK_MODEL_CONCURRENCY
+            if model_concurrency is None
+            else model_concurrency
+        )
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.call_timeout = call_timeout
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_seconds = breaker_reset_seconds
+        self.fallback_models = dict(fallback_models or {})
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.models_without_sampling_params = frozenset(models_without_sampling_params)
+        self._clock = clock
+        self._sleep = sleep
+        self._semaphores = {}
+        self._breakers = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+        # Attempts run here when they have a timeout; hedged calls run their
+        # retries in a pool of their own, so they never wait on their attempts
+        self._attempt_executor = ThreadPoolExecutor(
+            max_workers=4 * max_concurrency, thread_name_prefix="bedrock"
+        )
+        self._hedge_executor = ThreadPoolExecutor(
+            max_workers=2 * max_concurrency, thread_name_prefix="bedrock-hedge"
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def with_client(self, client):
+        """
+        A new gateway with the same policy around another client, e.g. a stub.
+        """
+        return BedrockGateway(
+            client,
+            max_concurrency=self.max_concurrency,
+            model_concurrency=self.model_concurrency,
+            max_attempts=self.max_attempts,
+            backoff=self.backoff,
+            max_backoff=self.max_backoff,
+            call_timeout=self.call_timeout,
+            breaker_failures=self.breaker_failures,
+            breaker_reset_seconds=self.breaker_reset_seconds,
+            fallback_models=self.fallback_models,
+            hedging=self.hedging,
+            hedge_percentile=self.hedge_percentile,
+            hedge_min_samples=self.hedge_min_samples,
+            models_without_sampling_params=self.models_without_sampling_params,
+            clock=self._clock,
+            sleep=self._sleep,
+        )
+
+    # Bedrock runtime operations used by LangChain and llama-index
+    def invoke_model(self, **kwargs):
+        return self._call("invoke_model", kwargs)
+
+    def converse(self, **kwargs):
+        return self._call("converse", kwargs)
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        return self._call("invoke_model_with_response_stream", kwargs)
+
+    def converse_stream(self, **kwargs):
+        return self._call("converse_stream", kwargs)
+
+    def _semaphore(self, model_id):
+        with self._lock:
+            semaphore = self._semaphores.get(model_id)
+            if semaphore is None:
+                limit = self.model_concurrency.get(model_id, self.max_concurrency)
+                semaphore = self._semaphores[model_id] = threading.BoundedSemaphore(
+                    limit
+                )
+            return semaphore
+
+    def breaker(self, model_id):
+        """
+        Return the circuit breaker of a model id.
+        """
+        with self._lock:
+            breaker = self._breakers.get(model_id)
+            if breaker is None:
+                breaker = self._breakers[model_id] = CircuitBreaker(
+                    self.breaker_failures, self.breaker_reset_seconds, self._clock
+                )
+            return breaker
+
+    def _call(self, operation, kwargs):
+        model_id = kwargs.get("modelId")
+        fallback_id = self.fallback_models.get(model_id)
+        if not self.breaker(model_id).allow():
+            increment("bedrock_circuit_open")
+            if fallback_id is None or not self.breaker(fallback_id).allow():
+                raise CircuitOpenError(model_id, operation)
+            logging.warning("Circuit open for %s, calling %s", model_id, fallback_id)
+            return self._with_retries(
+                operation, self._for_model(kwargs, fallback_id), fallback_id
+            )
+
+        hedge_delay = None
+        if self.hedging and fallback_id and operation in HEDGED_OPERATIONS:
+            hedge_delay = self.hedge_delay(model_id, _max_tokens(operation, kwargs))
+        if hedge_delay is None:
+            return self._with_retries(operation, kwargs, model_id)
+        return self._hedged(operation, kwargs, model_id, fallback_id, hedge_delay)
+
+    def _for_model(self, kwargs, model_id):
+        """
+        The request kwargs for another model, without the sampling parameters
+        it rejects.
+        """
+        kwargs = {**kwargs, "modelId": model_id}
+        if model_id not in self.models_without_sampling_params:
+            return kwargs
+        if "body" in kwargs:
+            body = json.loads(kwargs["body"])
+            for param in SAMPLING_PARAMS:
+                body.pop(param, None)
+            kwargs["body"] = json.dumps(body)
+        if "inferenceConfig" in kwargs:
+            kwargs["inferenceConfig"] = {
+                key: value
+                for key, value in kwargs["inferenceConfig"].items()
+                if key not in SAMPLING_PARAMS
+            }
+        return kwargs
+
+    def _with_retries(self, operation, kwargs, model_id):
+        breaker = self.breaker(model_id)
+        for attempt in range(1, self.max_attempts + 1):
+            start = time.perf_counter()
+            try:
+                response = self._attempt(operation, kwargs, model_id)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    # the model answered, e.g. with a ValidationException
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                if attempt == self.max_attempts or not breaker.allow():
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                delay = random.uniform(0, delay)
+                if expired(delay):
+                    # no time left for another attempt
+                    raise
+                increment("bedrock_retries")
+                logging.info(
+                    "Retrying %s of %s after %s", operation, model_id, type(e).__name__
+                )
+                self._sleep(delay)
+                continue
+            breaker.record_success()
+            if operation in HEDGED_OPERATIONS:
+                self._record_latency(
+                    model_id,
+                    _max_tokens(operation, kwargs),
+                    time.perf_counter() - start,
+                )
+            return response
+
+    def _attempt(self, operation, kwargs, model_id):
+        check(f"{operation} of {model_id}")
+        method = getattr(self._client, operation)
+        semaphore = self._semaphore(model_id)
+        # bounded by the request deadline, if any (see deadline.py)
+        timeout = bounded(self.call_timeout)
+        if not timeout or operation not in HEDGED_OPERATIONS:
+            with semaphore:
+                return method(**kwargs)
+
+        deadline = time.perf_counter() + timeout
+        if not semaphore.acquire(timeout=timeout):
+            raise self._timeout_error(model_id, operation)
+
+        def call():
+            try:
+                return method(**kwargs)
+            finally:
+                # released when Bedrock answers, even after a timeout, so
+                # abandoned calls still count against the limit
+                semaphore.release()
+
+        future = self._attempt_executor.submit(contextvars.copy_context().run, call)
+        try:
+            return future.result(timeout=max(0.0, deadline - time.perf_counter()))
+        except FutureTimeoutError:
+            raise self._timeout_error(model_id, operation) from None
+
+    def _timeout_error(self, model_id, operation):
+        increment("bedrock_timeouts")
+        if expired():
+            return DeadlineExceeded(f"{operation} of {model_id} ran out of time")
+        return CallTimeoutError(model_id, operation, self.call_timeout)
+
+    def _record_latency(self, model_id, max_tokens, seconds):
+        with self._lock:
+            latencies = self._latencies.setdefault(
+                (model_id, max_tokens), deque(maxlen=LATENCY_WINDOW)
+            )
+            latencies.append(seconds)
+
+    def hedge_delay(self, model_id, max_tokens=None):
+        """
+        Seconds after which a call is hedged, or None until enough calls of
+        the model and max_tokens were observed.
+        """
+        with self._lock:
+            latencies = list(self._latencies.get((model_id, max_tokens), ()))
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return float(np.percentile(latencies, self.hedge_percentile))
+
+    def _hedged(self, operation, kwargs, model_id, fallback_id, delay):
+        primary = self._hedge_executor.submit(
+            contextvars.copy_context().run,
+            self._with_retries,
+            operation,
+            kwargs,
+            model_id,
+        )
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        increment("bedrock_hedges")
+        logging.info(
+            "%s of %s slower than %.2fs, hedging to %s",
+            operation,
+            model_id,
+            delay,
+            fallback_id,
+        )
+        hedge = self._hedge_executor.submit(
+            contextvars.copy_context().run,
+            self._with_retries,
+            operation,
+            self._for_model(kwargs, fallback_id),
+            fallback_id,
+        )
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if future is hedge:
+                    increment("bedrock_hedge_wins")
+                return response
+        raise error
+
+    def stats(self):
+        """
+        Circuit state of every model id called so far.
+        """
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {model_id: breaker.state for model_id, breaker in breakers.items()}
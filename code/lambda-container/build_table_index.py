@@ -0,0 +1,71 @@
+"""
+This script is to prebuild the table-schema vector index used by the pricing query engine.
+
+The index only depends on the static table descriptions, the embedding model
+and the columns of the pricing tables, which are read from the pricing CSVs in
+assets/sagemaker_source (the files the Glue crawler reads), so no Athena
+database or deployed stack is needed. Embedding the descriptions needs AWS
+credentials with Amazon Bedrock access in AWS_REGION.
+
+Run it from code/lambda-container before cdk deploy:
+
+    python build_table_index.py [PRICING_DATA_DIR]
+
+The index is written to table_index/ and copied into the image, so new
+containers load it from disk instead of calling the embedding model. cdk synth
+fails when it is missing.
+"""
+
+import logging
+import os
+import sys
+
+DEFAULT_PRICING_DATA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    "assets",
+    "sagemaker_source",
+)
+
+# Connections reads the Lambda configuration at import; none of it but the
+# region is used to build the index
+PLACEHOLDER_ENVIRONMENT = {
+    "DATA_SOURCE_BUCKET_NAME": "unused",
+    "PRICING_DATA_SOURCE_BUCKET_NAME": "unused",
+    "KENDRA_INDEX_ID": "unused",
+    "SAGEMAKER_PRICING_DATABASE": "unused",
+    "LOG_LEVEL": "INFO",
+}
+
+
+def main(data_dir=DEFAULT_PRICING_DATA_DIR):
+    for key, value in PLACEHOLDER_ENVIRONMENT.items():
+        os.environ.setdefault(key, value)
+    if "AWS_DEFAULT_REGION" in os.environ:
+        os.environ.setdefault("AWS_REGION", os.environ["AWS_DEFAULT_REGION"])
+
+    from llama_index.core import Settings, SQLDatabase
+    from llama_index.core.objects import SQLTableNodeMapping
+
+    from pricing_data import create_sqlite_engine, load_pricing_tables
+    from sagemaker_pricing import (
+        TABLE_INDEX_DIR,
+        build_table_index,
+        create_embed_model,
+        persist_table_index,
+        table_schema,
+    )
+
+    logging.basicConfig(level=os.environ["LOG_LEVEL"])
+    Settings.embed_model = create_embed_model()
+    sql_database = SQLDatabase(
+        create_sqlite_engine(load_pricing_tables(data_dir=data_dir))
+    )
+    obj_index = build_table_index(sql_database, SQLTableNodeMapping(sql_database))
+    persist_table_index(obj_index, table_schema(sql_database), TABLE_INDEX_DIR)
+    logging.info("Table index written to %s", TABLE_INDEX_DIR)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,121 @@
+"""
+This script is to provide the in-process caches shared by the request pipeline.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import record_cache_lookup
+
+
+class LRUTTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after a time to live.
+
+    The cache carries an optional version stamp (for example a hash of the
+    prompt or a data version). Calling ensure_version with a different value
+    drops every entry, so results computed from stale inputs are never served.
+
+    Hits and misses are counted in the request metrics (see metrics.py) under
+    the cache name, unless track_metrics is False.
+    """
+
+    def __init__(
+        self,
+        maxsize=1024,
+        ttl=None,
+        name="cache",
+        clock=time.monotonic,
+        track_metrics=True,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.track_metrics = track_metrics
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for key, or default on a miss.
+        """
+        hit, value = self._get(key)
+        if self.track_metrics:
+            record_cache_lookup(self.name, hit)
+        return value if hit else default
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        """
+        Store value under key, evicting the least recently used entries.
+        """
+        expires_at = self._clock() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def items(self):
+        """
+        Return a snapshot of the unexpired (key, value) pairs, oldest first.
+        """
+        now = self._clock()
+        with self._lock:
+            return [
+                (key, value)
+                for key, (value, expires_at) in self._data.items()
+                if expires_at is None or expires_at > now
+            ]
+
+    def invalidate(self, key=None):
+        """
+        Drop one entry, or every entry when key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def ensure_version(self, version):
+        """
+        Drop every entry if the version stamp changed since the last call.
+        """
+        with self._lock:
+            if version != self.version:
+                self._data.clear()
+                self.version = version
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
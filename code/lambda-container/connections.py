@@ -2,6 +2,16 @@ import os
 import boto3
 from langchain_aws import ChatBedrock
 
+from bedrock_gateway import (
+    BEDROCK_FALLBACK_MODELS,
+    BedrockGateway,
+    create_client_config,
+    parse_fallback_models,
+)
+from llm_usage import UsageCallback
+from output_budget import adaptive_max_tokens
+from prompt_cache import PromptCacheUsageLogger
+
 
 class Connections:
     region_name = os.environ["AWS_REGION"]
@@ -10,9 +20,18 @@ class Connections:
     kendra_rawdata_index_id = os.environ["KENDRA_INDEX_ID"]
     sagemaker_pricing_database = os.environ["SAGEMAKER_PRICING_DATABASE"]
     log_level = os.environ["LOG_LEVEL"]
+    # "athena" queries the Glue tables through Amazon Athena; "sqlite" loads the
+    # pricing CSVs (from PRICING_DATA_DIR, or the pricing bucket when unset)
+    # into an in-process SQLite database.
+    pricing_sql_backend = os.environ.get("PRICING_SQL_BACKEND", "athena").lower()
+    pricing_data_dir = os.environ.get("PRICING_DATA_DIR")
+    # DynamoDB Local or another compatible endpoint for the session store
+    dynamodb_endpoint_url = os.environ.get("DYNAMODB_ENDPOINT_URL")
     kendra_client = boto3.client("kendra", region_name=region_name)
     s3_resource = boto3.resource("s3", region_name=region_name)
-    bedrock_client = boto3.client("bedrock-runtime", region_name=region_name)
+    dynamodb_client = boto3.client(
+        "dynamodb", region_name=region_name, endpoint_url=dynamodb_endpoint_url
+    )
 
     MODELID_MAPPING = {
         "ClaudeHaiku": "global.anthropic.claude-haiku-4-5-20251001-v1:0",
@@ -32,23 +51,61 @@ class Connections:
         }
     )
 
+    # Every Bedrock runtime call goes through the gateway (see
+    # bedrock_gateway.py): concurrency limits, retries, timeouts, circuit
+    # breakers and hedging per model id
+    bedrock_client = BedrockGateway(
+        boto3.client(
+            "bedrock-runtime", region_name=region_name, config=create_client_config()
+        ),
+        fallback_models=parse_fallback_models(
+            BEDROCK_FALLBACK_MODELS, MODELID_MAPPING
+        ),
+        models_without_sampling_params=MODELS_WITHOUT_SAMPLING_PARAMS,
+    )
+
     @staticmethod
     def supports_sampling_params(model_id):
         """Whether the given Bedrock model accepts temperature/top_p/top_k."""
         return model_id not in Connections.MODELS_WITHOUT_SAMPLING_PARAMS
 
     @staticmethod
-    def get_bedrock_llm(model_name="ClaudeSonnet", max_tokens=256, cache=False):
+    def get_bedrock_llm(
+        model_name="ClaudeSonnet",
+        max_tokens=256,
+        cache=False,
+        cache_stage=None,
+        stage=None,
+        adaptive=True,
+    ):
+        """
+        Create a Bedrock chat model.
+
+        cache enables the LangChain response cache. cache_stage names the
+        pipeline stage whose prompt-cache checkpoints (see prompt_cache.py)
+        this model serves; the cache read/write tokens are then logged.
+        stage names the pipeline stage its token usage is counted under (see
+        llm_usage.py), cache_stage or the model name by default. With adaptive,
+        max_tokens is the ceiling of a budget sized from the output lengths
+        observed for the stage (see output_budget.py).
+        """
         model_id = Connections.MODELID_MAPPING.get(
             model_name, Connections.MODELID_MAPPING["ClaudeSonnet"]
         )
+        usage_stage = stage or cache_stage or model_name
+        if adaptive:
+            max_tokens = adaptive_max_tokens(usage_stage, max_tokens)
         model_kwargs = {"max_tokens": max_tokens}
         if Connections.supports_sampling_params(model_id):
             model_kwargs["temperature"] = 0
+        callbacks = [UsageCallback(usage_stage, model_id)]
+        if cache_stage:
+            callbacks.append(PromptCacheUsageLogger(cache_stage))
         llm = ChatBedrock(
             client=Connections.bedrock_client,
             model_id=model_id,
             model_kwargs=model_kwargs,
             cache=cache,
+            callbacks=callbacks,
         )
         return llm
@@ -0,0 +1,173 @@
+"""
+This script is to derive version stamps of the data behind the answers.
+
+A version is a hash of the keys and ETags of the S3 objects a data source is
+built from: the pricing CSVs behind the Glue tables, and the documents behind
+the Kendra index. Caches stamped with a version drop their entries once the
+underlying objects change. Versions are refreshed in the background at most
+every DATA_VERSION_TTL_SECONDS, or immediately with refresh(). A version that
+is not known yet is None, and caches are bypassed until it is.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from connections import Connections
+
+DATA_VERSION_TTL_SECONDS = float(os.environ.get("DATA_VERSION_TTL_SECONDS", "300"))
+DATA_VERSION_RETRY_SECONDS = float(os.environ.get("DATA_VERSION_RETRY_SECONDS", "30"))
+
+# Versions are recomputed off the request path
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="data-version")
+
+
+def s3_prefix_version(bucket, prefix=""):
+    """
+    Hash the keys and ETags of the objects under an S3 prefix.
+    """
+    digest = hashlib.sha256()
+    s3_bucket = Connections.s3_resource.Bucket(bucket)
+    for obj in sorted(s3_bucket.objects.filter(Prefix=prefix), key=lambda obj: obj.key):
+        digest.update(f"{obj.key}\0{obj.e_tag}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def local_dir_version(path):
+    """
+    Hash the relative paths, sizes and modification times of a local folder.
+    """
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(path)):
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            stat = os.stat(file_path)
+            relative = os.path.relpath(file_path, path)
+            digest.update(f"{relative}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class DataVersion:
+    """
+    Version stamp of one data source, recomputed in the background once its
+    TTL expires.
+
+    get() never waits for S3: an expired version is served while a background
+    refresh recomputes it. Until a version was computed, get() returns None and
+    the caches stamped with it must be bypassed. If the version cannot be
+    computed, the previous one is kept so a transient S3 error does not flush
+    every cache, and the computation is retried after
+    DATA_VERSION_RETRY_SECONDS.
+    """
+
+    def __init__(
+        self,
+        name,
+        compute,
+        ttl=DATA_VERSION_TTL_SECONDS,
+        retry=DATA_VERSION_RETRY_SECONDS,
+        clock=time.monotonic,
+        executor=None,
+    ):
+        self.name = name
+        self._compute = compute
+        self.ttl = ttl
+        self.retry = retry
+        self._clock = clock
+        self._executor = executor or _refresh_executor
+        self._version = None
+        self._expires_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the current version, or None while it is unknown, and start a
+        background refresh when it is older than the TTL.
+        """
+        with self._lock:
+            version = self._version
+            start = not self._refreshing and self._clock() >= self._expires_at
+            if start:
+                self._refreshing = True
+        if start:
+            try:
+                self._executor.submit(self._background_refresh)
+            except RuntimeError:
+                # The executor is shut down, e.g. at interpreter exit
+                with self._lock:
+                    self._refreshing = False
+        return version
+
+    def refresh(self):
+        """
+        Recompute the version now, e.g. after the data was updated.
+        """
+        start = time.perf_counter()
+        try:
+            version = self._compute()
+        except Exception:
+            logging.exception("Could not compute the %s data version", self.name)
+            with self._lock:
+                self._expires_at = self._clock() + min(self.retry, self.ttl)
+                return self._version
+        with self._lock:
+            if version != self._version:
+                logging.info(
+                    "%s data version is %s (%.0f ms)",
+                    self.name,
+                    version[:12],
+                    (time.perf_counter() - start) * 1000,
+                )
+            self._version = version
+            self._expires_at = self._clock() + self.ttl
+            return version
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+class VersionedValue:
+    """
+    Value built from a data source, rebuilt once the version of the source
+    changes, e.g. the pricing tables loaded from the pricing CSVs.
+
+    While the version is unknown, the value built last is kept, and built once
+    if there is none.
+    """
+
+    def __init__(self, data_version, build):
+        self._data_version = data_version
+        self._build = build
+        self._value = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        version = self._data_version.get()
+        with self._lock:
+            if self._value is None or (
+                version is not None and version != self._version
+            ):
+                self._value = self._build()
+                self._version = version
+            return self._value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._version = None
+
+
+def _kendra_version():
+    return s3_prefix_version(Connections.s3_rawdata_bucket_name)
+
+
+kendra_data_version = DataVersion("kendra", _kendra_version)
@@ -0,0 +1,173 @@
+"""
+This script is to give every stage of a request the time it has left.
+
+lambda_handler opens request_deadline() with the smaller of two budgets: the
+time left before the Lambda function times out, minus DEADLINE_MARGIN_SECONDS
+to return the response, and the client's "time_budget_seconds"
+(REQUEST_TIME_BUDGET_SECONDS by default, just under the 300 s the Streamlit
+client waits). The deadline is a context variable, so threads started with a
+copied context, e.g. speculative branches and agent tools, share it.
+
+The stages read it to stay within budget:
+- the Bedrock gateway bounds each attempt by the time left and does not retry
+  past the deadline (see bedrock_gateway.py)
+- Kendra retrieval is not started past the deadline
+- SQL statements still running at the deadline are cancelled: Athena queries
+  are stopped, and SQLite statements interrupted
+- the RAG answer, the pricing answer and the agent fall back to a cheaper or
+  partial answer when too little time is left: the Kendra excerpts without
+  synthesis, the SQL rows without synthesis, and the tool results gathered so
+  far
+Outside a request deadline, remaining() is None and nothing is bounded.
+"""
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+REQUEST_TIME_BUDGET_SECONDS = float(
+    os.environ.get("REQUEST_TIME_BUDGET_SECONDS", "280")
+)
+DEADLINE_MARGIN_SECONDS = float(os.environ.get("DEADLINE_MARGIN_SECONDS", "5"))
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised by a stage that has no time left to run.
+    """
+
+
+@contextmanager
+def request_deadline(budget_seconds=None, lambda_context=None):
+    """
+    Set the deadline of the enclosed request; an enclosing deadline that is
+    earlier is kept.
+
+    Inputs:
+        budget_seconds (float): time allowed to the request
+        lambda_context: Lambda context, whose remaining time (minus
+            DEADLINE_MARGIN_SECONDS) also bounds the request
+    Output:
+        the deadline, in time.monotonic() seconds
+    """
+    now = time.monotonic()
+    candidates = [_deadline.get()]
+    if budget_seconds is not None:
+        candidates.append(now + float(budget_seconds))
+    if lambda_context is not None and hasattr(
+        lambda_context, "get_remaining_time_in_millis"
+    ):
+        lambda_seconds = lambda_context.get_remaining_time_in_millis() / 1000
+        candidates.append(now + lambda_seconds - DEADLINE_MARGIN_SECONDS)
+    deadlines = [deadline for deadline in candidates if deadline is not None]
+    deadline = min(deadlines) if deadlines else None
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """
+    Seconds left before the request deadline, or None without a deadline.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def expired(reserve=0.0):
+    """
+    Whether less than reserve seconds are left before the deadline.
+    """
+    left = remaining()
+    return left is not None and left <= reserve
+
+
+def check(stage, reserve=0.0):
+    """
+    Raise DeadlineExceeded when less than reserve seconds are left for a stage.
+    """
+    if expired(reserve):
+        raise DeadlineExceeded(f"No time left for {stage}")
+
+
+def bounded(timeout):
+    """
+    The smaller of a timeout and the time left; timeout when there is no
+    deadline.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    return min(timeout, left) if timeout else left
+
+
+def _cancel_statement(cursor, dbapi_connection, cancelled):
+    cancelled.set()
+    try:
+        if hasattr(cursor, "cancel"):
+            # PyAthena: StopQueryExecution
+            cursor.cancel()
+        elif hasattr(dbapi_connection, "interrupt"):
+            # sqlite3
+            dbapi_connection.interrupt()
+    except Exception:
+        logging.exception("Could not cancel the SQL statement")
+
+
+def cancel_sql_on_deadline(engine):
+    """
+    Cancel the statements of a SQLAlchemy engine still running at the request
+    deadline; they then fail with DeadlineExceeded.
+    """
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        left = remaining()
+        if left is None:
+            return
+        if left <= 0:
+            raise DeadlineExceeded("No time left for the SQL query")
+        cancelled = threading.Event()
+        timer = threading.Timer(
+            left,
+            _cancel_statement,
+            (cursor, conn.connection.dbapi_connection, cancelled),
+        )
+        timer.daemon = True
+        # Kept on the execution context: statements of other threads must not
+        # stop this one's timer
+        context._deadline_timer = (timer, cancelled)
+        timer.start()
+
+    def _stop_timer(context):
+        entry = getattr(context, "_deadline_timer", None)
+        if entry is None:
+            return False
+        del context._deadline_timer
+        timer, cancelled = entry
+        timer.cancel()
+        return cancelled.is_set()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        _stop_timer(context)
+
+    def error(exception_context):
+        if _stop_timer(exception_context.execution_context):
+            logging.warning("Cancelled a SQL statement at the request deadline")
+            return DeadlineExceeded("SQL query cancelled at the request deadline")
+        return None
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+    event.listen(engine, "handle_error", error)
+    return engine
@@ -1,18 +1,85 @@
 import json
 import logging
-from index import get_response
+import time
+
+_init_start = time.perf_counter()
+
+from batch_questions import run_batch_event
+from index import get_response, get_response_stream
 from connections import Connections
+from deadline import REQUEST_TIME_BUDGET_SECONDS, request_deadline
+from metrics import record_init, request_metrics
 
 logging.getLogger().setLevel(Connections.log_level)
 logging.getLogger("boto3").setLevel(logging.WARNING)
 logging.getLogger("botocore").setLevel(logging.WARNING)
 
+# Imports dominate the container init; reported with the first request
+record_init(time.perf_counter() - _init_start)
+
+
+def _request_properties(context):
+    request_id = getattr(context, "aws_request_id", None)
+    return {"request_id": request_id} if request_id else {}
+
+
+def _time_budget(payload):
+    budget = payload.get("time_budget_seconds")
+    return REQUEST_TIME_BUDGET_SECONDS if budget is None else float(budget)
+
+
+def stream_response(
+    query,
+    session_id,
+    properties=None,
+    include_usage=None,
+    time_budget=None,
+    context=None,
+):
+    """
+    Encode the streamed response as newline-delimited JSON frames
+
+    Input:
+        query (str): user's question
+        session_id (str): chat session id
+        properties (dict): extra properties of the request metrics
+        include_usage (bool): end with a frame of the request's LLM usage
+        time_budget (float): seconds allowed to the request
+        context: Lambda context, whose remaining time also bounds the request
+    Output:
+        generator of bytes, one JSON frame per line
+    """
+    with request_metrics("lambda_handler", properties=properties):
+        with request_deadline(time_budget, context):
+            try:
+                for frame in get_response_stream(query, session_id, include_usage):
+                    yield (json.dumps(frame) + "\n").encode("utf-8")
+            except Exception as e:
+                logging.exception("Error streaming response")
+                frame = {
+                    "type": "error",
+                    "message": f"Error processing your request: {e}",
+                }
+                yield (json.dumps(frame) + "\n").encode("utf-8")
+
 
 def lambda_handler(event, context):
     """
     Lambda handler to answer user's question
+
+    When the payload sets "stream" to true, a generator of NDJSON frames is
+    returned, which the streaming runtime (streaming_runtime.py) sends to the
+    caller as it is produced. "include_usage" adds the LLM calls, tokens and
+    cost of the request to the response. "time_budget_seconds" is the time the
+    client waits, REQUEST_TIME_BUDGET_SECONDS by default; the request deadline
+    is the earlier of it and the Lambda timeout (see deadline.py).
+
+    An event with a "batch" key answers a JSONL file of questions instead (see
+    batch_questions.py) and returns the summary of the run.
     """
     logging.info("events: %s", event)
+    if "batch" in event:
+        return run_batch_event(event["batch"], context)
     try:
         payload = json.loads(event["body"])
         logging.debug("Lambda Payload: %s", payload)
@@ -20,7 +87,16 @@ def lambda_handler(event, context):
         query = payload["query"]
         session_id = payload["session_id"]
 
-        output = get_response(query, session_id)
+        include_usage = payload.get("include_usage")
+        properties = _request_properties(context)
+        time_budget = _time_budget(payload)
+        if payload.get("stream"):
+            return stream_response(
+                query, session_id, properties, include_usage, time_budget, context
+            )
+        with request_metrics("lambda_handler", properties=properties):
+            with request_deadline(time_budget, context):
+                output = get_response(query, session_id, include_usage)
     except Exception as e:
         logging.exception("Error processing request")
         output = {"source": " ", "answer": f"Error processing your request: {e}"}
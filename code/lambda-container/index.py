@@ -1,44 +1,364 @@
+import contextvars
 import logging
-from sagemaker_pricing import query_engine
-from app_question_intent import get_question_intent_general
-from sagemaker_dg_rag import doc_retrieval
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.messages import AIMessage, HumanMessage
+from answer_cache import (
+    get_answer_cache,
+    lookup_answer,
+    start_embedding,
+    store_answer,
+)
+from session_memory import get_by_session_id
+from sagemaker_pricing import query_pricing
+from intent_classifier import (
+    INTENT_LABELS,
+    get_cached_or_local_intent,
+    get_llm_question_intent,
+)
+from sagemaker_dg_rag import doc_retrieval, doc_retrieval_stream, retrieve_documents
 from sagemaker_agent import agent_call
 from connections import Connections
+from deadline import DeadlineExceeded
+from llm_usage import track_usage
+from metrics import set_dimension, span
+from model_cascade import cascade_stats
 
+# Work started before the intent is known, while the LLM classifier runs:
+#   "off"       - nothing; every stage runs after classification
+#   "retrieval" - the Kendra retrieval used by Use Case 1 answers
+#   "full"      - Kendra retrieval and the complete pricing answer (Use Case 2)
+# Speculation only happens when the intent is not already known from the cache
+# or the local classifier. Discarded branches still incur their cost, so use
+# "retrieval" or "off" to limit Kendra and Bedrock usage.
+SPECULATION_MODE = os.environ.get("SPECULATION_MODE", "retrieval").lower()
 
-def get_response(user_input, session_id):
+# Add the LLM calls, tokens and cost of the request to the response as "usage"
+# (a final {"type": "usage"} frame when streaming); the lambda payload can also
+# ask for it with "include_usage"
+RESPONSE_INCLUDE_USAGE = (
+    os.environ.get("RESPONSE_INCLUDE_USAGE", "false").lower() == "true"
+)
+
+_speculation_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="speculation"
+)
+
+
+def _timed_branch(timings, name, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def _start_speculation(user_input, timings):
     """
-    Get response RAG or Query
+    Start the intent-independent branches in the background
     """
-    logging.info("Getting response from RAG or Query or Agent Call")
-    llm_qintent = Connections.get_bedrock_llm(
-        model_name="ClaudeHaiku", max_tokens=32, cache=False
-    )
+    branches = {}
+    if SPECULATION_MODE in ("retrieval", "full"):
+        branches["retrieval"] = _speculation_executor.submit(
+            contextvars.copy_context().run,
+            _timed_branch,
+            timings,
+            "retrieval",
+            retrieve_documents,
+            user_input,
+        )
+    if SPECULATION_MODE == "full":
+        branches["pricing"] = _speculation_executor.submit(
+            contextvars.copy_context().run,
+            _timed_branch,
+            timings,
+            "pricing",
+            query_pricing,
+            user_input,
+        )
+    return branches
 
-    # Claude Sonnet 5 can spend part of its output budget on thinking tokens
-    # before the final answer, so the agent needs enough headroom to finish its
-    # JSON response instead of being cut off mid-answer.
-    llm_agent = Connections.get_bedrock_llm(
-        model_name="ClaudeSonnet", max_tokens=4096, cache=False
-    )
-    qintent = get_question_intent_general(llm=llm_qintent, query=user_input)
+
+def _take_branch(branches, name):
+    """
+    Return the result of a speculative branch, or None if it was not started
+    or failed (the caller then runs the stage itself).
+    """
+    future = branches.pop(name, None)
+    if future is None:
+        return None
+    try:
+        return future.result()
+    except Exception:
+        logging.exception("Speculative %s branch failed, running it again", name)
+        return None
+
+
+def _discard_branches(branches):
+    for name, future in branches.items():
+        if future.cancel():
+            logging.debug("Cancelled speculative %s branch", name)
+        else:
+            logging.debug("Discarding result of speculative %s branch", name)
+
+
+def _classify(user_input, timings):
+    """
+    Get the question intent, speculating while the LLM classifier runs
+    """
+    branches = {}
+    qintent = get_cached_or_local_intent(user_input)
+    if qintent is None:
+        branches = _start_speculation(user_input, timings)
+        llm_qintent = Connections.get_bedrock_llm(
+            model_name="ClaudeHaiku", max_tokens=32, cache=False, cache_stage="intent"
+        )
+        qintent = _timed_branch(
+            timings, "intent", get_llm_question_intent, llm_qintent, user_input
+        )
     logging.debug("Question %s", user_input)
     logging.debug("Intent: %s", qintent)
+    # Unexpected LLM replies would each become a metric dimension value
+    set_dimension("Intent", qintent if qintent in INTENT_LABELS else "Other")
+    return qintent, branches
+
+
+TIMEOUT_ANSWER = (
+    "Sorry, there was not enough time to answer this question. Please try "
+    "again, or ask a narrower question."
+)
+
+
+def _timeout_output(qintent):
+    logging.warning("Request deadline exceeded answering intent %s", qintent)
+    return {"source": " ", "answer": TIMEOUT_ANSWER, "degraded": True}
+
+
+def _answer(qintent, user_input, branches, session_id):
+    """
+    Answer for the intent; a stage out of time before it has anything to show
+    gives a degraded answer instead of an error (see deadline.py).
+    """
+    try:
+        return _answer_intent(qintent, user_input, branches, session_id)
+    except DeadlineExceeded:
+        return _timeout_output(qintent)
+
+
+def _deadline_frames(frames, qintent):
+    """
+    Pass the frames through; a stage out of time before the answer is streamed,
+    e.g. the Kendra retrieval, gives the degraded answer of _answer().
+    """
+    try:
+        yield from frames
+    except DeadlineExceeded:
+        output = _timeout_output(qintent)
+        yield {"type": "delta", "text": output["answer"]}
+        yield {"type": "source", "source": output["source"], "degraded": True}
+
+
+def _answer_intent(qintent, user_input, branches, session_id):
     if qintent == "UseCase2":
-        response = query_engine.query(user_input)
-        logging.debug(response.response)
-        logging.debug(response.metadata["sql_query"])
-        output = {"source": response.metadata["sql_query"], "answer": response.response}
-    elif qintent == "UseCase1":
-        output = doc_retrieval(user_input)
-    elif qintent == "UseCase3":
-        output = agent_call(llm=llm_agent, query=user_input)
-    else:
-        output = {
-            "source": " ",
-            "answer": "This is a malicious query. Please ask a relevant question.",
-        }
+        return _take_branch(branches, "pricing") or query_pricing(user_input)
+    if qintent == "UseCase1":
+        docs = _take_branch(branches, "retrieval")
+        return doc_retrieval(user_input, docs=docs, session_id=session_id)
+    if qintent == "UseCase3":
+        # Claude Sonnet 5 can spend part of its output budget on thinking
+        # tokens before the final answer, so the agent needs enough headroom
+        # to finish its JSON response instead of being cut off mid-answer.
+        llm_agent = Connections.get_bedrock_llm(
+            model_name="ClaudeSonnet",
+            max_tokens=4096,
+            cache=False,
+            cache_stage="agent",
+        )
+        return agent_call(llm=llm_agent, query=user_input)
+    return {
+        "source": " ",
+        "answer": "This is a malicious query. Please ask a relevant question.",
+    }
 
-    logging.info(output)
 
+def _log_timings(timings, qintent):
+    if timings:
+        logging.info(
+            "Speculation (%s) branch timings for intent %s: %s",
+            SPECULATION_MODE,
+            qintent,
+            timings,
+        )
+
+
+def _cached_answer(qintent, user_input, session_id, cache, embedding):
+    """
+    Look up a cached answer for the question.
+
+    Input:
+        embedding (Future): the embedding of the question, see start_embedding
+    Output:
+        (answer, lookup): answer is None on a miss; lookup is passed to
+        store_answer, and is None when the question bypasses the cache
+    """
+    lookup = lookup_answer(cache, user_input, qintent, session_id, embedding)
+    if lookup is None or lookup.answer is None:
+        return None, lookup
+    if qintent == "UseCase1" and session_id:
+        # Keep the conversation complete for later documentation questions
+        get_by_session_id(session_id).add_messages(
+            [HumanMessage(user_input), AIMessage(lookup.answer["answer"])]
+        )
+    return lookup.answer, lookup
+
+
+def _log_usage(usage, qintent):
+    summary = usage.summary()
+    logging.info(
+        "LLM usage for intent %s: %s calls, %s input tokens, %s output tokens, "
+        "$%.6f (%s)",
+        qintent,
+        summary["total"]["calls"],
+        summary["total"]["input_tokens"],
+        summary["total"]["output_tokens"],
+        summary["total"]["cost_usd"],
+        summary["stages"],
+    )
+    stats = cascade_stats()
+    if stats:
+        logging.info("Model cascades: %s", stats)
+    return summary
+
+
+@span("get_response")
+def get_response(user_input, session_id, include_usage=None):
+    """
+    Get response RAG or Query
+
+    The LLM usage of the request is logged, and added to the output as
+    "usage" when include_usage (RESPONSE_INCLUDE_USAGE by default) is set.
+    """
+    if include_usage is None:
+        include_usage = RESPONSE_INCLUDE_USAGE
+    with track_usage() as usage:
+        output, qintent = _get_response(user_input, session_id)
+    summary = _log_usage(usage, qintent)
+    if include_usage:
+        output = {**output, "usage": summary}
     return output
+
+
+def _get_response(user_input, session_id):
+    logging.info("Getting response from RAG or Query or Agent Call")
+    timings = {}
+    cache = get_answer_cache()
+    # The embedding call of a cache miss overlaps the intent classification
+    embedding = start_embedding(cache, user_input)
+    qintent, branches = _classify(user_input, timings)
+    try:
+        output, lookup = _cached_answer(
+            qintent, user_input, session_id, cache, embedding
+        )
+        if output is None:
+            start = time.perf_counter()
+            output = _answer(qintent, user_input, branches, session_id)
+            store_answer(
+                cache, lookup, user_input, qintent, output, time.perf_counter() - start
+            )
+    finally:
+        _discard_branches(branches)
+
+    _log_timings(timings, qintent)
+    logging.info(output)
+
+    return output, qintent
+
+
+def _stored_frames(frames, cache, lookup, user_input, qintent, start):
+    """
+    Pass the frames through, then cache the answer they spell out
+    """
+    text = []
+    source = ""
+    degraded = False
+    for frame in frames:
+        if frame["type"] == "delta":
+            text.append(frame["text"])
+        elif frame["type"] == "source":
+            source = frame["source"]
+            degraded = frame.get("degraded", False)
+        yield frame
+    output = {"source": source, "answer": "".join(text)}
+    if degraded:
+        output["degraded"] = True
+    store_answer(
+        cache, lookup, user_input, qintent, output, time.perf_counter() - start
+    )
+
+
+def get_response_stream(user_input, session_id, include_usage=None):
+    """
+    Get response RAG or Query, streamed as frames
+
+    Documentation answers are streamed as the LLM generates them; pricing,
+    agent, refusal and cached answers are sent as a single chunk once complete.
+
+    Output:
+        generator of frames: {"type": "delta", "text"} chunks of the answer,
+        then one {"type": "source", "source"} frame, and a {"type": "usage",
+        "usage"} frame when include_usage (RESPONSE_INCLUDE_USAGE by default)
+        is set
+    """
+    if include_usage is None:
+        include_usage = RESPONSE_INCLUDE_USAGE
+    logging.info("Streaming response from RAG or Query or Agent Call")
+    with track_usage() as usage:
+        timings = {}
+        cache = get_answer_cache()
+        embedding = start_embedding(cache, user_input)
+        qintent, branches = _classify(user_input, timings)
+        yield from _answer_frames(
+            user_input, session_id, qintent, branches, timings, cache, embedding
+        )
+    summary = _log_usage(usage, qintent)
+    if include_usage:
+        yield {"type": "usage", "usage": summary}
+
+
+def _answer_frames(
+    user_input, session_id, qintent, branches, timings, cache, embedding
+):
+    try:
+        output, lookup = _cached_answer(
+            qintent, user_input, session_id, cache, embedding
+        )
+        start = time.perf_counter()
+        if output is None and qintent == "UseCase1":
+            docs = _take_branch(branches, "retrieval")
+            frames = _deadline_frames(
+                doc_retrieval_stream(user_input, docs=docs, session_id=session_id),
+                qintent,
+            )
+            frames = _stored_frames(frames, cache, lookup, user_input, qintent, start)
+        else:
+            if output is None:
+                output = _answer(qintent, user_input, branches, session_id)
+                store_answer(
+                    cache,
+                    lookup,
+                    user_input,
+                    qintent,
+                    output,
+                    time.perf_counter() - start,
+                )
+            logging.info(output)
+            frames = [
+                {"type": "delta", "text": output["answer"]},
+                {"type": "source", "source": output["source"]},
+            ]
+    finally:
+        _discard_branches(branches)
+
+    _log_timings(timings, qintent)
+    yield from frames
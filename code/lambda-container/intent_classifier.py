@@ -0,0 +1,376 @@
+"""
+This script is to classify question intent locally before falling back to the LLM classifier.
+
+A nearest-neighbour model over TF-IDF weighted word and character n-grams is
+trained from the few-shot examples of the LLM classifier plus a labeled query
+log (intent_queries.jsonl). It returns an intent label with a confidence
+score, and the LLM classifier is only invoked when the confidence is below
+INTENT_CONFIDENCE_THRESHOLD or the query looks like a prompt injection.
+
+Run it as a script to report coverage and accuracy per threshold:
+
+    python intent_classifier.py
+"""
+
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter, defaultdict
+
+from app_question_intent import (
+    INTENT_EXAMPLES,
+    INTENT_SYSTEM_PROMPT,
+    get_question_intent_general,
+)
+from caching import LRUTTLCache
+from utils import normalize_question
+
+INTENT_QUERY_LOG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "intent_queries.jsonl"
+)
+INTENT_LABELS = ("UseCase1", "UseCase2", "UseCase3", "MaliciousQuery")
+# Leave-one-out on the 273 labeled queries (few-shot examples and query log,
+# all four intents), counting the queries INJECTION_PATTERN leaves to the LLM
+# as not answered locally:
+#   threshold 0.6: 12% answered locally, 97% correctly
+#   threshold 0.5: 34% answered locally, 97% correctly
+#   threshold 0.4: 52% answered locally, 95% correctly
+#   threshold 0.35: 64% answered locally, 90% correctly
+#   threshold 0.3: 71% answered locally, 89% correctly
+# The default of 0.4 takes the LLM classifier off the critical path for about
+# half of the questions. Most local errors are on few-shot examples whose
+# labels disagree with similar examples. Extend the query log with reviewed
+# production questions and re-run this script to tune the threshold; repeated
+# questions already skip the LLM via intent_cache.
+INTENT_CONFIDENCE_THRESHOLD = float(
+    os.environ.get("INTENT_CONFIDENCE_THRESHOLD", "0.4")
+)
+# Queries that try to steer the classifier are always left to the LLM, which is
+# prompted to detect prompt injection.
+INJECTION_PATTERN = re.compile(
+    r"\b(ignore|forget|disregard|pretend|reveal|disclose|instructions?|prompts?|"
+    r"rules|guidance|use\s*case|developer mode|jailbreak)\b",
+    re.IGNORECASE,
+)
+
+# Intents of previously seen questions; the intent of a question never changes
+# unless the prompt, the examples or the query log change.
+intent_cache = LRUTTLCache(
+    maxsize=int(os.environ.get("INTENT_CACHE_SIZE", "2048")),
+    ttl=float(os.environ.get("INTENT_CACHE_TTL_SECONDS", "86400")),
+    name="intent",
+)
+
+
+def normalize_intent(label):
+    """
+    Normalize an intent label the way the LLM output is, e.g. "Use Case 1" -> "UseCase1".
+    """
+    return "".join(label.replace("\n", "").split(" "))
+
+
+def load_labeled_queries(path=INTENT_QUERY_LOG):
+    """
+    Load the few-shot examples and the labeled query log.
+
+    Input:
+        path (str): JSONL file with one {"query": ..., "intent": ...} per line
+    Output:
+        list of (query, intent) tuples
+    """
+    labeled = [
+        (example["query"], normalize_intent(example["answer"]))
+        for example in INTENT_EXAMPLES
+    ]
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    labeled.append(
+                        (record["query"], normalize_intent(record["intent"]))
+                    )
+    return labeled
+
+
+def _features(text):
+    text = re.sub(r"[^a-z0-9$.\s]", " ", text.lower().replace("?", " "))
+    words = text.split()
+    features = Counter(words)
+    features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    for word in words:
+        padded = f" {word} "
+        for n in (3, 4, 5):
+            features.update(
+                f"#{padded[i:i + n]}" for i in range(max(len(padded) - n + 1, 0))
+            )
+    return features
+
+
+class LocalIntentClassifier:
+    """
+    k-nearest-neighbour intent classifier over TF-IDF n-gram vectors.
+    """
+
+    def __init__(self, k=5):
+        self.k = k
+        self._idf = {}
+        self._vectors = []
+        self._labels = []
+
+    def fit(self, labeled):
+        """
+        Train on (query, intent) pairs.
+        """
+        documents = [_features(query) for query, _ in labeled]
+        document_frequency = Counter()
+        for features in documents:
+            document_frequency.update(features.keys())
+        count = len(documents)
+        self._idf = {
+            feature: math.log((1 + count) / (1 + df)) + 1
+            for feature, df in document_frequency.items()
+        }
+        self._vectors = [self._vectorize(features) for features in documents]
+        self._labels = [intent for _, intent in labeled]
+        return self
+
+    def _vectorize(self, features):
+        vector = {
+            feature: (1 + math.log(tf)) * self._idf[feature]
+            for feature, tf in features.items()
+            if feature in self._idf
+        }
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        if norm:
+            vector = {feature: value / norm for feature, value in vector.items()}
+        return vector
+
+    def predict(self, query):
+        """
+        Classify a query.
+
+        Input:
+            query (str): user's question
+        Output:
+            (intent, confidence): normalized intent label and a score in [0, 1]
+        """
+        vector = self._vectorize(_features(query))
+        similarities = []
+        for other, label in zip(self._vectors, self._labels):
+            if len(other) < len(vector):
+                similarity = sum(
+                    value * vector.get(f, 0.0) for f, value in other.items()
+                )
+            else:
+                similarity = sum(
+                    value * other.get(f, 0.0) for f, value in vector.items()
+                )
+            similarities.append((similarity, label))
+        neighbours = sorted(similarities, reverse=True)[: self.k]
+        if not neighbours or neighbours[0][0] <= 0:
+            return None, 0.0
+
+        votes = defaultdict(float)
+        for similarity, label in neighbours:
+            votes[label] += similarity
+        intent = max(votes, key=votes.get)
+        best_similarity = max(s for s, label in neighbours if label == intent)
+        # Share of the neighbour vote, scaled by how close the nearest
+        # neighbour of that intent actually is.
+        confidence = votes[intent] / sum(votes.values()) * best_similarity
+        return intent, confidence
+
+
+_classifier = None
+
+
+def get_local_classifier():
+    """
+    Return the container-wide classifier, training it on first use.
+    """
+    global _classifier
+    if _classifier is None:
+        _classifier = LocalIntentClassifier().fit(load_labeled_queries())
+    return _classifier
+
+
+@functools.lru_cache(maxsize=None)
+def _file_digest(path):
+    if not path or not os.path.exists(path):
+        return ""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def intent_prompt_hash(path=INTENT_QUERY_LOG):
+    """
+    Hash of everything that determines a question's intent: the LLM prompt,
+    its few-shot examples and the labeled query log.
+    """
+    digest = hashlib.sha256()
+    digest.update(INTENT_SYSTEM_PROMPT.encode("utf-8"))
+    digest.update(json.dumps(INTENT_EXAMPLES, sort_keys=True).encode("utf-8"))
+    digest.update(_file_digest(path).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_question_intent(llm, query, threshold=INTENT_CONFIDENCE_THRESHOLD):
+    """
+    Classify the query intent locally, falling back to the LLM classifier.
+
+    Inputs:
+        llm: LLM object for the fallback classifier
+        query (str): user's question
+        threshold (float): minimum local confidence to skip the LLM
+    Output:
+        query intent as a str, e.g. "UseCase1"
+    """
+    intent = get_cached_or_local_intent(query, threshold)
+    if intent is None:
+        intent = get_llm_question_intent(llm, query)
+    return intent
+
+
+def get_llm_question_intent(llm, query):
+    """
+    Classify the query intent with the LLM classifier and cache it, for a
+    question get_cached_or_local_intent() could not classify.
+
+    Inputs:
+        llm: LLM object for the classifier
+        query (str): user's question
+    Output:
+        query intent as a str, e.g. "UseCase1"
+    """
+    intent = get_question_intent_general(llm=llm, query=query)
+    if intent in INTENT_LABELS:
+        intent_cache.set(normalize_question(query), intent)
+    return intent
+
+
+def get_cached_or_local_intent(query, threshold=INTENT_CONFIDENCE_THRESHOLD):
+    """
+    Classify the query intent without calling the LLM, if possible.
+
+    Inputs:
+        query (str): user's question
+        threshold (float): minimum local confidence
+    Output:
+        the cached intent or a confident local prediction, or None when the
+        LLM classifier is needed
+    """
+    intent_cache.ensure_version(intent_prompt_hash())
+    cache_key = normalize_question(query)
+    intent = intent_cache.get(cache_key)
+    if intent is not None:
+        logging.info(
+            "Cached question intent for %s: %s (%s)",
+            query,
+            intent,
+            intent_cache.stats(),
+        )
+        return intent
+
+    start = time.perf_counter()
+    intent, confidence = get_local_classifier().predict(query)
+    local_ms = (time.perf_counter() - start) * 1000
+
+    if intent and confidence >= threshold and not INJECTION_PATTERN.search(query):
+        logging.info(
+            "Local question intent for %s: %s (confidence %.2f, %.1f ms)",
+            query,
+            intent,
+            confidence,
+            local_ms,
+        )
+        intent_cache.set(cache_key, intent)
+        return intent
+
+    logging.info(
+        "Local intent confidence %.2f below %.2f for %s, calling the LLM classifier",
+        confidence,
+        threshold,
+        query,
+    )
+    return None
+
+
+def evaluate_thresholds(labeled, thresholds, llm_latency_ms=None):
+    """
+    Leave-one-out evaluation of the local classifier at several thresholds.
+
+    Inputs:
+        labeled (list): (query, intent) pairs
+        thresholds (list): confidence thresholds to evaluate
+        llm_latency_ms (float): average LLM classifier latency, used to
+            estimate the latency saved per request
+    Output:
+        list of dicts, one per threshold, with coverage (share of queries
+        answered locally), local_accuracy (accuracy on those queries),
+        local_latency_ms and, when llm_latency_ms is given,
+        saved_latency_ms (average saved per request)
+    """
+    predictions = []
+    elapsed = 0.0
+    for i, (query, intent) in enumerate(labeled):
+        classifier = LocalIntentClassifier().fit(labeled[:i] + labeled[i + 1 :])
+        start = time.perf_counter()
+        predicted, confidence = classifier.predict(query)
+        elapsed += time.perf_counter() - start
+        if INJECTION_PATTERN.search(query):
+            # always left to the LLM, as in get_cached_or_local_intent()
+            predicted = None
+        predictions.append((predicted, confidence, intent))
+    local_latency_ms = elapsed / max(len(labeled), 1) * 1000
+
+    report = []
+    for threshold in thresholds:
+        covered = [(p, i) for p, c, i in predictions if p and c >= threshold]
+        row = {
+            "threshold": threshold,
+            "coverage": len(covered) / max(len(predictions), 1),
+            "local_accuracy": (
+                sum(p == i for p, i in covered) / len(covered) if covered else None
+            ),
+            "local_latency_ms": local_latency_ms,
+        }
+        if llm_latency_ms is not None:
+            row["saved_latency_ms"] = row["coverage"] * llm_latency_ms
+        report.append(row)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--log", default=INTENT_QUERY_LOG)
+    parser.add_argument(
+        "--thresholds",
+        type=float,
+        nargs="+",
+        default=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7],
+    )
+    parser.add_argument(
+        "--llm-latency-ms",
+        type=float,
+        default=None,
+        help="average latency of the LLM classifier, to estimate savings",
+    )
+    args = parser.parse_args()
+
+    report = evaluate_thresholds(
+        load_labeled_queries(args.log), args.thresholds, args.llm_latency_ms
+    )
+    for row in report:
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    main()
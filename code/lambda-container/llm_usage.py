@@ -0,0 +1,309 @@
+"""
+This script is to count the LLM calls, tokens and cost spent while serving a
+request.
+
+track_usage() opens a scope; every LLM response received in it, including
+those made from tool threads started in it, is added to the scope and to the
+scopes enclosing it. Usage is grouped by pipeline stage ("intent", "rag",
+"sql", "agent", ...). Each response counts its input and output tokens, the
+input tokens read from and written to the prompt cache, the thinking tokens
+(estimated from the thinking text, as Bedrock counts them as output tokens) and
+whether it stopped at max_tokens. Its cost is priced from MODEL_PRICES.
+
+Every response is also reported to output_budget.py, which sizes the max_tokens
+of each stage from the output lengths observed.
+"""
+
+import contextvars
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events.llm import (
+    LLMChatEndEvent,
+    LLMChatStartEvent,
+)
+from pydantic import PrivateAttr
+
+from output_budget import observe_output, response_stage
+
+# On-demand prices in USD per million tokens. The Sonnet and Opus entries use
+# the prices of the previous Claude generation; set LLM_PRICES to a JSON object
+# of the same shape to override or extend them.
+MODEL_PRICES = {
+    "global.anthropic.claude-haiku-4-5-20251001-v1:0": {
+        "input": 1.0,
+        "output": 5.0,
+        "cache_read": 0.1,
+        "cache_write": 1.25,
+    },
+    "global.anthropic.claude-sonnet-5": {
+        "input": 3.0,
+        "output": 15.0,
+        "cache_read": 0.3,
+        "cache_write": 3.75,
+    },
+    "global.anthropic.claude-opus-4-8": {
+        "input": 5.0,
+        "output": 25.0,
+        "cache_read": 0.5,
+        "cache_write": 6.25,
+    },
+}
+MODEL_PRICES.update(json.loads(os.environ.get("LLM_PRICES", "{}")))
+
+USAGE_FIELDS = (
+    "calls",
+    "input_tokens",
+    "output_tokens",
+    "cache_read_tokens",
+    "cache_write_tokens",
+    "thinking_tokens",
+    "truncated",
+    "cost_usd",
+)
+
+_current_usage = contextvars.ContextVar("llm_usage", default=None)
+
+
+def estimate_tokens(text):
+    return len(text or "") // 4
+
+
+def call_cost(
+    model_id, input_tokens=0, output_tokens=0, cache_read_tokens=0, cache_write_tokens=0
+):
+    """
+    Price one LLM call.
+
+    Input tokens exclude the cached ones, as Bedrock reports them.
+
+    Output:
+        cost in USD, or None when the model has no price
+    """
+    prices = MODEL_PRICES.get(model_id)
+    if prices is None:
+        return None
+    return (
+        input_tokens * prices["input"]
+        + output_tokens * prices["output"]
+        + cache_read_tokens * prices.get("cache_read", prices["input"])
+        + cache_write_tokens * prices.get("cache_write", prices["input"])
+    ) / 1_000_000
+
+
+class UsageTotals:
+    """
+    LLM calls, tokens and cost per stage, added to the enclosing totals as well.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.stages = {}
+        self.models = {}
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        stage,
+        input_tokens=0,
+        output_tokens=0,
+        model_id=None,
+        cache_read_tokens=0,
+        cache_write_tokens=0,
+        thinking_tokens=0,
+        truncated=False,
+    ):
+        cost = call_cost(
+            model_id,
+            input_tokens or 0,
+            output_tokens or 0,
+            cache_read_tokens or 0,
+            cache_write_tokens or 0,
+        )
+        call = {
+            "calls": 1,
+            "input_tokens": input_tokens or 0,
+            "output_tokens": output_tokens or 0,
+            "cache_read_tokens": cache_read_tokens or 0,
+            "cache_write_tokens": cache_write_tokens or 0,
+            "thinking_tokens": thinking_tokens or 0,
+            "truncated": int(bool(truncated)),
+            "cost_usd": cost or 0.0,
+        }
+        totals = self
+        while totals is not None:
+            with totals._lock:
+                if model_id:
+                    totals.models[model_id] = totals.models.get(model_id, 0) + 1
+                usage = totals.stages.setdefault(stage, dict.fromkeys(USAGE_FIELDS, 0))
+                for key, value in call.items():
+                    usage[key] += value
+            totals = totals.parent
+
+    def summary(self):
+        """
+        Output:
+            dict with the usage of each stage and their total, and the calls per
+            model id
+        """
+        with self._lock:
+            stages = {stage: dict(usage) for stage, usage in self.stages.items()}
+            models = dict(self.models)
+        total = dict.fromkeys(USAGE_FIELDS, 0)
+        for usage in stages.values():
+            for key in total:
+                total[key] += usage[key]
+        for usage in [total, *stages.values()]:
+            usage["cost_usd"] = round(usage["cost_usd"], 6)
+        return {"stages": stages, "total": total, "models": models}
+
+
+@contextmanager
+def track_usage():
+    """
+    Count the LLM usage of the enclosed block.
+
+    Output:
+        UsageTotals of the block
+    """
+    totals = UsageTotals(parent=_current_usage.get())
+    token = _current_usage.set(totals)
+    try:
+        yield totals
+    finally:
+        _current_usage.reset(token)
+
+
+def record_usage(
+    stage,
+    input_tokens=0,
+    output_tokens=0,
+    model_id=None,
+    cache_read_tokens=0,
+    cache_write_tokens=0,
+    thinking_tokens=0,
+    truncated=False,
+    tool_calls=False,
+):
+    """
+    Add one LLM response to the current usage scope, if any, and to the output
+    lengths observed for the stage (see output_budget.response_stage).
+    """
+    observe_output(response_stage(stage, tool_calls), output_tokens or 0, truncated)
+    totals = _current_usage.get()
+    if totals is not None:
+        totals.add(
+            stage,
+            input_tokens,
+            output_tokens,
+            model_id,
+            cache_read_tokens,
+            cache_write_tokens,
+            thinking_tokens,
+            truncated,
+        )
+
+
+def _thinking_text(content):
+    if not isinstance(content, list):
+        return ""
+    return "".join(
+        block.get("thinking", "")
+        for block in content
+        if isinstance(block, dict) and block.get("type") == "thinking"
+    )
+
+
+class UsageCallback(BaseCallbackHandler):
+    """
+    LangChain callback recording the token usage of each response.
+    """
+
+    def __init__(self, stage, model_id=None):
+        self.stage = stage
+        self.model_id = model_id
+
+    def on_llm_end(self, response, **kwargs: Any) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or {}
+                details = usage.get("input_token_details") or {}
+                metadata = {
+                    **(getattr(message, "additional_kwargs", None) or {}),
+                    **(getattr(message, "response_metadata", None) or {}),
+                }
+                record_usage(
+                    self.stage,
+                    usage.get("input_tokens", 0),
+                    usage.get("output_tokens", 0),
+                    self.model_id,
+                    details.get("cache_read", 0),
+                    details.get("cache_creation", 0),
+                    estimate_tokens(_thinking_text(getattr(message, "content", None))),
+                    metadata.get("stop_reason") == "max_tokens",
+                    bool(getattr(message, "tool_calls", None)),
+                )
+
+
+class LlamaIndexUsageHandler(BaseEventHandler):
+    """
+    llama-index event handler recording the token usage of each chat.
+
+    The model of a chat is taken from its start event, model_id otherwise.
+    """
+
+    stage: str = "sql"
+    model_id: Optional[str] = None
+    _models: dict = PrivateAttr(default_factory=dict)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LlamaIndexUsageHandler"
+
+    def handle(self, event, **kwargs) -> None:
+        if isinstance(event, LLMChatStartEvent):
+            self._models[event.span_id] = (event.model_dict or {}).get("model")
+            return
+        if not isinstance(event, LLMChatEndEvent):
+            return
+        model_id = self._models.pop(event.span_id, None) or self.model_id
+        if event.response is None:
+            return
+        usage = event.response.additional_kwargs or {}
+        raw = event.response.raw if isinstance(event.response.raw, dict) else {}
+        thinking = "".join(
+            getattr(block, "content", None) or ""
+            for block in getattr(event.response.message, "blocks", [])
+            if type(block).__name__ == "ThinkingBlock"
+        )
+        record_usage(
+            self.stage,
+            usage.get("prompt_tokens", 0),
+            usage.get("completion_tokens", 0),
+            model_id,
+            usage.get("cache_read_input_tokens", 0),
+            usage.get("cache_creation_input_tokens", 0),
+            estimate_tokens(thinking),
+            raw.get("stopReason") == "max_tokens",
+        )
+
+
+_llama_index_handler = None
+
+
+def register_llama_index_usage_handler(stage="sql", model_id=None):
+    """
+    Record the usage of every llama-index LLM chat, once per container.
+    """
+    global _llama_index_handler
+    if _llama_index_handler is None:
+        _llama_index_handler = LlamaIndexUsageHandler(stage=stage, model_id=model_id)
+        get_dispatcher().add_event_handler(_llama_index_handler)
+    return _llama_index_handler
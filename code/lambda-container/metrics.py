@@ -0,0 +1,281 @@
+"""
+This script is to time the stages of a request and emit them as CloudWatch
+metrics in the Embedded Metric Format (EMF).
+
+request_metrics() opens the metrics of one request. Within it, span(name) times
+a stage, also in threads started from the request with a copied context, and
+increment(name) counts events such as cache hits. When the request ends, one
+EMF JSON line is printed to stdout, which CloudWatch Logs turns into metrics:
+- the duration in milliseconds of every span, e.g. "get_response" or
+  "kendra_retrieve"; a span entered several times in a request, e.g. a tool the
+  agent called twice, reports every duration
+- the LLM calls, input/output/cache read tokens and cost in USD of the
+  request (see llm_usage.py)
+- the hits and misses of each in-process cache
+- on a cold start, the container init duration as "init"
+The metrics have the question intent and the cold start flag as dimensions.
+The model ids and the token usage per stage are kept as properties of the log
+line, for CloudWatch Logs Insights queries.
+
+METRICS_SAMPLE_RATE sets the share of requests measured; cold starts are always
+measured. Outside a measured request, span() and increment() do nothing.
+capture_metrics() collects the records instead of printing them, to inspect
+them in tests and local runs.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from llm_usage import track_usage
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "GenAIChatApp")
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1.0"))
+
+DIMENSION_SETS = [["Intent"], ["ColdStart"]]
+# Counters that are not event counts
+COUNT_UNITS = {"cost_usd": "None"}
+
+_current_metrics = contextvars.ContextVar("request_metrics", default=None)
+_captures = []
+_state = {"cold_start": True, "init_seconds": None}
+_state_lock = threading.Lock()
+
+
+class RequestMetrics:
+    """
+    Span durations, counters, dimensions and properties of one request.
+    """
+
+    def __init__(self, cold_start=False):
+        self.dimensions = {
+            "Intent": "Unknown",
+            "ColdStart": "true" if cold_start else "false",
+        }
+        self.durations = {}
+        self.counts = {}
+        self.properties = {}
+        self._lock = threading.Lock()
+
+    def add_duration(self, name, milliseconds):
+        with self._lock:
+            self.durations.setdefault(name, []).append(round(milliseconds, 3))
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def set_dimension(self, name, value):
+        with self._lock:
+            self.dimensions[name] = str(value)
+
+    def set_property(self, name, value):
+        with self._lock:
+            self.properties[name] = value
+
+    def add_usage(self, summary):
+        """
+        Add the LLM usage of the request, as returned by UsageTotals.summary().
+        """
+        total = summary["total"]
+        self.increment("llm_calls", total["calls"])
+        self.increment("input_tokens", total["input_tokens"])
+        self.increment("output_tokens", total["output_tokens"])
+        self.increment("cache_read_tokens", total["cache_read_tokens"])
+        self.increment("cost_usd", total["cost_usd"])
+        self.set_property("llm_usage", summary["stages"])
+        self.set_property("model_ids", sorted(summary.get("models", {})))
+
+    def to_emf(self, namespace=METRICS_NAMESPACE, timestamp=None):
+        """
+        Output:
+            the request as an EMF record (dict)
+        """
+        with self._lock:
+            durations = {name: list(values) for name, values in self.durations.items()}
+            counts = dict(self.counts)
+            dimensions = dict(self.dimensions)
+            properties = dict(self.properties)
+
+        definitions = [
+            {"Name": name, "Unit": "Milliseconds"} for name in sorted(durations)
+        ]
+        definitions += [
+            {"Name": name, "Unit": COUNT_UNITS.get(name, "Count")}
+            for name in sorted(counts)
+        ]
+        record = {
+            "_aws": {
+                "Timestamp": int((timestamp or time.time()) * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": namespace,
+                        "Dimensions": DIMENSION_SETS,
+                        "Metrics": definitions,
+                    }
+                ],
+            },
+            **properties,
+            **dimensions,
+        }
+        for name, values in durations.items():
+            record[name] = values[0] if len(values) == 1 else values
+        record.update(counts)
+        return record
+
+
+def record_init(seconds):
+    """
+    Record the container init duration, reported with the first request.
+    """
+    with _state_lock:
+        _state["init_seconds"] = seconds
+
+
+def _start_request():
+    with _state_lock:
+        cold_start = _state["cold_start"]
+        _state["cold_start"] = False
+        return cold_start, _state["init_seconds"]
+
+
+def emit(record):
+    """
+    Print an EMF record, or hand it to the active captures.
+    """
+    if _captures:
+        for captured in list(_captures):
+            captured.append(record)
+        return
+    print(json.dumps(record, default=str), flush=True)
+
+
+@contextmanager
+def capture_metrics():
+    """
+    Collect the EMF records emitted in the enclosed block instead of printing
+    them.
+
+    Output:
+        list receiving the records
+    """
+    captured = []
+    _captures.append(captured)
+    try:
+        yield captured
+    finally:
+        _captures.remove(captured)
+
+
+@contextmanager
+def request_metrics(name="request", sample_rate=None, properties=None):
+    """
+    Measure one request and emit its metrics when it ends.
+
+    Inputs:
+        name (str): span timing the whole request
+        sample_rate (float): share of requests measured, METRICS_SAMPLE_RATE
+            by default
+        properties (dict): extra properties of the record, e.g. the request id
+    Output:
+        RequestMetrics of the request, or None when it is not measured
+    """
+    cold_start, init_seconds = _start_request()
+    rate = METRICS_SAMPLE_RATE if sample_rate is None else sample_rate
+    if not METRICS_ENABLED or (not cold_start and random.random() >= rate):
+        yield None
+        return
+
+    metrics = RequestMetrics(cold_start)
+    for key, value in (properties or {}).items():
+        metrics.set_property(key, value)
+    if cold_start and init_seconds is not None:
+        metrics.add_duration("init", init_seconds * 1000)
+    token = _current_metrics.set(metrics)
+    start = time.perf_counter()
+    try:
+        with track_usage() as usage:
+            yield metrics
+    finally:
+        metrics.add_duration(name, (time.perf_counter() - start) * 1000)
+        _current_metrics.reset(token)
+        try:
+            metrics.add_usage(usage.summary())
+            emit(metrics.to_emf())
+        except Exception:
+            logging.exception("Could not emit the request metrics")
+
+
+@contextmanager
+def span(name):
+    """
+    Time the enclosed block, or the decorated function, as a stage of the
+    current request.
+    """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_duration(name, (time.perf_counter() - start) * 1000)
+
+
+def increment(name, value=1):
+    """
+    Add to a counter of the current request, if it is measured.
+    """
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.increment(name, value)
+
+
+def set_dimension(name, value):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.set_dimension(name, value)
+
+
+def set_property(name, value):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.set_property(name, value)
+
+
+def record_cache_lookup(cache_name, hit):
+    """
+    Count a cache hit or miss of the current request.
+    """
+    increment(f"{cache_name}_cache_{'hits' if hit else 'misses'}")
+
+
+def instrument_sql_engine(engine, name="sql_execution"):
+    """
+    Time every statement run through a SQLAlchemy engine (Athena or SQLite).
+    """
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context, which belongs to this statement only
+        context._query_start = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is None:
+            return
+        metrics = _current_metrics.get()
+        if metrics is not None:
+            metrics.add_duration(name, (time.perf_counter() - start) * 1000)
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+    return engine
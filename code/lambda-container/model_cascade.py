@@ -0,0 +1,212 @@
+"""
+This script is to answer with a cheaper model first and escalate to the
+stronger model only when the answer fails a verifier.
+
+A cascade is configured per stage with MODEL_CASCADE_STAGES, a comma-separated
+subset of "rag" and "sql" ("none" disables it). For these stages,
+CASCADE_FIRST_MODEL (Claude Haiku by default) answers first, and
+CASCADE_FALLBACK_MODEL (Claude Sonnet) runs only when the verifier rejects the
+first answer:
+- "rag": the answer refuses, e.g. "I do not have enough context"
+- "sql": the generated SQL does not execute, or returns no rows
+
+Each cascade counts its calls and escalations, and estimates the latency saved:
+every accepted first answer saves the mean latency of the fallback model, and
+every first attempt costs its own latency. The estimate is None until the
+fallback model has run once.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+from metrics import increment, span
+
+MODEL_CASCADE_STAGES = frozenset(
+    stage.strip()
+    for stage in os.environ.get("MODEL_CASCADE_STAGES", "rag,sql").lower().split(",")
+    if stage.strip() and stage.strip() != "none"
+)
+CASCADE_FIRST_MODEL = os.environ.get("CASCADE_FIRST_MODEL", "ClaudeHaiku")
+CASCADE_FALLBACK_MODEL = os.environ.get("CASCADE_FALLBACK_MODEL", "ClaudeSonnet")
+# Characters of a streamed answer held back until the verifier has seen them
+CASCADE_STREAM_HOLD_CHARS = int(os.environ.get("CASCADE_STREAM_HOLD_CHARS", "200"))
+
+# Refusals asked for by RAG_TEMPLATE, and their usual paraphrases
+REFUSAL_PATTERN = re.compile(
+    r"(do(?: not|n't) have (?:enough|sufficient) (?:context|information)"
+    r"|(?:not|in)sufficient (?:context|information)"
+    r"|(?:context|information) (?:provided )?(?:does not|doesn't) "
+    r"(?:contain|mention|include|cover)"
+    r"|\bI (?:cannot|can't|am unable to) (?:answer|find)"
+    r"|\bout of scope)",
+    re.IGNORECASE,
+)
+
+
+def is_cascade_enabled(stage):
+    """
+    Whether the stage answers with the first model before the fallback model.
+    """
+    return stage in MODEL_CASCADE_STAGES
+
+
+def is_refusal(text):
+    """
+    Whether a RAG answer declines to answer the question.
+    """
+    return bool(REFUSAL_PATTERN.search(text or ""))
+
+
+def sql_result_verified(metadata):
+    """
+    Whether the text-to-SQL step ran its SQL and got rows back.
+
+    Input:
+        metadata (dict): metadata returned by NLSQLRetriever.retrieve_with_metadata
+    """
+    return bool(metadata.get("result"))
+
+
+class ModelCascade:
+    """
+    First model, verifier and fallback model of one stage, with their stats.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.calls = 0
+        self.escalations = 0
+        self.first_seconds = 0.0
+        self.fallback_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, first_seconds, escalated, fallback_seconds=0.0):
+        """
+        Count one cascade call.
+        """
+        with self._lock:
+            self.calls += 1
+            self.first_seconds += first_seconds
+            if escalated:
+                self.escalations += 1
+                self.fallback_seconds += fallback_seconds
+        increment(f"{self.stage}_cascade_calls")
+        if escalated:
+            increment(f"{self.stage}_cascade_escalations")
+
+    def run(self, first, fallback, verify):
+        """
+        Inputs:
+            first (callable): answers with the first model
+            fallback (callable): answers with the fallback model
+            verify (callable): result -> bool, whether to keep the first answer
+        Output:
+            the first answer if verified, else the fallback answer
+        """
+        start = time.perf_counter()
+        with span(f"{self.stage}_first_model"):
+            try:
+                result = first()
+                verified = verify(result)
+            except Exception:
+                logging.exception("First model of the %s cascade failed", self.stage)
+                verified = False
+        first_seconds = time.perf_counter() - start
+        if verified:
+            self.record(first_seconds, escalated=False)
+            return result
+        return self._escalate(first_seconds, fallback)
+
+    def _escalate(self, first_seconds, fallback):
+        logging.info("Escalating %s to %s", self.stage, CASCADE_FALLBACK_MODEL)
+        start = time.perf_counter()
+        try:
+            with span(f"{self.stage}_fallback_model"):
+                return fallback()
+        finally:
+            self.record(first_seconds, True, time.perf_counter() - start)
+
+    def stream(self, first, fallback, rejected, hold_chars=CASCADE_STREAM_HOLD_CHARS):
+        """
+        Stream the first model's answer, unless its beginning is rejected.
+
+        The first hold_chars characters are held back until rejected() has
+        seen them; a rejected beginning is discarded and the fallback model's
+        answer is streamed instead.
+
+        Inputs:
+            first (callable): returns an iterator of str chunks
+            fallback (callable): returns an iterator of str chunks
+            rejected (callable): beginning of the answer -> bool
+        Output:
+            generator of str chunks
+        """
+        start = time.perf_counter()
+        held = []
+        chunks = iter(())
+        try:
+            chunks = first()
+            for chunk in chunks:
+                held.append(chunk)
+                if sum(len(held_chunk) for held_chunk in held) >= hold_chars:
+                    break
+            verified = not rejected("".join(held))
+        except Exception:
+            logging.exception("First model of the %s cascade failed", self.stage)
+            verified = False
+        if not verified:
+            first_seconds = time.perf_counter() - start
+            logging.info("Escalating %s to %s", self.stage, CASCADE_FALLBACK_MODEL)
+            start = time.perf_counter()
+            try:
+                yield from fallback()
+            finally:
+                self.record(first_seconds, True, time.perf_counter() - start)
+            return
+        yield from held
+        yield from chunks
+        self.record(time.perf_counter() - start, escalated=False)
+
+    def stats(self):
+        with self._lock:
+            calls, escalations = self.calls, self.escalations
+            first_seconds, fallback_seconds = self.first_seconds, self.fallback_seconds
+        saved = None
+        if escalations:
+            mean_fallback = fallback_seconds / escalations
+            saved = (calls - escalations) * mean_fallback - first_seconds
+        return {
+            "stage": self.stage,
+            "calls": calls,
+            "escalations": escalations,
+            "escalation_rate": escalations / calls if calls else 0.0,
+            "latency_saved_seconds": saved,
+        }
+
+
+_cascades = {}
+_cascades_lock = threading.Lock()
+
+
+def get_cascade(stage):
+    """
+    Return the container-wide cascade of the stage.
+    """
+    with _cascades_lock:
+        cascade = _cascades.get(stage)
+        if cascade is None:
+            cascade = _cascades[stage] = ModelCascade(stage)
+        return cascade
+
+
+def cascade_stats():
+    """
+    Output:
+        list with the stats of every cascade used in this container
+    """
+    with _cascades_lock:
+        cascades = list(_cascades.values())
+    return [cascade.stats() for cascade in cascades]
@@ -0,0 +1,146 @@
+"""
+This script is to size the max_tokens of each pipeline stage from the output
+lengths observed in this container.
+
+Every LLM response reports its output tokens per stage (see llm_usage.py).
+Once a stage has OUTPUT_BUDGET_MIN_SAMPLES responses, its max_tokens is the
+OUTPUT_BUDGET_PERCENTILE of the last OUTPUT_BUDGET_WINDOW output lengths, times
+OUTPUT_BUDGET_HEADROOM, rounded up to a power of two. The budget never exceeds
+the max_tokens the caller asks for, which stays the ceiling, and never drops
+below OUTPUT_BUDGET_FLOOR. A response cut off at max_tokens drops the stage's
+samples, so the stage goes back to the caller's max_tokens until enough
+complete responses are observed again.
+
+The agent model writes both tool calls and the final answer, whose lengths
+differ by an order of magnitude. Its responses are observed under "agent_step"
+and "agent_final", and its max_tokens is the larger of the two budgets, so a
+mix of many short tool calls cannot lower the budget of the final answer.
+
+Rounding to powers of two keeps the number of distinct budgets, and so of
+model configurations (e.g. compiled agents), small.
+"""
+
+import math
+import os
+import threading
+from collections import deque
+
+import numpy as np
+
+ADAPTIVE_MAX_TOKENS = os.environ.get("ADAPTIVE_MAX_TOKENS", "true").lower() == "true"
+OUTPUT_BUDGET_PERCENTILE = float(os.environ.get("OUTPUT_BUDGET_PERCENTILE", "99"))
+OUTPUT_BUDGET_HEADROOM = float(os.environ.get("OUTPUT_BUDGET_HEADROOM", "1.25"))
+OUTPUT_BUDGET_MIN_SAMPLES = int(os.environ.get("OUTPUT_BUDGET_MIN_SAMPLES", "20"))
+OUTPUT_BUDGET_WINDOW = int(os.environ.get("OUTPUT_BUDGET_WINDOW", "500"))
+OUTPUT_BUDGET_FLOOR = int(os.environ.get("OUTPUT_BUDGET_FLOOR", "16"))
+
+# Stages whose model answers with tool calls before its final answer
+TOOL_CALLING_STAGES = frozenset({"agent"})
+
+
+def response_stage(stage, tool_calls=False):
+    """
+    Key the output length of one response is observed under.
+
+    Inputs:
+        stage (str): pipeline stage of the model
+        tool_calls (bool): whether the response calls tools
+    Output:
+        "<stage>_step" or "<stage>_final" for a TOOL_CALLING_STAGES stage,
+        the stage otherwise
+    """
+    if stage not in TOOL_CALLING_STAGES:
+        return stage
+    return f"{stage}_step" if tool_calls else f"{stage}_final"
+
+
+class OutputBudget:
+    """
+    Output lengths observed per stage, and the max_tokens derived from them.
+    """
+
+    def __init__(
+        self,
+        enabled=ADAPTIVE_MAX_TOKENS,
+        percentile=OUTPUT_BUDGET_PERCENTILE,
+        headroom=OUTPUT_BUDGET_HEADROOM,
+        min_samples=OUTPUT_BUDGET_MIN_SAMPLES,
+        window=OUTPUT_BUDGET_WINDOW,
+        floor=OUTPUT_BUDGET_FLOOR,
+    ):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.window = window
+        self.floor = floor
+        self.truncations = {}
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, output_tokens, truncated=False):
+        """
+        Add the output length of one response of the stage.
+        """
+        with self._lock:
+            samples = self._samples.setdefault(stage, deque(maxlen=self.window))
+            if truncated:
+                self.truncations[stage] = self.truncations.get(stage, 0) + 1
+                samples.clear()
+            elif output_tokens:
+                samples.append(output_tokens)
+
+    def max_tokens(self, stage, default):
+        """
+        Inputs:
+            stage (str): pipeline stage, e.g. "rag"
+            default (int): max_tokens asked for by the caller, the ceiling
+        Output:
+            the max_tokens to use for the next response of the stage
+        """
+        if not self.enabled:
+            return default
+        if stage in TOOL_CALLING_STAGES:
+            # Any response may be the final answer or a tool call
+            return max(
+                self.max_tokens(response_stage(stage, tool_calls), default)
+                for tool_calls in (True, False)
+            )
+        with self._lock:
+            samples = list(self._samples.get(stage, ()))
+        if len(samples) < self.min_samples:
+            return default
+        needed = np.percentile(samples, self.percentile) * self.headroom
+        budget = 2 ** math.ceil(math.log2(max(needed, 1)))
+        return int(min(default, max(self.floor, budget)))
+
+    def stats(self):
+        with self._lock:
+            stages = {stage: list(samples) for stage, samples in self._samples.items()}
+            truncations = dict(self.truncations)
+        return {
+            stage: {
+                "samples": len(samples),
+                "p50": float(np.percentile(samples, 50)) if samples else None,
+                "p99": float(np.percentile(samples, 99)) if samples else None,
+                "truncations": truncations.get(stage, 0),
+            }
+            for stage, samples in stages.items()
+        }
+
+
+output_budget = OutputBudget()
+
+
+def observe_output(stage, output_tokens, truncated=False):
+    """
+    Add the output length of one response of the stage.
+    """
+    output_budget.observe(stage, output_tokens, truncated)
+
+
+def adaptive_max_tokens(stage, default):
+    """
+    The max_tokens of the stage's next response, at most default.
+    """
+    return output_budget.max_tokens(stage, default)
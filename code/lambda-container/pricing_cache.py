@@ -0,0 +1,241 @@
+"""
+This script is to memoize the text-to-SQL and SQL execution steps of the
+pricing query engine.
+
+Two caches sit around the query engine:
+- question -> generated SQL, skipping the text-to-SQL LLM call for questions
+  already seen (after normalizing case, whitespace and question marks)
+- SQL -> result rows, skipping the Athena (or SQLite) execution for statements
+  already run, whichever question produced them
+
+Both are stamped with the pricing data version (a hash of the S3 keys and
+ETags of the CSVs behind the Glue tables, see data_version.py), so they are
+emptied once the pricing data changes, and bypassed while the version is not
+known yet. refresh_pricing_cache() recomputes the
+version and empties them immediately, e.g. after the Glue crawler ran.
+"""
+
+import logging
+import os
+import re
+
+from llama_index.core import SQLDatabase
+from llama_index.core.indices.struct_store.sql_query import BaseSQLTableQueryEngine
+from llama_index.core.indices.struct_store.sql_retriever import NLSQLRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+
+from caching import LRUTTLCache
+from pricing_data import pricing_data_version
+from utils import normalize_question
+
+PRICING_CACHE_ENABLED = (
+    os.environ.get("PRICING_CACHE_ENABLED", "true").lower() == "true"
+)
+PRICING_SQL_CACHE_SIZE = int(os.environ.get("PRICING_SQL_CACHE_SIZE", "1024"))
+PRICING_RESULT_CACHE_SIZE = int(os.environ.get("PRICING_RESULT_CACHE_SIZE", "512"))
+PRICING_CACHE_TTL_SECONDS = int(os.environ.get("PRICING_CACHE_TTL_SECONDS", "86400"))
+
+# Single-quoted SQL string literals, kept verbatim by normalize_sql
+SQL_LITERAL_PATTERN = re.compile(r"('(?:[^']|'')*')")
+
+
+def normalize_sql(sql):
+    """
+    Normalize a SQL statement for use as a cache key.
+
+    Keywords and identifiers are lowercased and whitespace is collapsed, but
+    string literals such as instance names are left untouched.
+
+    Input:
+        sql (str): SQL statement
+    Output:
+        normalized statement as a str
+    """
+    parts = SQL_LITERAL_PATTERN.split(sql.strip().rstrip(";"))
+    normalized = []
+    for index, part in enumerate(parts):
+        # split() with a capture group puts the literals at odd positions
+        normalized.append(part if index % 2 else re.sub(r"\s+", " ", part.lower()))
+    return "".join(normalized).strip()
+
+
+class PricingQueryCache:
+    """
+    The question -> SQL and SQL -> rows caches, stamped with a data version.
+    """
+
+    def __init__(
+        self,
+        version=pricing_data_version,
+        sql_size=PRICING_SQL_CACHE_SIZE,
+        result_size=PRICING_RESULT_CACHE_SIZE,
+        ttl=PRICING_CACHE_TTL_SECONDS,
+    ):
+        self.data_version = version
+        self.sql = LRUTTLCache(maxsize=sql_size, ttl=ttl, name="pricing_sql")
+        self.results = LRUTTLCache(maxsize=result_size, ttl=ttl, name="pricing_result")
+
+    def _check_version(self):
+        """
+        Drop the entries of an older data version. False while the version is
+        not known yet, in which case the caches are bypassed.
+        """
+        version = self.data_version.get()
+        if version is None:
+            return False
+        self.sql.ensure_version(version)
+        self.results.ensure_version(version)
+        return True
+
+    def get_sql(self, question):
+        if not self._check_version():
+            return None
+        return self.sql.get(normalize_question(question))
+
+    def set_sql(self, question, sql):
+        if self._check_version():
+            self.sql.set(normalize_question(question), sql)
+
+    def get_result(self, sql):
+        if not self._check_version():
+            return None
+        return self.results.get(normalize_sql(sql))
+
+    def set_result(self, sql, result):
+        if self._check_version():
+            self.results.set(normalize_sql(sql), result)
+
+    def refresh(self):
+        """
+        Recompute the data version and drop every cached SQL and result.
+        """
+        self.data_version.refresh()
+        self.sql.invalidate()
+        self.results.invalidate()
+
+    def stats(self):
+        return [self.sql.stats(), self.results.stats()]
+
+
+pricing_query_cache = PricingQueryCache()
+
+
+def refresh_pricing_cache():
+    """
+    Drop the cached SQL and results, e.g. after the pricing data was updated.
+    """
+    pricing_query_cache.refresh()
+
+
+class MemoizedSQLDatabase(SQLDatabase):
+    """
+    SQL database serving repeated statements from the result cache.
+    """
+
+    def __init__(self, *args, cache=pricing_query_cache, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._query_cache = cache
+
+    def run_sql(self, command):
+        cached = self._query_cache.get_result(command)
+        if cached is not None:
+            logging.info("Pricing SQL result served from cache")
+            return cached
+        result = super().run_sql(command)
+        self._query_cache.set_result(command, result)
+        return result
+
+
+class MemoizedNLSQLRetriever(NLSQLRetriever):
+    """
+    Text-to-SQL retriever reusing the SQL generated for an earlier question.
+
+    New questions go through generator, another text-to-SQL retriever, when
+    given (e.g. a model cascade), and through this retriever's LLM otherwise.
+    """
+
+    def __init__(self, *args, cache=pricing_query_cache, generator=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._query_cache = cache
+        self._generator = generator
+
+    def _generate(self, query_bundle):
+        if self._generator is not None:
+            return self._generator.retrieve_with_metadata(query_bundle)
+        return super().retrieve_with_metadata(query_bundle)
+
+    def retrieve_with_metadata(self, str_or_query_bundle):
+        if isinstance(str_or_query_bundle, str):
+            query_bundle = QueryBundle(str_or_query_bundle)
+        else:
+            query_bundle = str_or_query_bundle
+
+        sql_query_str = self._query_cache.get_sql(query_bundle.query_str)
+        if sql_query_str is None:
+            retrieved_nodes, metadata = self._generate(query_bundle)
+            # Only SQL that executed is reused; failed statements are retried
+            if "result" in metadata:
+                self._query_cache.set_sql(query_bundle.query_str, metadata["sql_query"])
+            return retrieved_nodes, metadata
+
+        logging.info("Pricing SQL served from cache: %s", sql_query_str)
+        try:
+            retrieved_nodes, metadata = self._sql_retriever.retrieve_with_metadata(
+                sql_query_str
+            )
+        except BaseException as e:
+            if not self._handle_sql_errors:
+                raise
+            retrieved_nodes = [NodeWithScore(node=TextNode(text=f"Error: {e!s}"))]
+            metadata = {}
+        return retrieved_nodes, {"sql_query": sql_query_str, **metadata}
+
+    async def aretrieve_with_metadata(self, str_or_query_bundle):
+        return self.retrieve_with_metadata(str_or_query_bundle)
+
+
+class SQLRetrieverQueryEngine(BaseSQLTableQueryEngine):
+    """
+    SQL query engine answering with a given text-to-SQL retriever, e.g. a model
+    cascade or a memoized retriever, and synthesizing the response as
+    SQLTableRetrieverQueryEngine does.
+    """
+
+    def __init__(self, sql_retriever, **kwargs):
+        self._retriever = sql_retriever
+        super().__init__(**kwargs)
+
+    @property
+    def sql_retriever(self):
+        return self._retriever
+
+
+class MemoizedSQLQueryEngine(SQLRetrieverQueryEngine):
+    """
+    SQL query engine whose text-to-SQL step is memoized.
+
+    Pair it with a MemoizedSQLDatabase to memoize the SQL execution as well.
+    generator writes the SQL of new questions, see MemoizedNLSQLRetriever.
+    """
+
+    def __init__(
+        self,
+        sql_database,
+        table_retriever,
+        text_to_sql_prompt=None,
+        cache=pricing_query_cache,
+        generator=None,
+        **kwargs,
+    ):
+        super().__init__(
+            MemoizedNLSQLRetriever(
+                sql_database,
+                cache=cache,
+                generator=generator,
+                llm=kwargs.get("llm"),
+                text_to_sql_prompt=text_to_sql_prompt,
+                table_retriever=table_retriever,
+                callback_manager=kwargs.get("callback_manager"),
+            ),
+            **kwargs,
+        )
@@ -0,0 +1,267 @@
+"""
+This script is to load the SageMaker pricing CSVs into an embedded SQLite database.
+
+The tables and columns mirror the ones the AWS Glue crawler creates for Amazon
+Athena, so the same text-to-SQL prompts work against either backend. The
+tables, and the database loaded from them, are reloaded when the pricing data
+version changes (see data_version.py).
+"""
+
+import csv
+import io
+import logging
+import os
+import re
+import sqlite3
+import uuid
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import QueuePool
+
+from connections import Connections
+from data_version import (
+    DataVersion,
+    VersionedValue,
+    local_dir_version,
+    s3_prefix_version,
+)
+
+# S3 prefix the CDK stack uploads assets/sagemaker_source to; each table lives
+# in its own folder, which is also the table name the Glue crawler assigns.
+PRICING_DATA_PREFIX = "source_data"
+PRICING_TABLES = (
+    "asynchronous_inference_price",
+    "inference_accelerator_price",
+    "real_time_inference_price",
+    "training_price",
+)
+
+_SQL_TYPES = {"bigint": "BIGINT", "double": "DOUBLE", "string": "VARCHAR"}
+
+
+def normalize_column_name(name):
+    """
+    Normalize a CSV header the way the Glue crawler does, e.g. "vCPU" -> "vcpu".
+    """
+    name = name.strip().lower()
+    return re.sub(r"[^a-z0-9_]", "_", name)
+
+
+def _infer_type(values):
+    """
+    Infer the Glue column type ("bigint", "double" or "string") of CSV values.
+    """
+    non_empty = [value for value in values if value != ""]
+    if not non_empty:
+        return "string"
+    try:
+        for value in non_empty:
+            int(value)
+        return "bigint"
+    except ValueError:
+        pass
+    try:
+        for value in non_empty:
+            float(value)
+        return "double"
+    except ValueError:
+        return "string"
+
+
+def _convert(value, column_type):
+    if value == "":
+        return None
+    if column_type == "bigint":
+        return int(value)
+    if column_type == "double":
+        return float(value)
+    return value
+
+
+def parse_pricing_csv(texts):
+    """
+    Parse the CSV files of one table into typed rows.
+
+    Input:
+        texts (list): CSV file contents (str) sharing the same header
+    Output:
+        table (dict): {"columns": [(name, glue_type)], "rows": [tuple]}
+    """
+    header = None
+    raw_rows = []
+    for text in texts:
+        reader = csv.reader(io.StringIO(text.lstrip("\ufeff")))
+        file_header = next(reader, None)
+        if file_header is None:
+            continue
+        header = header or [normalize_column_name(col) for col in file_header]
+        raw_rows.extend(row for row in reader if any(cell.strip() for cell in row))
+
+    if header is None:
+        raise ValueError("Pricing table has no CSV header")
+
+    column_types = [
+        _infer_type([row[i].strip() for row in raw_rows if i < len(row)])
+        for i in range(len(header))
+    ]
+    rows = []
+    for row in raw_rows:
+        cells = [cell.strip() for cell in row] + [""] * (len(header) - len(row))
+        rows.append(
+            tuple(
+                _convert(cell, column_type)
+                for cell, column_type in zip(cells, column_types)
+            )
+        )
+    return {"columns": list(zip(header, column_types)), "rows": rows}
+
+
+def _read_local_csvs(data_dir, table):
+    table_dir = os.path.join(data_dir, table)
+    texts = []
+    for file_name in sorted(os.listdir(table_dir)):
+        if file_name.endswith(".csv"):
+            with open(os.path.join(table_dir, file_name), encoding="utf-8") as f:
+                texts.append(f.read())
+    return texts
+
+
+def _read_s3_csvs(bucket, table):
+    texts = []
+    s3_bucket = Connections.s3_resource.Bucket(bucket)
+    for obj in s3_bucket.objects.filter(Prefix=f"{PRICING_DATA_PREFIX}/{table}/"):
+        if obj.key.endswith(".csv"):
+            texts.append(obj.get()["Body"].read().decode("utf-8"))
+    return texts
+
+
+def load_pricing_tables(data_dir=None, bucket=None):
+    """
+    Load the pricing tables from a local folder or from the pricing S3 bucket.
+
+    Inputs:
+        data_dir (str): folder laid out like assets/sagemaker_source; takes
+            precedence over the bucket when set
+        bucket (str): S3 bucket holding the pricing CSVs under source_data/
+    Output:
+        tables (dict): table name -> {"columns": [...], "rows": [...]}
+    """
+    tables = {}
+    for table in PRICING_TABLES:
+        if data_dir:
+            texts = _read_local_csvs(data_dir, table)
+        else:
+            texts = _read_s3_csvs(bucket or Connections.s3_pricing_bucket_name, table)
+        tables[table] = parse_pricing_csv(texts)
+        logging.debug("Loaded %d rows into %s", len(tables[table]["rows"]), table)
+    return tables
+
+
+def _pricing_version():
+    # Same source as the pricing tables: a local folder, or the pricing bucket
+    # prefix the Glue crawler reads
+    if Connections.pricing_data_dir:
+        return local_dir_version(Connections.pricing_data_dir)
+    return s3_prefix_version(
+        Connections.s3_pricing_bucket_name, f"{PRICING_DATA_PREFIX}/"
+    )
+
+
+pricing_data_version = DataVersion("pricing", _pricing_version)
+
+_pricing_tables = VersionedValue(
+    pricing_data_version,
+    lambda: load_pricing_tables(data_dir=Connections.pricing_data_dir),
+)
+
+
+def get_pricing_tables():
+    """
+    Load the pricing tables from the configured source, once per container and
+    again whenever the pricing data version changes.
+    """
+    return _pricing_tables.get()
+
+
+class _DatabaseConnection(sqlite3.Connection):
+    """
+    SQLite connection that knows the database it was opened on.
+    """
+
+    database = None
+
+
+class SharedMemoryDatabase:
+    """
+    Named in-memory SQLite database holding the pricing tables, which every
+    connection of an engine opens.
+
+    Each connection is used by one thread at a time, and one connection stays
+    open so the database lives as long as the object.
+    """
+
+    def __init__(self, tables):
+        self.uri = f"file:pricing-{uuid.uuid4().hex}?mode=memory&cache=shared"
+        self._keep_alive = self.connect()
+        with self._keep_alive as conn:
+            for table, data in tables.items():
+                columns = ", ".join(
+                    f'"{name}" {_SQL_TYPES[column_type]}'
+                    for name, column_type in data["columns"]
+                )
+                conn.execute(f'CREATE TABLE "{table}" ({columns})')
+                placeholders = ", ".join("?" for _ in data["columns"])
+                conn.executemany(
+                    f'INSERT INTO "{table}" VALUES ({placeholders})', data["rows"]
+                )
+
+    def connect(self):
+        # Pooled connections are returned and closed from any thread
+        conn = sqlite3.connect(
+            self.uri, uri=True, check_same_thread=False, factory=_DatabaseConnection
+        )
+        conn.database = self
+        return conn
+
+
+def create_sqlite_engine(tables):
+    """
+    Create an in-memory SQLite database holding the given pricing tables.
+
+    Input:
+        tables (dict): output of load_pricing_tables
+    Output:
+        SQLAlchemy engine
+    """
+    # Concurrent requests check out their own connection to the shared
+    # database instead of interleaving statements on a single one
+    database = SharedMemoryDatabase(tables)
+    return create_engine("sqlite://", creator=database.connect, poolclass=QueuePool)
+
+
+def create_pricing_sqlite_engine():
+    """
+    Create an in-memory SQLite database holding the configured pricing tables,
+    reloaded when the pricing data version changes.
+
+    Connections checked out after a change open the reloaded database; queries
+    already running finish on the previous one.
+
+    Output:
+        SQLAlchemy engine
+    """
+    databases = VersionedValue(
+        pricing_data_version, lambda: SharedMemoryDatabase(get_pricing_tables())
+    )
+    engine = create_engine(
+        "sqlite://", creator=lambda: databases.get().connect(), poolclass=QueuePool
+    )
+
+    @event.listens_for(engine, "checkout")
+    def _reconnect_to_current_data(dbapi_connection, record, proxy):
+        # The pool replaces a connection refused at checkout with a new one
+        if dbapi_connection.database is not databases.get():
+            raise DisconnectionError("The pricing data version changed")
+
+    return engine
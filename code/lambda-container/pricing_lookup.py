@@ -0,0 +1,258 @@
+"""
+This script is to answer direct instance price lookups without calling an LLM.
+
+Questions such as "how much is p3.8xlarge per hour for training?" only need the
+price of a few named instances from one pricing table. They are resolved here
+from the pricing data when the rest of the question is only made of price and
+table keywords (SIMPLE_LOOKUP_WORDS); anything that cannot be resolved with
+high confidence returns None and falls through to the text-to-SQL query engine.
+"""
+
+import logging
+import re
+
+from data_version import VersionedValue
+from pricing_data import get_pricing_tables, pricing_data_version
+
+TABLE_LABELS = {
+    "training_price": "training",
+    "real_time_inference_price": "real-time inference",
+    "asynchronous_inference_price": "asynchronous inference",
+    "inference_accelerator_price": "inference accelerator",
+}
+# Column holding the instance name, when it is not "instance_type"
+KEY_COLUMNS = {"inference_accelerator_price": "accelerator"}
+
+# Optional "ml." prefix, an instance family such as "p3", "g4dn" or "trn1n",
+# then a size, with or without a separator: "ml.p3.2xlarge", "p3 2xlarge" and
+# "p32xlarge" all match.
+INSTANCE_PATTERN = re.compile(
+    r"\b(?:ml\s*\.\s*)?([a-z]+\d+[a-z]*)[\s.\-]*(\d*xlarge|large|medium|small|metal)\b",
+    re.IGNORECASE,
+)
+PRICE_PATTERN = re.compile(
+    r"\b(price|prices|priced|pricing|cost|costs|rate|how much|per hour|hourly)\b",
+    re.IGNORECASE,
+)
+# Anything asking for a ranking, a comparison, other attributes, arithmetic or
+# another price than the on-demand one (savings plans, spot, other regions) is
+# left to the query engine.
+COMPLEX_PATTERN = re.compile(
+    r"\b(cheap\w*|expensive|most|least|max\w*|min\w*|compare\w*|comparison|"
+    r"better|best|worse|recommend\w*|which|why|should|budget|total|sum|average|"
+    r"memory|vcpus?|cpus?|gpus?|ram|hours|days?|weeks?|months?|minutes|"
+    r"difference|differ|vs|versus|than|all|list|every|"
+    r"savings?|spot|reserved|reservations?|discount\w*|commit\w*|plans?|"
+    r"regions?|zones?|[a-z]{2}(?:-gov)?-[a-z]+-\d)\b",
+    re.IGNORECASE,
+)
+# Once the instance names are removed, a direct lookup is only made of these
+# words: the price and table keywords and the filler around them. A question
+# with any other word may qualify the price and is left to the query engine.
+SIMPLE_LOOKUP_WORDS = frozenset(
+    "price prices priced pricing cost costs rate rates how much per hour hourly "
+    "training train inference endpoint endpoints hosting deploy deploying "
+    "deployment real time realtime async asynchronous accelerator accelerators "
+    "what whats s is are the of for a an and does do it to use using run running "
+    "on instance instances sagemaker amazon ml me tell please current latest".split()
+)
+WORD_PATTERN = re.compile(r"[a-z]+")
+TABLE_PATTERNS = (
+    ("asynchronous_inference_price", re.compile(r"\basync\w*", re.IGNORECASE)),
+    ("inference_accelerator_price", re.compile(r"\baccelerator|\beia", re.IGNORECASE)),
+    (
+        "real_time_inference_price",
+        re.compile(
+            r"\binferenc\w*|\bendpoints?\b|\bhosting\b|\bdeploy\w*|\breal[\s-]?time\b",
+            re.IGNORECASE,
+        ),
+    ),
+    ("training_price", re.compile(r"\btrain\w*", re.IGNORECASE)),
+)
+
+
+def compact_instance_name(name):
+    """
+    Reduce an instance name to a separator-free key, e.g. "ml.p3.2xlarge" -> "p32xlarge".
+    """
+    name = name.lower()
+    if name.startswith("ml."):
+        name = name[3:]
+    return re.sub(r"[^a-z0-9]", "", name)
+
+
+def detect_table(query, instances=()):
+    """
+    Detect the pricing table a question refers to from its keywords.
+
+    Inputs:
+        query (str): user's question
+        instances (list): canonical instance names found in the question
+    Output:
+        table name as a str, or None when several tables are mentioned
+    """
+    if instances and all(instance.startswith("ml.eia") for instance in instances):
+        return "inference_accelerator_price"
+
+    matched = [table for table, pattern in TABLE_PATTERNS if pattern.search(query)]
+    if "asynchronous_inference_price" in matched or (
+        "inference_accelerator_price" in matched
+    ):
+        # "asynchronous inference" and "inference accelerator" also mention
+        # inference, which is not a separate real-time table request.
+        matched = [table for table in matched if table != "real_time_inference_price"]
+    if not matched:
+        # Same default as the text-to-SQL prompt
+        return "training_price"
+    if len(matched) > 1:
+        return None
+    return matched[0]
+
+
+class PriceLookupResolver:
+    """
+    Index of instance prices per table, keyed by canonical instance name.
+    """
+
+    def __init__(self, tables):
+        self.prices = {}
+        aliases = {}
+        ambiguous = set()
+        for table, data in tables.items():
+            columns = [name for name, _ in data["columns"]]
+            key_index = columns.index(KEY_COLUMNS.get(table, "instance_type"))
+            price_index = columns.index("price_per_hour")
+            table_prices = {}
+            for row in data["rows"]:
+                instance, price = row[key_index], row[price_index]
+                if instance is None or price is None:
+                    continue
+                table_prices[instance] = price
+                key = compact_instance_name(instance)
+                if aliases.get(key, instance) != instance:
+                    ambiguous.add(key)
+                aliases[key] = instance
+            self.prices[table] = table_prices
+        self.aliases = {k: v for k, v in aliases.items() if k not in ambiguous}
+
+    def extract_instances(self, query):
+        """
+        Find the instance names mentioned in a question.
+
+        Input:
+            query (str): user's question
+        Output:
+            (instances, unresolved): canonical names in order of appearance,
+            and the number of instance-like tokens that matched no instance
+        """
+        instances = []
+        unresolved = 0
+        for match in INSTANCE_PATTERN.finditer(query):
+            canonical = self.aliases.get(
+                compact_instance_name(match.group(1) + match.group(2))
+            )
+            if canonical is None:
+                unresolved += 1
+            elif canonical not in instances:
+                instances.append(canonical)
+        return instances, unresolved
+
+    def resolve(self, query):
+        """
+        Answer a direct price lookup from the pricing data.
+
+        Input:
+            query (str): user's question
+        Output:
+            output (dict): {"source", "answer"}, or None when the question is
+            not a direct price lookup that can be answered with confidence
+        """
+        if not PRICE_PATTERN.search(query) or COMPLEX_PATTERN.search(query):
+            return None
+
+        instances, unresolved = self.extract_instances(query)
+        if not instances or unresolved:
+            return None
+        # Any number left once the instance names are removed (quantities,
+        # durations, ...) needs arithmetic the lookup does not do, and any
+        # other word may qualify the price.
+        rest = INSTANCE_PATTERN.sub(" ", query).lower()
+        if re.search(r"\d", rest) or not SIMPLE_LOOKUP_WORDS.issuperset(
+            WORD_PATTERN.findall(rest)
+        ):
+            return None
+
+        table = detect_table(query, instances)
+        if table is None:
+            return None
+        table_prices = self.prices.get(table, {})
+        if any(instance not in table_prices for instance in instances):
+            return None
+
+        return {
+            "source": self._sql(table, instances),
+            "answer": self._answer(table, instances, table_prices),
+        }
+
+    @staticmethod
+    def _sql(table, instances):
+        key_column = KEY_COLUMNS.get(table, "instance_type")
+        if len(instances) == 1:
+            condition = f"{key_column} = '{instances[0]}'"
+        else:
+            names = ", ".join(f"'{instance}'" for instance in instances)
+            condition = f"{key_column} IN ({names})"
+        return (
+            f"SELECT {key_column}, price_per_hour \nFROM {table}\n"
+            f"WHERE {condition}\nORDER BY price_per_hour"
+        )
+
+    @staticmethod
+    def _answer(table, instances, table_prices):
+        label = TABLE_LABELS[table]
+        if len(instances) == 1:
+            instance = instances[0]
+            return (
+                f"According to the latest information, the {label} price of "
+                f"**{instance}** is \\${table_prices[instance]} per hour."
+            )
+        lines = [
+            f"According to the latest information, the {label} prices per hour are:",
+            "",
+        ]
+        for instance in sorted(instances, key=lambda name: table_prices[name]):
+            lines.append(f"- **{instance}**: \\${table_prices[instance]} per hour")
+        return "\n".join(lines)
+
+
+_resolver = VersionedValue(
+    pricing_data_version, lambda: PriceLookupResolver(get_pricing_tables())
+)
+
+
+def get_price_resolver():
+    """
+    Return the container-wide resolver, building it from the pricing data
+    again whenever its version changes.
+    """
+    return _resolver.get()
+
+
+def resolve_price_lookup(query):
+    """
+    Try to answer a pricing question without an LLM.
+
+    Input:
+        query (str): user's question
+    Output:
+        output (dict) with "source" and "answer", or None to fall through
+    """
+    try:
+        output = get_price_resolver().resolve(query)
+    except Exception:
+        # The lookup is only a shortcut; the query engine still answers.
+        logging.exception("Price lookup failed, falling back to the query engine")
+        return None
+    if output is not None:
+        logging.info("Answered price lookup without an LLM: %s", query)
+    return output
@@ -0,0 +1,126 @@
+"""
+This script is to place Amazon Bedrock prompt-cache checkpoints after the static
+prompt prefixes and to log how many input tokens they save.
+
+A checkpoint marks the end of a prompt prefix that is identical across requests
+(system prompt, few-shot examples, tool specs, table schemas). Bedrock caches
+the prefix for a few minutes; later requests read it from the cache at a
+fraction of the input-token price and with a shorter time to first token.
+Prefixes shorter than the model's minimum cacheable length are processed
+normally, and the logged cache token counts stay at zero.
+
+Checkpoints are enabled per stage with PROMPT_CACHE_STAGES, a comma-separated
+subset of "intent", "sql" and "agent" (all by default, "none" disables them).
+"""
+
+import logging
+import os
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events.llm import LLMChatEndEvent
+
+PROMPT_CACHE_STAGES = frozenset(
+    stage.strip()
+    for stage in os.environ.get("PROMPT_CACHE_STAGES", "intent,sql,agent")
+    .lower()
+    .split(",")
+    if stage.strip() and stage.strip() != "none"
+)
+
+
+def is_prompt_cache_enabled(stage):
+    """
+    Whether prompt-cache checkpoints are placed for the given stage.
+    """
+    return stage in PROMPT_CACHE_STAGES
+
+
+def cache_checkpoint(text, stage):
+    """
+    Message content ending with a cache checkpoint, when enabled for the stage.
+
+    Inputs:
+        text (str): static message text
+        stage (str): pipeline stage, e.g. "intent"
+    Output:
+        list of content blocks with a checkpoint, or the text unchanged
+    """
+    if not is_prompt_cache_enabled(stage):
+        return text
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+
+def log_cache_usage(stage, input_tokens, cache_read, cache_write):
+    logging.info(
+        "Prompt cache for %s: %s input tokens, %s read from cache, %s written to cache",
+        stage,
+        input_tokens,
+        cache_read,
+        cache_write,
+    )
+
+
+class PromptCacheUsageLogger(BaseCallbackHandler):
+    """
+    LangChain callback logging the cache read and write tokens of each response.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def on_llm_end(self, response, **kwargs: Any) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None)
+                if not usage:
+                    continue
+                details = usage.get("input_token_details") or {}
+                log_cache_usage(
+                    self.stage,
+                    usage.get("input_tokens", 0),
+                    details.get("cache_read", 0),
+                    details.get("cache_creation", 0),
+                )
+
+
+class LlamaIndexCacheUsageLogger(BaseEventHandler):
+    """
+    llama-index event handler logging the cache tokens of BedrockConverse chats.
+    """
+
+    stage: str = "sql"
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LlamaIndexCacheUsageLogger"
+
+    def handle(self, event, **kwargs) -> None:
+        if not isinstance(event, LLMChatEndEvent) or event.response is None:
+            return
+        usage = event.response.additional_kwargs or {}
+        if "cache_read_input_tokens" not in usage:
+            return
+        log_cache_usage(
+            self.stage,
+            usage.get("prompt_tokens", 0),
+            usage.get("cache_read_input_tokens", 0),
+            usage.get("cache_creation_input_tokens", 0),
+        )
+
+
+_llama_index_logger = None
+
+
+def register_llama_index_cache_logger(stage="sql"):
+    """
+    Log the cache usage of every llama-index LLM chat, once per container.
+    """
+    global _llama_index_logger
+    if _llama_index_logger is None:
+        _llama_index_logger = LlamaIndexCacheUsageLogger(stage=stage)
+        get_dispatcher().add_event_handler(_llama_index_logger)
+    return _llama_index_logger
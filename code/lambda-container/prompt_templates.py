@@ -26,6 +26,12 @@ RAG_TEMPLATE = """
     {context}
     </context>
 
+    Here is the question:
+
+    <question>
+    {question}
+    </question>
+
 """
 
 # prompts for pricing details retrieval
@@ -65,3 +71,15 @@ RESPONSE_TEMPLATE_STR = """If the <SQL Response> below contains data, then given
     If the final answer contains <dollar_sign>$</dollar_sign>, ADD '\' ahead of each <dollar_sign>$</dollar_sign>.
 
     Response: """
+
+# prompt for the agent's final answer once its step or time budget is spent
+AGENT_FINAL_ANSWER_TEMPLATE = """You have run out of time to call tools. Answer the question below using only the tool results gathered so far.
+If they are not enough to answer, say which information is missing.
+
+<question>{question}</question>
+
+<tool_results>
+{evidence}
+</tool_results>
+
+Answer in JSON format with the keys "text" and "source", following the guidelines above."""
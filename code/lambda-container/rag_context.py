@@ -0,0 +1,189 @@
+"""
+This script is to build the context of the RAG prompt from the Kendra excerpts.
+
+Concatenating the excerpts of every retrieved document as they come repeats
+near-identical passages and spends input tokens on weakly related ones. The
+context builder instead:
+1. drops near-duplicate excerpts, whose word shingles have a Jaccard similarity
+   of at least RAG_DUPLICATE_THRESHOLD, keeping the one Kendra ranked higher
+2. reranks the rest with BM25 against the question, on their titles and
+   excerpts; Kendra's order breaks ties
+3. cuts the ranking at the largest score gap, when that gap is at least
+   RAG_SCORE_GAP of the top score, keeping at least RAG_MIN_EXCERPTS
+4. packs the excerpts, each labelled with its number and title, up to
+   RAG_CONTEXT_MAX_TOKENS, truncating the last one that does not fit
+The documents packed are also the sources listed with the answer. Set
+RAG_CONTEXT_BUILDER=false to concatenate the excerpts as before, e.g. to compare
+input tokens and latency with the benchmark.
+"""
+
+import logging
+import math
+import os
+import re
+from collections import Counter
+
+RAG_CONTEXT_BUILDER = os.environ.get("RAG_CONTEXT_BUILDER", "true").lower() == "true"
+RAG_CONTEXT_MAX_TOKENS = int(os.environ.get("RAG_CONTEXT_MAX_TOKENS", "600"))
+RAG_DUPLICATE_THRESHOLD = float(os.environ.get("RAG_DUPLICATE_THRESHOLD", "0.7"))
+RAG_SCORE_GAP = float(os.environ.get("RAG_SCORE_GAP", "0.4"))
+RAG_MIN_EXCERPTS = int(os.environ.get("RAG_MIN_EXCERPTS", "2"))
+# An excerpt is only truncated to fit when this many tokens of it still fit
+RAG_MIN_EXCERPT_TOKENS = 40
+# Same estimate as langchain's count_tokens_approximately
+CHARS_PER_TOKEN = 4.0
+SHINGLE_SIZE = 3
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it of on or "
+    "that the this to what when where which who why with you your".split()
+)
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _words(text):
+    return [w for w in WORD_PATTERN.findall(text.lower()) if w not in STOP_WORDS]
+
+
+def _excerpt(doc):
+    return " ".join((doc.metadata.get("excerpt") or doc.page_content).split())
+
+
+def _title(doc):
+    return " ".join(doc.metadata.get("title", "").split())
+
+
+def _shingles(text):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {
+        tuple(words[i : i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def drop_near_duplicates(docs, threshold=RAG_DUPLICATE_THRESHOLD):
+    """
+    Keep the first of the documents whose excerpts are near-duplicates.
+    """
+    kept, kept_shingles = [], []
+    for doc in docs:
+        shingles = _shingles(_excerpt(doc))
+        if any(
+            len(shingles & other) / len(shingles | other) >= threshold
+            for other in kept_shingles
+        ):
+            continue
+        kept.append(doc)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def bm25_scores(query, texts, k1=BM25_K1, b=BM25_B):
+    """
+    BM25 score of each text for the query, the texts being the whole corpus.
+    """
+    terms = set(_words(query))
+    documents = [Counter(_words(text)) for text in texts]
+    if not terms or not documents:
+        return [0.0] * len(texts)
+    lengths = [sum(counts.values()) for counts in documents]
+    average_length = sum(lengths) / len(lengths) or 1.0
+    scores = []
+    for counts, length in zip(documents, lengths):
+        score = 0.0
+        for term in terms:
+            frequency = counts.get(term, 0)
+            if not frequency:
+                continue
+            containing = sum(1 for other in documents if term in other)
+            idf = math.log(1 + (len(documents) - containing + 0.5) / (containing + 0.5))
+            score += idf * (
+                frequency
+                * (k1 + 1)
+                / (frequency + k1 * (1 - b + b * length / average_length))
+            )
+        scores.append(score)
+    return scores
+
+
+def cut_at_score_gap(scores, min_kept=RAG_MIN_EXCERPTS, gap=RAG_SCORE_GAP):
+    """
+    Number of documents to keep from scores sorted best first.
+
+    Keeps everything unless the largest drop between consecutive scores is at
+    least gap times the top score; then keeps the documents before the drop,
+    and at least min_kept.
+    """
+    if len(scores) <= min_kept or scores[0] <= 0:
+        return len(scores)
+    drop, index = max(
+        ((scores[i - 1] - scores[i], i) for i in range(1, len(scores))),
+        key=lambda item: (item[0], -item[1]),
+    )
+    return max(index, min_kept) if drop >= gap * scores[0] else len(scores)
+
+
+def _truncate(text, max_tokens):
+    limit = int(max_tokens * CHARS_PER_TOKEN) - 4
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + " ..."
+
+
+def pack_excerpts(docs, max_tokens=RAG_CONTEXT_MAX_TOKENS):
+    """
+    Label the excerpts with their titles and pack them up to max_tokens.
+
+    Output:
+        (context, docs): the packed context, and the documents it holds
+    """
+    sections, packed = [], []
+    left = max_tokens
+    for doc in docs:
+        label = f"[{len(packed) + 1}] {_title(doc)}\n"
+        excerpt = _excerpt(doc)
+        room = left - estimate_tokens(label)
+        if estimate_tokens(excerpt) > room:
+            if room < RAG_MIN_EXCERPT_TOKENS:
+                break
+            excerpt = _truncate(excerpt, room)
+        section = label + excerpt
+        sections.append(section)
+        packed.append(doc)
+        left -= estimate_tokens(section) + 1
+    return "\n\n".join(sections), packed
+
+
+def build_context(query, docs, max_tokens=RAG_CONTEXT_MAX_TOKENS):
+    """
+    Build the RAG context of a question from its retrieved documents.
+
+    Inputs:
+        query (str): user's question
+        docs (list): Kendra documents, best first
+        max_tokens (int): estimated token budget of the context
+    Output:
+        (context, docs): the context, and the documents it holds in its order
+    """
+    candidates = drop_near_duplicates(docs)
+    scores = bm25_scores(
+        query, [f"{_title(doc)} {_excerpt(doc)}" for doc in candidates]
+    )
+    order = sorted(range(len(candidates)), key=lambda i: (-scores[i], i))
+    kept = cut_at_score_gap([scores[i] for i in order])
+    context, packed = pack_excerpts([candidates[i] for i in order[:kept]], max_tokens)
+    logging.info(
+        "RAG context: %d of %d excerpts, %d duplicates, ~%d tokens",
+        len(packed),
+        len(docs),
+        len(docs) - len(candidates),
+        estimate_tokens(context),
+    )
+    return context, packed
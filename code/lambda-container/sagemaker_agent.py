@@ -1,25 +1,154 @@
+import contextvars
+import json
 import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional
 
-from sagemaker_pricing import query_engine
-from sagemaker_dg_rag import doc_retrieval
-from utils import parse_agent_output
+from sagemaker_pricing import query_pricing, query_pricing_evidence
+from sagemaker_dg_rag import doc_evidence, doc_retrieval
+from deadline import DeadlineExceeded, remaining
+from llm_usage import track_usage
+from metrics import span
+from training_estimator import get_training_estimator
+from utils import normalize_question, parse_agent_output
 
 from langgraph.prebuilt import create_react_agent
+from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage
 from langchain_core.tools import tool
+from prompt_cache import cache_checkpoint
+from prompt_templates import AGENT_FINAL_ANSWER_TEMPLATE
+
+# Budgets of one agent call. Once the agent has made AGENT_MAX_STEPS model
+# calls, or AGENT_MAX_SECONDS have passed, it stops calling tools and answers
+# from the tool results gathered so far. The budgets are checked once the tools
+# requested by a model call have run, so the tool calls of the last step are
+# never thrown away, and a step that is already running is allowed to finish.
+AGENT_MAX_STEPS = int(os.environ.get("AGENT_MAX_STEPS", "6"))
+AGENT_MAX_SECONDS = float(os.environ.get("AGENT_MAX_SECONDS", "60"))
+# Time kept for the final answer before the request deadline (see deadline.py);
+# the time budget of the agent never runs past it. Without time left for a
+# final answer, the agent returns the tool results gathered so far.
+AGENT_FINAL_ANSWER_SECONDS = float(os.environ.get("AGENT_FINAL_ANSWER_SECONDS", "15"))
+PARTIAL_ANSWER_INTRO = (
+    "There was not enough time to complete the answer. These are the results "
+    "gathered so far:"
+)
+
+# What the tools return to the agent:
+#   "answer"   - a generated answer: the RAG answer for documentation
+#                questions and the synthesized answer for pricing questions
+#   "evidence" - the raw evidence: ranked Kendra excerpts with titles and URLs,
+#                and the executed SQL with its result rows. The agent writes
+#                the only answer, saving one or two LLM calls per tool call.
+AGENT_TOOL_MODE = os.environ.get("AGENT_TOOL_MODE", "answer").lower()
+
+# Tool results of the current agent call, keyed by tool and normalized input
+_tool_calls = contextvars.ContextVar("agent_tool_calls", default=None)
+_tool_calls_lock = threading.Lock()
+
+
+def _memoized_tool_call(name, query, func):
+    """
+    Run a tool once per distinct input within the current agent call.
+
+    Identical calls issued in parallel wait for the first one instead of
+    running again. Failed calls are not memoized.
+    """
+    calls = _tool_calls.get()
+    if calls is None:
+        return func()
+    key = (name, normalize_question(query))
+    with _tool_calls_lock:
+        future = calls.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = calls[key] = Future()
+    if not is_owner:
+        logging.info("Reusing the %s result for %r", name, query)
+        return future.result()
+    try:
+        result = func()
+    except Exception as e:
+        with _tool_calls_lock:
+            calls.pop(key, None)
+        future.set_exception(e)
+        raise
+    future.set_result(result)
+    return result
 
 
 @tool
 def sagemaker_developer_guide(query: str) -> str:
     """Useful for when you need to query the Amazon Kendra index for more information on SageMaker documentation. Input should be a question formatted as a string."""
-    output = doc_retrieval(query)
-    return str(output)
+    return _memoized_tool_call(
+        "sagemaker_developer_guide", query, lambda: str(doc_retrieval(query))
+    )
 
 
 @tool
 def sagemaker_pricing_data_retrieval(query: str) -> str:
     """Useful for when you need to have access to pricing table data. Input should be a question."""
-    response = query_engine.query(query)
-    return response.response
+    return _memoized_tool_call(
+        "sagemaker_pricing_data_retrieval",
+        query,
+        lambda: query_pricing(query)["answer"],
+    )
+
+
+@tool("sagemaker_developer_guide")
+def sagemaker_developer_guide_evidence(query: str) -> str:
+    """Useful for when you need to query the Amazon Kendra index for more information on SageMaker documentation. Input should be a question formatted as a string. Returns the most relevant documentation excerpts, best first, with their titles and URLs."""
+    return _memoized_tool_call(
+        "sagemaker_developer_guide",
+        query,
+        lambda: json.dumps(doc_evidence(query), indent=1),
+    )
+
+
+@tool("sagemaker_pricing_data_retrieval")
+def sagemaker_pricing_data_retrieval_evidence(query: str) -> str:
+    """Useful for when you need to have access to pricing table data. Input should be a question. Returns the SQL query that was run and its result rows."""
+    return _memoized_tool_call(
+        "sagemaker_pricing_data_retrieval",
+        query,
+        lambda: json.dumps(query_pricing_evidence(query), default=str),
+    )
+
+
+@tool(parse_docstring=True)
+def sagemaker_training_estimator(
+    gpu_hours: float,
+    budget_usd: Optional[float] = None,
+    deadline_hours: Optional[float] = None,
+    min_accelerator_memory_gib: float = 0.0,
+    min_memory_gib: float = 0.0,
+    require_cuda: bool = False,
+    pricing: str = "training",
+) -> str:
+    """Useful for when you need to estimate how long and how much a training job takes on SageMaker instances, or which instances fit a budget or a deadline. Scores every instance in one call and returns the feasible instances from the cheapest to the fastest, with their hours and cost.
+
+    Args:
+        gpu_hours: size of the workload in NVIDIA V100 GPU-hours; estimate it from the model and the data when the question does not give it, and state that assumption in the answer
+        budget_usd: most the job may cost in USD
+        deadline_hours: most the job may take in hours
+        min_accelerator_memory_gib: memory each GPU needs in GiB, e.g. 16 for Stable Diffusion fine-tuning
+        min_memory_gib: instance memory the job needs in GiB
+        require_cuda: only NVIDIA GPUs, for code that needs CUDA
+        pricing: "training" for training jobs, or "inference" for work run on real-time endpoints
+    """
+    estimate = get_training_estimator().estimate(
+        gpu_hours,
+        budget_usd=budget_usd,
+        deadline_hours=deadline_hours,
+        min_accelerator_memory_gib=min_accelerator_memory_gib,
+        min_memory_gib=min_memory_gib,
+        require_cuda=require_cuda,
+        pricing=pricing,
+    )
+    return json.dumps(estimate)
 
 
 SYSTEM_PROMPT = """You are an expert in AWS SageMaker services and EC2 pricing.
@@ -28,32 +157,193 @@ You have access to tools for querying SageMaker documentation and pricing data.
 Guidelines:
 - If asked about pricing data such as instance price, compute optimized, memory, accelerated computing, storage, instance features, instance performance etc., use the sagemaker_pricing_data_retrieval tool.
 - Use EC2 instances with GPUs to train deep learning models.
+- For training time, training cost, budget or deadline questions, call the sagemaker_training_estimator tool once instead of looking up instances one at a time.
+- When you need several independent pieces of information, request all the tool calls in the same turn.
 - Do not make up any answer.
 - Format the final text answer in Markdown style, ADD '\\' ahead of each $.
 - Include the source file from the sagemaker_developer_guide tool in the final answer.
 - The final answer format should be in JSON format with the keys as "text" and "source".
-- If the final answer comes only from the "sagemaker_pricing_data_retrieval" tool, set "source" as "[Amazon SageMaker Pricing](https://aws.amazon.com/sagemaker/pricing/)"
+- If the final answer comes only from the "sagemaker_pricing_data_retrieval" or "sagemaker_training_estimator" tools, set "source" as "[Amazon SageMaker Pricing](https://aws.amazon.com/sagemaker/pricing/)"
 """
 
+TOOLS = {
+    "answer": [
+        sagemaker_developer_guide,
+        sagemaker_pricing_data_retrieval,
+        sagemaker_training_estimator,
+    ],
+    "evidence": [
+        sagemaker_developer_guide_evidence,
+        sagemaker_pricing_data_retrieval_evidence,
+        sagemaker_training_estimator,
+    ],
+}
+
+_agents = {}
+_agents_lock = threading.Lock()
+
 
-def agent_call(llm, query):
+def _llm_key(llm):
+    model_id = getattr(llm, "model_id", None)
+    if model_id is None:
+        return id(llm)
+    model_kwargs = json.dumps(getattr(llm, "model_kwargs", None), sort_keys=True)
+    return (type(llm).__name__, model_id, model_kwargs)
+
+
+def get_agent(llm, tool_mode=AGENT_TOOL_MODE):
+    """
+    Return the agent graph for the LLM's configuration, compiling it once.
+
+    Inputs:
+        llm (object): a LLM object, initialized with Amazon Bedrock client
+        tool_mode (str): "answer" or "evidence", see AGENT_TOOL_MODE
+    Output:
+        compiled ReAct agent graph
+    """
+    if tool_mode not in TOOLS:
+        raise ValueError(f"Unsupported agent tool mode: {tool_mode}")
+    key = (_llm_key(llm), tool_mode)
+    with _agents_lock:
+        agent = _agents.get(key)
+        if agent is None:
+            # Bedrock places the tool specs before the system prompt, so a
+            # checkpoint after the system prompt caches both.
+            prompt = SystemMessage(content=cache_checkpoint(SYSTEM_PROMPT, "agent"))
+            agent = create_react_agent(model=llm, tools=TOOLS[tool_mode], prompt=prompt)
+            _agents[key] = agent
+        return agent
+
+
+def _final_answer(llm, query, messages):
+    """
+    Ask the LLM, without tools, for an answer from the tool results so far.
+    """
+    evidence = "\n\n".join(
+        f"<{message.name}>\n{message.content}\n</{message.name}>"
+        for message in messages
+        if isinstance(message, ToolMessage)
+    )
+    prompt = [
+        SystemMessage(content=SYSTEM_PROMPT),
+        HumanMessage(
+            content=AGENT_FINAL_ANSWER_TEMPLATE.format(
+                question=query, evidence=evidence or "No tool results."
+            )
+        ),
+    ]
+    return llm.invoke(prompt).content
+
+
+def _partial_answer(messages):
+    """
+    The tool results gathered so far, as the agent's JSON answer, without an
+    LLM call.
+    """
+    results = [
+        f"**{message.name}**: {message.content}"
+        for message in messages
+        if isinstance(message, ToolMessage)
+    ]
+    if not results:
+        text = "There was not enough time to answer this question."
+    else:
+        text = "\n\n".join([PARTIAL_ANSWER_INTRO, *results])
+    return json.dumps({"text": text, "source": " "})
+
+
+def _run_agent(llm, query, max_steps, max_seconds, tool_mode):
+    """
+    Run the agent step by step until it answers or a budget is spent.
+
+    Output:
+        (final message content, whether the answer is partial)
+    """
+    messages = [HumanMessage(content=query)]
+    try:
+        return _run_agent_steps(llm, messages, max_steps, max_seconds, tool_mode), False
+    except DeadlineExceeded:
+        logging.warning("Agent ran out of time, returning the tool results so far")
+        return _partial_answer(messages), True
+
+
+def _run_agent_steps(llm, messages, max_steps, max_seconds, tool_mode):
+    query = messages[0].content
+    agent = get_agent(llm, tool_mode)
+    deadline = time.monotonic() + max_seconds
+    steps = 0
+    config = {"recursion_limit": 2 * max_steps + 2}
+    for update in agent.stream(
+        {"messages": list(messages)}, config=config, stream_mode="updates"
+    ):
+        for node, state in update.items():
+            new_messages = (state or {}).get("messages", [])
+            messages.extend(new_messages)
+            if node != "agent":
+                continue
+            steps += 1
+            if new_messages and not getattr(new_messages[-1], "tool_calls", None):
+                logging.info("Agent answered after %d steps", steps)
+                return new_messages[-1].content
+        if "tools" not in update:
+            continue
+        if steps >= max_steps or time.monotonic() >= deadline:
+            logging.warning(
+                "Agent budget spent after %d steps and %.1f s, answering from "
+                "the tool results so far",
+                steps,
+                max_seconds - (deadline - time.monotonic()),
+            )
+            return _final_answer(llm, query, messages)
+    return messages[-1].content
+
+
+@span("agent_call")
+def agent_call(llm, query, max_steps=None, max_seconds=None, tool_mode=None):
     """
     Agent with access to document retrieval tool and pricing data retrieval tool.
 
     Inputs:
         llm (object): a LLM object, initialized with Amazon Bedrock client
         query (str): question from the user.
+        max_steps (int): model calls allowed before the agent must answer,
+            AGENT_MAX_STEPS by default
+        max_seconds (float): time allowed before the agent must answer,
+            AGENT_MAX_SECONDS by default, and at most the time left before
+            the request deadline minus AGENT_FINAL_ANSWER_SECONDS
+        tool_mode (str): "answer" or "evidence", AGENT_TOOL_MODE by default
     Output:
-        output (dict): answer to the input question.
+        output (dict): answer to the input question, with "degraded": True
+        when it only lists the tool results gathered before the deadline
     """
-    tools = [sagemaker_developer_guide, sagemaker_pricing_data_retrieval]
-
-    agent = create_react_agent(model=llm, tools=tools, prompt=SYSTEM_PROMPT)
-    result = agent.invoke({"messages": [("user", query)]})
+    max_steps = max_steps or AGENT_MAX_STEPS
+    max_seconds = max_seconds or AGENT_MAX_SECONDS
+    left = remaining()
+    if left is not None:
+        max_seconds = max(0.0, min(max_seconds, left - AGENT_FINAL_ANSWER_SECONDS))
+    tool_mode = tool_mode or AGENT_TOOL_MODE
+    token = _tool_calls.set({})
+    start = time.perf_counter()
+    try:
+        with track_usage() as usage:
+            output_text, partial = _run_agent(
+                llm, query, max_steps, max_seconds, tool_mode
+            )
+    finally:
+        _tool_calls.reset(token)
+    # Compare the tool modes on these figures: the evidence tools make no
+    # LLM calls of their own, but return longer tool results to the agent.
+    logging.info(
+        "Agent (%s tools) answered in %.2f s, LLM usage: %s",
+        tool_mode,
+        time.perf_counter() - start,
+        usage.summary(),
+    )
 
-    output_text = result["messages"][-1].content
     logging.debug("Agent output: %s", output_text)
     parsed = parse_agent_output(output_text)
     logging.debug("Parsed agent output: %s", parsed)
     output = {"source": parsed["source"], "answer": parsed["text"]}
+    if partial:
+        output["degraded"] = True
     return output
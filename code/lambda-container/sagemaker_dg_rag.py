@@ -1,57 +1,236 @@
+import contextvars
+import functools
 import json
+import os
+import re
+import threading
+import time
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
 
 import logging
 from operator import itemgetter
-from langchain_core.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
-from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.prompts import (
+    ChatPromptTemplate,
+    HumanMessagePromptTemplate,
+    MessagesPlaceholder,
+)
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.messages import SystemMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from langchain_community.retrievers import AmazonKendraRetriever as KendraRetriever
+from caching import LRUTTLCache
 from connections import Connections
-from utils import get_by_session_id
+from deadline import DeadlineExceeded, check, expired
+from metrics import span
+from model_cascade import (
+    CASCADE_FALLBACK_MODEL,
+    CASCADE_FIRST_MODEL,
+    get_cascade,
+    is_cascade_enabled,
+    is_refusal,
+)
+from rag_context import RAG_CONTEXT_BUILDER, build_context
+from session_memory import get_by_session_id
 from prompt_templates import RAG_SYS, RAG_TEMPLATE
 
 
 s3_resource = Connections.s3_resource
 
+KENDRA_MIN_SCORE_CONFIDENCE = 0.1
+# Kendra results per (query, top_k, min_score_confidence, index id). Every
+# Kendra Query call is billed and rate limited, and the agent can ask the
+# documentation tool the same question several times in one request. The TTL
+# bounds how long results survive a data source sync in containers that do not
+# call invalidate_retrieval_cache.
+retrieval_cache = LRUTTLCache(
+    maxsize=int(os.environ.get("KENDRA_CACHE_SIZE", "512")),
+    ttl=float(os.environ.get("KENDRA_CACHE_TTL_SECONDS", "3600")),
+    name="kendra",
+)
+_retrievers = {}
+_retrievers_lock = threading.Lock()
 
-def source_link(input_source):
+# Written by the CDK stack from assets/kendra_documents/sm_dg.zip, see
+# code/source_manifest.py
+SOURCE_MANIFEST_PATH = os.environ.get(
+    "SOURCE_MANIFEST_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "source_manifest.json"),
+)
+# The page URL is the first field of every document, so a miss only reads the
+# head of the object instead of the whole document.
+SOURCE_URL_RANGE_BYTES = 4096
+SOURCE_URL_PATTERN = re.compile(r'"Url"\s*:\s*"([^"]+)"')
+
+# Links resolved from S3 for documents missing from the manifest
+source_link_cache = LRUTTLCache(
+    maxsize=int(os.environ.get("SOURCE_LINK_CACHE_SIZE", "4096")), name="source_link"
+)
+_link_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="source-link")
+# Runs resolve_source_links next to answer generation; kept apart from
+# _link_executor so its tasks never wait on their own pool.
+_resolve_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sources")
+
+# Time a generated answer needs; with less time left before the request
+# deadline (see deadline.py), the Kendra excerpts are returned instead
+RAG_MIN_SECONDS = float(os.environ.get("RAG_MIN_SECONDS", "10"))
+EXCERPTS_INTRO = (
+    "There was not enough time to write an answer. These are the most relevant "
+    "excerpts of the Amazon SageMaker Developer Guide:"
+)
+CUT_SHORT_INTRO = (
+    "The answer was cut short for lack of time. These are the most relevant "
+    "excerpts of the Amazon SageMaker Developer Guide:"
+)
+
+
+@functools.lru_cache(maxsize=1)
+def load_source_manifest(path=SOURCE_MANIFEST_PATH):
     """
-    Retrieve source url of relevant documents
+    Load the object key -> {"url", "title"} manifest once per container.
     """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        logging.warning("No source manifest at %s, links are read from S3", path)
+        return {}
+    logging.info("Loaded %d source links from %s", len(manifest), path)
+    return manifest
+
+
+def _split_source_uri(input_source):
     string = input_source.partition(f"s3.{Connections.region_name}.amazonaws.com/")[2]
     bucket = string.partition("/")[0]
     obj = string.partition("/")[2]
+    return bucket, obj
+
+
+def _read_source_link(bucket, obj):
     file = s3_resource.Object(bucket, obj)
+    head = file.get(Range=f"bytes=0-{SOURCE_URL_RANGE_BYTES - 1}")["Body"].read()
+    match = SOURCE_URL_PATTERN.search(head.decode("utf-8", errors="ignore"))
+    if match:
+        return json.loads(f'"{match.group(1)}"')
     body = file.get()["Body"].read()
-    res = json.loads(body)
-    source_link = res["Url"]
-    return source_link
+    return json.loads(body)["Url"]
+
 
+@span("source_link")
+def source_link(input_source):
+    """
+    Retrieve source url of relevant documents
 
-def doc_retrieval(query, K=5):
+    The manifest is checked first, then the links already resolved from S3.
     """
-    Answer user's query about Amazon SageMaker
+    bucket, obj = _split_source_uri(input_source)
+    manifest = load_source_manifest()
+    entry = manifest.get(obj) or manifest.get(unquote(obj))
+    if entry:
+        return entry["url"]
+
+    link = source_link_cache.get(input_source)
+    if link is None:
+        link = _read_source_link(bucket, obj)
+        source_link_cache.set(input_source, link)
+    return link
+
+
+def resolve_source_links(input_sources):
+    """
+    Resolve the source urls of several documents, reading misses from S3 concurrently.
+
+    Input:
+        input_sources (list): S3 document URIs from the Kendra results
+    Output:
+        dict: document URI -> source url
+    """
+    unique_sources = list(OrderedDict.fromkeys(input_sources))
+    futures = [
+        _link_executor.submit(contextvars.copy_context().run, source_link, source)
+        for source in unique_sources
+    ]
+    links = {
+        source: future.result() for source, future in zip(unique_sources, futures)
+    }
+    logging.debug("Source link cache: %s", source_link_cache.stats())
+    return links
+
+
+def get_kendra_retriever(K=5, min_score_confidence=KENDRA_MIN_SCORE_CONFIDENCE):
+    """
+    Return the container-wide Kendra retriever for the given settings.
+    """
+    key = (Connections.kendra_rawdata_index_id, K, min_score_confidence)
+    retriever = _retrievers.get(key)
+    if retriever is None:
+        with _retrievers_lock:
+            retriever = _retrievers.get(key)
+            if retriever is None:
+                retriever = KendraRetriever(
+                    client=Connections.kendra_client,
+                    top_k=K,
+                    index_id=Connections.kendra_rawdata_index_id,
+                    min_score_confidence=min_score_confidence,
+                )
+                _retrievers[key] = retriever
+    return retriever
+
+
+def invalidate_retrieval_cache():
+    """
+    Drop every cached Kendra result, e.g. after a Kendra data source sync.
+    """
+    logging.info("Invalidating Kendra retrieval cache: %s", retrieval_cache.stats())
+    retrieval_cache.invalidate()
+
+
+def retrieve_documents(query, K=5, min_score_confidence=KENDRA_MIN_SCORE_CONFIDENCE):
+    """
+    Retrieve the documents relevant to user's query from Amazon Kendra
+
+    Results are cached per (query, K, min_score_confidence, index id).
     """
-    # instantiate retriever
-    retriever = KendraRetriever(
-        kclient=Connections.kendra_client,
-        top_k=K,
-        index_id=Connections.kendra_rawdata_index_id,
-        min_score_confidence=0.1,
+    key = (query, K, min_score_confidence, Connections.kendra_rawdata_index_id)
+    docs = retrieval_cache.get(key)
+    if docs is not None:
+        logging.info("Cached Kendra retrieval (%s)", retrieval_cache.stats())
+        return list(docs)
+
+    check("kendra_retrieve")
+    retriever = get_kendra_retriever(K, min_score_confidence)
+    start = time.perf_counter()
+    with span("kendra_retrieve"):
+        docs = retriever._get_relevant_documents(query, run_manager=None)
+    logging.info(
+        "Kendra retrieval took %.0f ms (%s)",
+        (time.perf_counter() - start) * 1000,
+        retrieval_cache.stats(),
+    )
+    retrieval_cache.set(key, tuple(docs))
+    return list(docs)
+
+
+def _start_source_links(docs):
+    """
+    Resolve the source links of the documents in the background.
+    """
+    return _resolve_executor.submit(
+        contextvars.copy_context().run,
+        resolve_source_links,
+        [doc.metadata["source"] for doc in docs],
     )
-    docs = retriever._get_relevant_documents(query, run_manager=None)
 
-    # return the top 5 sources
+
+def _format_sources(docs, links):
+    """
+    Format the unique sources as a numbered Markdown list of links.
+    """
     source_list = []
     for i, doc in enumerate(docs):
-        title = doc.metadata["title"]
-        title_without_newlines = title.replace("\n", "")
-        cleaned_title = " ".join(title_without_newlines.split())
-        s3_link = doc.metadata["source"]
-        web_link = source_link(s3_link)
+        cleaned_title = _clean_title(doc.metadata["title"])
+        web_link = links[doc.metadata["source"]]
         source_dict = (cleaned_title, web_link)
         source_list.append(source_dict)
 
@@ -60,38 +239,214 @@ def doc_retrieval(query, K=5):
     refs_str = ""
     for i, x in enumerate(list(unique_sources)):
         refs_str += f"{i + 1}. " + "[" + str(x[0]) + "](%s)" % (x[1]) + "\n\n"
+    return refs_str
 
-    # put the retrieved information in context
-    context = ""
-    for i, doc in enumerate(docs):
-        context += doc.metadata["excerpt"]
 
+def _build_rag_chain(model_name="ClaudeSonnet"):
     prompt = ChatPromptTemplate.from_messages(
         [
             SystemMessage(content=(RAG_SYS)),
+            # earlier turns of the session, trimmed to a token budget
+            MessagesPlaceholder("history"),
             HumanMessagePromptTemplate.from_template(RAG_TEMPLATE),
         ]
     )
-    llm = Connections.get_bedrock_llm(model_name="ClaudeSonnet", max_tokens=1024)
+    llm = Connections.get_bedrock_llm(
+        model_name=model_name, max_tokens=1024, stage="rag"
+    )
     rag_chain = (
         {
             "context": itemgetter("context"),
+            "question": itemgetter("question"),
+            "history": itemgetter("history"),
         }
         | prompt
         | llm
         | StrOutputParser()
     )
+    return rag_chain
+
 
-    rag_chain_with_memory = RunnableWithMessageHistory(
-        rag_chain,
-        get_by_session_id,
-        input_messages_key="question",
-        history_messages_key="history",
+def _generate_answer(chain_input):
+    """
+    Generate the RAG answer, with the cascade's first model when enabled.
+    """
+    if not is_cascade_enabled("rag"):
+        return _build_rag_chain().invoke(chain_input)
+    return get_cascade("rag").run(
+        first=lambda: _build_rag_chain(CASCADE_FIRST_MODEL).invoke(chain_input),
+        fallback=lambda: _build_rag_chain(CASCADE_FALLBACK_MODEL).invoke(chain_input),
+        verify=lambda answer: not is_refusal(answer),
     )
-    answer = rag_chain_with_memory.invoke(
-        {"context": context, "question": query},
-        config={"configurable": {"session_id": "1"}},
+
+
+def _stream_answer(chain_input):
+    """
+    Stream the RAG answer, with the cascade's first model when enabled.
+    """
+    if not is_cascade_enabled("rag"):
+        return _build_rag_chain().stream(chain_input)
+    return get_cascade("rag").stream(
+        first=lambda: _build_rag_chain(CASCADE_FIRST_MODEL).stream(chain_input),
+        fallback=lambda: _build_rag_chain(CASCADE_FALLBACK_MODEL).stream(chain_input),
+        rejected=is_refusal,
     )
+
+
+def _excerpts_answer(docs, intro=EXCERPTS_INTRO):
+    """
+    Answer with the Kendra excerpts themselves, without an LLM.
+    """
+    excerpts = [
+        f"{i}. **{_clean_title(doc.metadata['title'])}**: "
+        + " ".join((doc.metadata.get("excerpt") or doc.page_content).split())
+        for i, doc in enumerate(docs, start=1)
+    ]
+    return "\n\n".join([intro, *excerpts])
+
+
+def _save_turn(session_id, query, answer):
+    """
+    Append the question and its final answer to the session history.
+    """
+    if session_id is not None:
+        get_by_session_id(session_id).add_messages(
+            [HumanMessage(content=query), AIMessage(content=answer)]
+        )
+
+
+def _prepare_rag(query, K, docs, session_id):
+    if docs is None:
+        docs = retrieve_documents(query, K)
+
+    # put the retrieved information in context
+    if RAG_CONTEXT_BUILDER:
+        context, docs = build_context(query, docs)
+    else:
+        context = ""
+        for i, doc in enumerate(docs):
+            context += doc.metadata["excerpt"]
+
+    # resolve the source links while the answer is generated
+    links_future = _start_source_links(docs)
+
+    # earlier turns of the session; the answer is added once it is final, so
+    # that a rejected cascade answer never reaches the history
+    history = get_by_session_id(session_id).messages if session_id else []
+    chain_input = {"context": context, "question": query, "history": history}
+    return docs, links_future, chain_input
+
+
+def _clean_title(title):
+    return " ".join(title.replace("\n", "").split())
+
+
+def doc_evidence(query, K=5):
+    """
+    Ranked Kendra excerpts for a query, without generating an answer
+
+    Input:
+        query (str): question to retrieve documents for
+        K (int): number of documents
+    Output:
+        list of dicts with the rank, title, url and excerpt of each document
+    """
+    docs = retrieve_documents(query, K=K)
+    links = resolve_source_links([doc.metadata["source"] for doc in docs])
+    return [
+        {
+            "rank": rank,
+            "title": _clean_title(doc.metadata["title"]),
+            "url": links[doc.metadata["source"]],
+            "excerpt": " ".join(
+                (doc.metadata.get("excerpt") or doc.page_content).split()
+            ),
+        }
+        for rank, doc in enumerate(docs, start=1)
+    ]
+
+
+@span("doc_retrieval")
+def doc_retrieval(query, K=5, docs=None, session_id=None):
+    """
+    Answer user's query about Amazon SageMaker
+
+    Inputs:
+        query (str): question from the user
+        K (int): number of documents to retrieve
+        docs (list): documents already retrieved for the query, if any
+        session_id (str): chat session whose history the answer follows;
+            None (e.g. agent tool calls) answers without history
+    Output:
+        output (dict): {"source", "answer"}, and "degraded": True when there
+        was no time left to generate the answer (the excerpts are returned)
+    """
+    docs, links_future, chain_input = _prepare_rag(query, K, docs, session_id)
+    degraded = expired(RAG_MIN_SECONDS)
+    if not degraded:
+        try:
+            answer = _generate_answer(chain_input)
+        except DeadlineExceeded:
+            degraded = True
+    if degraded:
+        logging.warning("Out of time, answering with the Kendra excerpts")
+        answer = _excerpts_answer(docs)
+    else:
+        _save_turn(session_id, query, answer)
+
+    # return the sources of the context
+    refs_str = _format_sources(docs, links_future.result())
     output = {"source": refs_str, "answer": answer}
+    if degraded:
+        output["degraded"] = True
     logging.debug(output)
     return output
+
+
+def doc_retrieval_stream(query, K=5, docs=None, session_id=None):
+    """
+    Answer user's query about Amazon SageMaker, streaming the answer as it is generated
+
+    Inputs:
+        query (str): question from the user
+        K (int): number of documents to retrieve
+        docs (list): documents already retrieved for the query, if any
+        session_id (str): chat session whose history the answer follows;
+            None (e.g. agent tool calls) answers without history
+    Output:
+        generator of frames: {"type": "delta", "text"} for each chunk of the
+        answer, then one {"type": "source", "source"} frame, with
+        "degraded": True when the answer was cut short by the request deadline
+    """
+    with span("doc_retrieval_stream"):
+        docs, links_future, chain_input = _prepare_rag(query, K, docs, session_id)
+        answer = ""
+        degraded = expired(RAG_MIN_SECONDS)
+        try:
+            if not degraded:
+                for chunk in _stream_answer(chain_input):
+                    if chunk:
+                        answer += chunk
+                        yield {"type": "delta", "text": chunk}
+                    if expired():
+                        degraded = True
+                        break
+        except DeadlineExceeded:
+            degraded = True
+        if degraded:
+            logging.warning("Out of time, answering with the Kendra excerpts")
+            if answer:
+                text = "\n\n" + _excerpts_answer(docs, CUT_SHORT_INTRO)
+            else:
+                text = _excerpts_answer(docs)
+            answer += text
+            yield {"type": "delta", "text": text}
+        else:
+            _save_turn(session_id, query, answer)
+
+        refs_str = _format_sources(docs, links_future.result())
+        logging.debug({"source": refs_str, "answer": answer})
+        frame = {"type": "source", "source": refs_str}
+        if degraded:
+            frame["degraded"] = True
+        yield frame
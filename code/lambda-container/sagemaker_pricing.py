@@ -1,4 +1,10 @@
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
+import warnings
 from llama_index.core import Settings
 from llama_index.core import SQLDatabase, VectorStoreIndex
 from llama_index.core.objects import (
@@ -7,13 +13,35 @@ from llama_index.core.objects import (
     SQLTableSchema,
 )
 from llama_index.llms.bedrock_converse import BedrockConverse
-from llama_index.core.prompts import PromptTemplate
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.prompts import ChatPromptTemplate, PromptTemplate
 from llama_index.core.indices.struct_store import SQLTableRetrieverQueryEngine
+from llama_index.core.indices.struct_store.sql_retriever import NLSQLRetriever
 from llama_index.embeddings.langchain import LangchainEmbedding
 from langchain_aws import BedrockEmbeddings
 from sqlalchemy import create_engine
 from prompt_templates import SQL_TEMPLATE_STR, RESPONSE_TEMPLATE_STR
+from pricing_data import create_pricing_sqlite_engine
+from pricing_lookup import resolve_price_lookup
 from connections import Connections
+from deadline import cancel_sql_on_deadline, expired
+from prompt_cache import is_prompt_cache_enabled, register_llama_index_cache_logger
+from llm_usage import register_llama_index_usage_handler
+from metrics import instrument_sql_engine, span
+from model_cascade import (
+    CASCADE_FIRST_MODEL,
+    get_cascade,
+    is_cascade_enabled,
+    sql_result_verified,
+)
+from pricing_cache import (
+    PRICING_CACHE_ENABLED,
+    MemoizedSQLDatabase,
+    MemoizedSQLQueryEngine,
+    SQLRetrieverQueryEngine,
+    pricing_query_cache,
+)
+from utils import timed
 
 
 table_details = {
@@ -24,11 +52,117 @@ table_details = {
 }
 
 
+EMBEDDING_MODEL_ID = "cohere.embed-v4:0"
+
+# Directory holding the prebuilt table-schema vector index. It is produced by
+# build_table_index.py from the pricing CSVs before the container image is
+# built, and copied into the image together with the code; cdk synth fails when
+# it is missing.
+TABLE_INDEX_DIR = os.environ.get(
+    "TABLE_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "table_index"),
+)
+TABLE_INDEX_MANIFEST = "manifest.json"
+
 SQL_PROMPT = PromptTemplate(SQL_TEMPLATE_STR)
 RESPONSE_PROMPT = PromptTemplate(RESPONSE_TEMPLATE_STR)
+SQL_QUESTION_MARKER = "Question: {query_str}"
 
 
-def create_sql_engine():
+def create_cached_sql_prompt(template_str):
+    """
+    Split the text-to-SQL prompt into a static system message (instructions,
+    examples and table schemas) and a user message with the question, so the
+    system message can end with a prompt cache checkpoint.
+
+    Input:
+        template_str (str): text-to-SQL template ending with the question
+    Output:
+        ChatPromptTemplate, or a PromptTemplate if the template has no
+        trailing question to split on
+    """
+    prefix, marker, suffix = template_str.rpartition(SQL_QUESTION_MARKER)
+    if not marker:
+        return PromptTemplate(template_str)
+    return ChatPromptTemplate(
+        message_templates=[
+            ChatMessage(role=MessageRole.SYSTEM, content=prefix.rstrip()),
+            ChatMessage(role=MessageRole.USER, content=marker + suffix),
+        ]
+    )
+
+
+class SortedTableRetriever:
+    """
+    Return the retrieved table schemas in name order.
+
+    Every table fits in similarity_top_k, so retrieval only decides their
+    order; a fixed order keeps the schema text, and so the cached prompt
+    prefix, identical across questions.
+    """
+
+    def __init__(self, retriever):
+        self._retriever = retriever
+
+    def retrieve(self, query):
+        return sorted(self._retriever.retrieve(query), key=lambda t: t.table_name)
+
+    async def aretrieve(self, query):
+        tables = await self._retriever.aretrieve(query)
+        return sorted(tables, key=lambda t: t.table_name)
+
+
+class CascadeNLSQLRetriever(NLSQLRetriever):
+    """
+    Text-to-SQL retriever trying the cascade's first model before its own LLM.
+
+    The SQL of the first model is kept when it executes and returns rows;
+    otherwise this retriever's LLM writes it again (see model_cascade.py).
+    """
+
+    def __init__(self, sql_database, first_llm, cascade, **kwargs):
+        super().__init__(sql_database, **kwargs)
+        self._first_retriever = NLSQLRetriever(
+            sql_database, **{**kwargs, "llm": first_llm}
+        )
+        self._cascade = cascade
+
+    def retrieve_with_metadata(self, str_or_query_bundle):
+        return self._cascade.run(
+            first=lambda: self._first_retriever.retrieve_with_metadata(
+                str_or_query_bundle
+            ),
+            fallback=lambda: super(CascadeNLSQLRetriever, self).retrieve_with_metadata(
+                str_or_query_bundle
+            ),
+            verify=lambda result: sql_result_verified(result[1]),
+        )
+
+    async def aretrieve_with_metadata(self, str_or_query_bundle):
+        return self.retrieve_with_metadata(str_or_query_bundle)
+
+
+def create_bedrock_converse(model_id, cache_prompt):
+    """
+    Create a llama-index Bedrock model, without sampling parameters the model
+    rejects.
+
+    The Bedrock gateway retries the calls (see bedrock_gateway.py), so
+    llama-index makes a single attempt.
+    """
+    llm_kwargs = {}
+    if Connections.supports_sampling_params(model_id):
+        llm_kwargs["temperature"] = 0
+    return BedrockConverse(
+        model=model_id,
+        client=Connections.bedrock_client,
+        system_prompt_caching=cache_prompt,
+        max_retries=1,
+        **llm_kwargs,
+    )
+
+
+def create_athena_engine():
     """
     Connect to Amazon Athena
     """
@@ -40,38 +174,74 @@ def create_sql_engine():
     return engine
 
 
-def create_query_engine(SQL_PROMPT=SQL_PROMPT, RESPONSE_PROMPT=RESPONSE_PROMPT):
+def create_sql_engine():
     """
-    Create query engine
+    Create the SQL engine for the configured pricing backend
     """
-    engine = create_sql_engine()
-    sql_database = SQLDatabase(engine, sample_rows_in_table_info=2)
+    backend = Connections.pricing_sql_backend
+    if backend == "sqlite":
+        return create_pricing_sqlite_engine()
+    if backend != "athena":
+        raise ValueError(f"Unsupported PRICING_SQL_BACKEND: {backend}")
+    return create_athena_engine()
 
-    # Use the same Bedrock model mapping as the rest of the app, via the
-    # Converse API (supports current Claude models and global inference profiles).
-    pricing_model_id = Connections.MODELID_MAPPING["ClaudeSonnet"]
-    llm_kwargs = {}
-    if Connections.supports_sampling_params(pricing_model_id):
-        llm_kwargs["temperature"] = 0
-    llm = BedrockConverse(
-        model=pricing_model_id,
-        client=Connections.bedrock_client,
-        **llm_kwargs,
-    )
+
+def create_embed_model():
+    """
+    Create the embedding model used for the table-schema index
+    """
     # Wrapped through LangChain's Bedrock embeddings so any Bedrock embedding
     # model ID can be used (the llama-index Bedrock embedding integration only
     # accepts a fixed allowlist of model IDs).
-    embeddings = LangchainEmbedding(
+    return LangchainEmbedding(
         BedrockEmbeddings(
             client=Connections.bedrock_client,
-            model_id="cohere.embed-v4:0",
+            model_id=EMBEDDING_MODEL_ID,
         )
     )
 
-    Settings.llm = llm
-    Settings.embed_model = embeddings
 
-    table_node_mapping = SQLTableNodeMapping(sql_database)
+def table_schema(sql_database):
+    """
+    Column names of the described tables, as reflected by the SQL database.
+
+    The Glue crawler and the SQLite backend name the columns the same way, so
+    an index built from the pricing CSVs matches the Athena tables.
+
+    Output:
+        schema (dict): table name -> sorted column names
+    """
+    return {
+        table.name: sorted(column.name for column in table.columns)
+        for table in sql_database.metadata_obj.tables.values()
+        if table.name in table_details
+    }
+
+
+def table_index_fingerprint(schema):
+    """
+    Content hash of the inputs that determine the table-schema embeddings.
+
+    Input:
+        schema (dict): see table_schema
+    Output:
+        hex digest as a str
+    """
+    payload = json.dumps(
+        {
+            "table_details": table_details,
+            "embedding_model_id": EMBEDDING_MODEL_ID,
+            "schema": schema,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def build_table_index(sql_database, table_node_mapping):
+    """
+    Embed the table descriptions into a new object index
+    """
     table_schema_objs = []
     tables = list(sql_database._all_tables)
     for table in tables:
@@ -84,16 +254,322 @@ def create_query_engine(SQL_PROMPT=SQL_PROMPT, RESPONSE_PROMPT=RESPONSE_PROMPT):
         table_node_mapping,
         VectorStoreIndex,
     )
+    return obj_index
+
+
+def persist_table_index(obj_index, schema, persist_dir=TABLE_INDEX_DIR):
+    """
+    Save the object index together with a manifest of its fingerprint
+    """
+    with warnings.catch_warnings():
+        # SQLTableNodeMapping cannot be persisted; it is rebuilt from the SQL
+        # database when the index is loaded.
+        warnings.simplefilter("ignore")
+        obj_index.persist(persist_dir=persist_dir)
+    manifest = {
+        "fingerprint": table_index_fingerprint(schema),
+        "embedding_model_id": EMBEDDING_MODEL_ID,
+        "tables": sorted(table_details),
+        "schema": schema,
+    }
+    with open(os.path.join(persist_dir, TABLE_INDEX_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_table_index(table_node_mapping, schema, persist_dir=TABLE_INDEX_DIR):
+    """
+    Load the prebuilt object index if it matches the current table details.
 
-    query_engine = SQLTableRetrieverQueryEngine(
-        sql_database,
-        obj_index.as_retriever(similarity_top_k=5),
-        text_to_sql_prompt=SQL_PROMPT,
-        response_synthesis_prompt=RESPONSE_PROMPT,
+    Inputs:
+        table_node_mapping (SQLTableNodeMapping): mapping for the SQL database
+        schema (dict): schema of the SQL database, see table_schema
+        persist_dir (str): directory written by persist_table_index
+    Output:
+        ObjectIndex, or None when the index is missing or stale
+    """
+    try:
+        with open(os.path.join(persist_dir, TABLE_INDEX_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        logging.info("No prebuilt table index found in %s", persist_dir)
+        return None
+
+    if manifest.get("fingerprint") != table_index_fingerprint(schema):
+        logging.warning(
+            "Prebuilt table index in %s does not match the table details, "
+            "schema or embedding model, rebuilding it",
+            persist_dir,
+        )
+        return None
+
+    return ObjectIndex.from_persist_dir(
+        persist_dir, object_node_mapping=table_node_mapping
     )
+
+
+def create_query_engine(
+    SQL_PROMPT=SQL_PROMPT,
+    RESPONSE_PROMPT=RESPONSE_PROMPT,
+    timings=None,
+    memoize=PRICING_CACHE_ENABLED,
+):
+    """
+    Create query engine
+
+    Inputs:
+        SQL_PROMPT (PromptTemplate): text-to-SQL prompt
+        RESPONSE_PROMPT (PromptTemplate): response synthesis prompt
+        timings (dict): optional dict filled with the duration in seconds of
+            each build phase
+        memoize (bool): reuse the SQL generated for a question and the rows
+            returned for a SQL statement (see pricing_cache.py)
+    Output:
+        query_engine, obj_index (tuple)
+    """
+    if timings is None:
+        timings = {}
+
+    with timed(timings, "sql_engine"):
+        # statements still running at the request deadline are cancelled
+        engine = cancel_sql_on_deadline(instrument_sql_engine(create_sql_engine()))
+    with timed(timings, "sql_database"):
+        if memoize:
+            sql_database = MemoizedSQLDatabase(
+                engine, cache=pricing_query_cache, sample_rows_in_table_info=2
+            )
+        else:
+            sql_database = SQLDatabase(engine, sample_rows_in_table_info=2)
+
+    with timed(timings, "models"):
+        # Use the same Bedrock model mapping as the rest of the app, via the
+        # Converse API (supports current Claude models and global inference profiles).
+        pricing_model_id = Connections.MODELID_MAPPING["ClaudeSonnet"]
+        register_llama_index_usage_handler("sql", pricing_model_id)
+        cache_sql_prompt = is_prompt_cache_enabled("sql")
+        if cache_sql_prompt:
+            register_llama_index_cache_logger("sql")
+        llm = create_bedrock_converse(pricing_model_id, cache_sql_prompt)
+        # The cascade's first model writes the SQL; the response is
+        # synthesized by the pricing model
+        first_llm = None
+        if is_cascade_enabled("sql"):
+            first_llm = create_bedrock_converse(
+                Connections.MODELID_MAPPING[CASCADE_FIRST_MODEL], cache_sql_prompt
+            )
+        embeddings = create_embed_model()
+
+        Settings.llm = llm
+        Settings.embed_model = embeddings
+
+    with timed(timings, "obj_index"):
+        table_node_mapping = SQLTableNodeMapping(sql_database)
+        obj_index = load_table_index(
+            table_node_mapping, table_schema(sql_database), TABLE_INDEX_DIR
+        )
+        if obj_index is None:
+            obj_index = build_table_index(sql_database, table_node_mapping)
+
+    with timed(timings, "query_engine"):
+        table_retriever = obj_index.as_retriever(similarity_top_k=5)
+        if cache_sql_prompt:
+            table_retriever = SortedTableRetriever(table_retriever)
+            if isinstance(SQL_PROMPT, PromptTemplate):
+                SQL_PROMPT = create_cached_sql_prompt(SQL_PROMPT.template)
+        sql_generator = None
+        if first_llm is not None:
+            sql_generator = CascadeNLSQLRetriever(
+                sql_database,
+                first_llm=first_llm,
+                cascade=get_cascade("sql"),
+                text_to_sql_prompt=SQL_PROMPT,
+                table_retriever=table_retriever,
+            )
+        if memoize:
+            query_engine = MemoizedSQLQueryEngine(
+                sql_database,
+                table_retriever,
+                text_to_sql_prompt=SQL_PROMPT,
+                cache=pricing_query_cache,
+                generator=sql_generator,
+                response_synthesis_prompt=RESPONSE_PROMPT,
+            )
+        elif sql_generator is not None:
+            query_engine = SQLRetrieverQueryEngine(
+                sql_generator, response_synthesis_prompt=RESPONSE_PROMPT
+            )
+        else:
+            query_engine = SQLTableRetrieverQueryEngine(
+                sql_database,
+                table_retriever,
+                text_to_sql_prompt=SQL_PROMPT,
+                response_synthesis_prompt=RESPONSE_PROMPT,
+            )
     prompts_dict = query_engine.get_prompts()
     logging.debug("prompts_dict: %s", prompts_dict)
     return query_engine, obj_index
 
 
-query_engine, obj_index = create_query_engine()
+class QueryEngineProvider:
+    """
+    Build the pricing query engine on first use and reuse it afterwards.
+
+    Building the engine connects to the SQL backend, reflects the table schemas
+    and embeds the table descriptions, so it is deferred until a pricing
+    (Use Case 2 or 3) question actually needs it. The result is kept for the
+    lifetime of the Lambda container.
+    """
+
+    def __init__(self, builder=create_query_engine):
+        self._builder = builder
+        self._lock = threading.Lock()
+        self._query_engine = None
+        self._obj_index = None
+        self.build_timings = {}
+
+    @property
+    def is_built(self):
+        return self._query_engine is not None
+
+    def get(self):
+        """
+        Return the query engine, building it on the first call.
+
+        Output:
+            query_engine (SQLTableRetrieverQueryEngine)
+        """
+        if self._query_engine is None:
+            with self._lock:
+                if self._query_engine is None:
+                    timings = {}
+                    start = time.perf_counter()
+                    with span("query_engine_build"):
+                        query_engine, obj_index = self._builder(timings=timings)
+                    timings["total"] = time.perf_counter() - start
+                    self._obj_index = obj_index
+                    self._query_engine = query_engine
+                    self.build_timings = timings
+                    logging.info("Pricing query engine built: %s", timings)
+        return self._query_engine
+
+    def get_obj_index(self):
+        self.get()
+        return self._obj_index
+
+
+query_engine_provider = QueryEngineProvider()
+
+
+def get_query_engine():
+    """
+    Return the container-wide pricing query engine, building it if needed.
+    """
+    return query_engine_provider.get()
+
+
+# Rows returned to the agent by the evidence tool; the rest are counted only
+PRICING_EVIDENCE_MAX_ROWS = int(os.environ.get("PRICING_EVIDENCE_MAX_ROWS", "50"))
+# Time the text-to-SQL, the query and the synthesis need together; with less
+# time left before the request deadline (see deadline.py), the result rows are
+# returned without synthesis
+PRICING_SYNTHESIS_MIN_SECONDS = float(
+    os.environ.get("PRICING_SYNTHESIS_MIN_SECONDS", "20")
+)
+PRICING_ROWS_INTRO = (
+    "There was not enough time to summarize the pricing data. These are the "
+    "matching rows:"
+)
+
+
+def query_pricing_evidence(query, max_rows=PRICING_EVIDENCE_MAX_ROWS):
+    """
+    Run the SQL for a pricing question without synthesizing an answer.
+
+    Direct instance price lookups are answered from the pricing data; every
+    other question goes through text-to-SQL and the SQL backend only.
+
+    Input:
+        query (str): user's question
+        max_rows (int): maximum number of result rows returned
+    Output:
+        output (dict): {"sql", "columns", "rows", "row_count"}, or
+        {"sql", "answer"} for a direct price lookup
+    """
+    output = resolve_price_lookup(query)
+    if output is not None:
+        return {"sql": output["source"], "answer": output["answer"]}
+
+    nodes, metadata = get_query_engine().sql_retriever.retrieve_with_metadata(query)
+    rows = metadata.get("result") or []
+    evidence = {
+        "sql": metadata.get("sql_query", ""),
+        "columns": metadata.get("col_keys", []),
+        "rows": [list(row) for row in rows[:max_rows]],
+        "row_count": len(rows),
+    }
+    if "result" not in metadata and nodes:
+        # The retriever returns the SQL error as the only node
+        evidence["error"] = nodes[0].node.get_content()
+    return evidence
+
+
+def _markdown_cell(value):
+    return str(value).replace("|", "\\|")
+
+
+def rows_answer(evidence):
+    """
+    Answer with the rows of query_pricing_evidence as a Markdown table.
+    """
+    if evidence.get("error"):
+        if expired():
+            answer = "There was not enough time to look up the pricing data."
+        else:
+            answer = "The pricing data could not be looked up."
+    elif not evidence.get("rows"):
+        answer = "No matching pricing rows were found."
+    else:
+        lines = [
+            "| " + " | ".join(map(_markdown_cell, evidence["columns"])) + " |",
+            "|" + " --- |" * len(evidence["columns"]),
+        ]
+        lines += [
+            "| " + " | ".join(map(_markdown_cell, row)) + " |"
+            for row in evidence["rows"]
+        ]
+        answer = "\n".join([PRICING_ROWS_INTRO, "", *lines])
+        if evidence["row_count"] > len(evidence["rows"]):
+            answer += (
+                f"\n\nFirst {len(evidence['rows'])} of "
+                f"{evidence['row_count']} rows."
+            )
+    return {"source": evidence["sql"], "answer": answer, "degraded": True}
+
+
+def query_pricing(query):
+    """
+    Answer a pricing question.
+
+    Direct instance price lookups are answered from the pricing data without an
+    LLM; every other question goes through the text-to-SQL query engine.
+
+    Input:
+        query (str): user's question
+    Output:
+        output (dict): {"source": SQL query, "answer": answer text}, and
+        "degraded": True when there was no time left to synthesize the answer
+        (the result rows are returned)
+    """
+    output = resolve_price_lookup(query)
+    if output is not None:
+        return output
+
+    if expired(PRICING_SYNTHESIS_MIN_SECONDS):
+        logging.warning("Out of time, answering with the pricing rows")
+        return rows_answer(query_pricing_evidence(query))
+
+    query_engine = get_query_engine()
+    with span("query_engine.query"):
+        response = query_engine.query(query)
+    logging.debug(response.response)
+    logging.debug(response.metadata["sql_query"])
+    return {"source": response.metadata["sql_query"], "answer": response.response}
@@ -0,0 +1,185 @@
+"""
+This script is to keep the conversation history of each chat session.
+
+Two backends are available, selected with SESSION_BACKEND:
+    "memory"   - an in-process LRU of sessions; history survives only while
+                 the Lambda container stays warm
+    "dynamodb" - a DynamoDB table keyed on session_id (SESSION_TABLE_NAME),
+                 shared by every container; DYNAMODB_ENDPOINT_URL points it
+                 at DynamoDB Local or another compatible endpoint
+
+Whatever the backend, only the most recent messages that fit in
+SESSION_HISTORY_MAX_TOKENS are kept, so the prompt size of follow-up questions
+stays flat as a conversation grows.
+"""
+
+import json
+import logging
+import os
+import time
+from typing import List
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import (
+    BaseMessage,
+    messages_from_dict,
+    messages_to_dict,
+    trim_messages,
+)
+from langchain_core.messages.utils import count_tokens_approximately
+
+from caching import LRUTTLCache
+from connections import Connections
+
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory").lower()
+SESSION_TABLE_NAME = os.environ.get("SESSION_TABLE_NAME")
+SESSION_HISTORY_MAX_TOKENS = int(os.environ.get("SESSION_HISTORY_MAX_TOKENS", "2000"))
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "86400"))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "1024"))
+
+
+def trim_history(messages, max_tokens=SESSION_HISTORY_MAX_TOKENS):
+    """
+    Keep the most recent messages that fit in the token budget.
+
+    Inputs:
+        messages (list): conversation messages, oldest first
+        max_tokens (int): token budget of the history
+    Output:
+        list of messages starting with a human message
+    """
+    return trim_messages(
+        messages,
+        max_tokens=max_tokens,
+        token_counter=count_tokens_approximately,
+        strategy="last",
+        start_on="human",
+        allow_partial=False,
+    )
+
+
+class InMemorySessionStore:
+    """
+    LRU of session histories held by the Lambda container.
+    """
+
+    def __init__(self, maxsize=SESSION_CACHE_SIZE, ttl=SESSION_TTL_SECONDS):
+        self._cache = LRUTTLCache(maxsize=maxsize, ttl=ttl, name="session")
+
+    def load(self, session_id):
+        return list(self._cache.get(session_id, ()))
+
+    def save(self, session_id, messages):
+        self._cache.set(session_id, tuple(messages))
+
+    def clear(self, session_id):
+        self._cache.invalidate(session_id)
+
+
+class DynamoDBSessionStore:
+    """
+    Session histories stored in a DynamoDB table.
+
+    Each item holds the session_id (partition key), the serialized messages
+    and an expires_at epoch used as the table's TTL attribute.
+    """
+
+    def __init__(self, table_name, client=None, ttl=SESSION_TTL_SECONDS):
+        if not table_name:
+            raise ValueError("SESSION_TABLE_NAME is required for the dynamodb backend")
+        self.table_name = table_name
+        self.client = client or Connections.dynamodb_client
+        self.ttl = ttl
+
+    def load(self, session_id):
+        response = self.client.get_item(
+            TableName=self.table_name,
+            Key={"session_id": {"S": session_id}},
+            ConsistentRead=True,
+        )
+        item = response.get("Item")
+        if not item or int(item["expires_at"]["N"]) <= time.time():
+            return []
+        return messages_from_dict(json.loads(item["messages"]["S"]))
+
+    def save(self, session_id, messages):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={
+                "session_id": {"S": session_id},
+                "messages": {"S": json.dumps(messages_to_dict(messages))},
+                "expires_at": {"N": str(int(time.time()) + self.ttl)},
+            },
+        )
+
+    def clear(self, session_id):
+        self.client.delete_item(
+            TableName=self.table_name, Key={"session_id": {"S": session_id}}
+        )
+
+
+class SessionHistory(BaseChatMessageHistory):
+    """
+    Chat message history of one session, trimmed to a token budget on write.
+    """
+
+    def __init__(self, session_id, store, max_tokens=SESSION_HISTORY_MAX_TOKENS):
+        self.session_id = session_id
+        self.store = store
+        self.max_tokens = max_tokens
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.store.load(self.session_id)
+
+    def add_messages(self, messages: List[BaseMessage]) -> None:
+        """Append messages, dropping the oldest ones beyond the token budget"""
+        history = self.store.load(self.session_id) + list(messages)
+        trimmed = trim_history(history, self.max_tokens)
+        if len(trimmed) < len(history):
+            logging.debug(
+                "Trimmed %d messages from session %s",
+                len(history) - len(trimmed),
+                self.session_id,
+            )
+        self.store.save(self.session_id, trimmed)
+
+    def clear(self) -> None:
+        self.store.clear(self.session_id)
+
+
+def create_session_store(backend=SESSION_BACKEND):
+    """
+    Create the session store of the configured backend.
+    """
+    if backend == "memory":
+        return InMemorySessionStore()
+    if backend == "dynamodb":
+        return DynamoDBSessionStore(SESSION_TABLE_NAME)
+    raise ValueError(f"Unsupported session backend: {backend}")
+
+
+_store = None
+
+
+def get_session_store():
+    """
+    Return the container-wide session store.
+    """
+    global _store
+    if _store is None:
+        _store = create_session_store()
+    return _store
+
+
+def get_by_session_id(session_id: str) -> BaseChatMessageHistory:
+    """
+    Get a chat message history by session id.
+
+    Args:
+        session_id: The session id to get the history for.
+
+    Returns:
+        The chat message history for the session id.
+    """
+    return SessionHistory(session_id, get_session_store())
@@ -0,0 +1,230 @@
+"""
+This script is to run the Lambda handler with response streaming support.
+
+The Python runtime interface client always buffers the handler's return value.
+This loop talks to the Lambda Runtime API directly: when the handler returns an
+iterator, every chunk it yields is sent to the caller as soon as it is produced
+(streaming response mode, chunked transfer encoding), so clients using
+InvokeWithResponseStream see the first tokens while the rest of the answer is
+still being generated. Any other return value is sent as a buffered JSON
+response, exactly like the standard runtime, so RequestResponse invokes keep
+working.
+
+It is the container image entrypoint when response streaming is enabled:
+
+    python3 -m streaming_runtime genai_chat_app.lambda_handler
+"""
+
+import base64
+import http.client
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from collections.abc import Iterator
+
+RUNTIME_API_VERSION = "2018-06-01"
+ERROR_TYPE_TRAILER = "Lambda-Runtime-Function-Error-Type"
+ERROR_BODY_TRAILER = "Lambda-Runtime-Function-Error-Body"
+
+_request_id = None
+
+
+class LambdaContext:
+    """
+    Subset of the standard Lambda context object used by handlers.
+    """
+
+    def __init__(self, headers):
+        self.aws_request_id = headers.get("Lambda-Runtime-Aws-Request-Id")
+        self.invoked_function_arn = headers.get("Lambda-Runtime-Invoked-Function-Arn")
+        self.function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+        self.function_version = os.environ.get("AWS_LAMBDA_FUNCTION_VERSION")
+        self.memory_limit_in_mb = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+        self.log_group_name = os.environ.get("AWS_LAMBDA_LOG_GROUP_NAME")
+        self.log_stream_name = os.environ.get("AWS_LAMBDA_LOG_STREAM_NAME")
+        client_context = headers.get("Lambda-Runtime-Client-Context")
+        self.client_context = json.loads(client_context) if client_context else None
+        identity = headers.get("Lambda-Runtime-Cognito-Identity")
+        self.identity = json.loads(identity) if identity else None
+        self._deadline_ms = int(headers.get("Lambda-Runtime-Deadline-Ms") or 0)
+
+    def get_remaining_time_in_millis(self):
+        return max(self._deadline_ms - int(time.time() * 1000), 0)
+
+
+def _error_payload(error):
+    return {
+        "errorMessage": str(error),
+        "errorType": type(error).__name__,
+        "stackTrace": traceback.format_exception(error),
+    }
+
+
+class RuntimeClient:
+    """
+    Minimal client of the Lambda Runtime API.
+    """
+
+    def __init__(self, address):
+        self.address = address
+
+    def _request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection(self.address)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            return response.read(), response.headers
+        finally:
+            conn.close()
+
+    def next_invocation(self):
+        """
+        Block until the next event arrives.
+
+        Output:
+            (event bytes, response headers)
+        """
+        return self._request("GET", f"/{RUNTIME_API_VERSION}/runtime/invocation/next")
+
+    def post_response(self, request_id, result):
+        self._request(
+            "POST",
+            f"/{RUNTIME_API_VERSION}/runtime/invocation/{request_id}/response",
+            body=json.dumps(result).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+
+    def post_error(self, request_id, error):
+        payload = _error_payload(error)
+        self._request(
+            "POST",
+            f"/{RUNTIME_API_VERSION}/runtime/invocation/{request_id}/error",
+            body=json.dumps(payload).encode("utf-8"),
+            headers={ERROR_TYPE_TRAILER: payload["errorType"]},
+        )
+
+    def post_init_error(self, error):
+        payload = _error_payload(error)
+        self._request(
+            "POST",
+            f"/{RUNTIME_API_VERSION}/runtime/init/error",
+            body=json.dumps(payload).encode("utf-8"),
+            headers={ERROR_TYPE_TRAILER: payload["errorType"]},
+        )
+
+    def stream_response(self, request_id, chunks, content_type="application/x-ndjson"):
+        """
+        Send the chunks of a response as they are produced.
+
+        An exception raised by the iterator after the response started is
+        reported in the error trailers, which fail the invocation.
+        """
+        conn = http.client.HTTPConnection(self.address)
+        try:
+            conn.putrequest(
+                "POST",
+                f"/{RUNTIME_API_VERSION}/runtime/invocation/{request_id}/response",
+            )
+            conn.putheader("Lambda-Runtime-Function-Response-Mode", "streaming")
+            conn.putheader("Transfer-Encoding", "chunked")
+            conn.putheader("Content-Type", content_type)
+            conn.putheader("Trailer", f"{ERROR_TYPE_TRAILER}, {ERROR_BODY_TRAILER}")
+            conn.endheaders()
+
+            trailers = b""
+            try:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode("utf-8")
+                    if chunk:
+                        conn.send(b"%X\r\n%s\r\n" % (len(chunk), chunk))
+            except Exception as e:
+                logging.exception("Error while streaming the response")
+                payload = _error_payload(e)
+                body = base64.b64encode(json.dumps(payload).encode("utf-8"))
+                trailers = (
+                    f"{ERROR_TYPE_TRAILER}: {payload['errorType']}\r\n".encode()
+                    + f"{ERROR_BODY_TRAILER}: ".encode()
+                    + body
+                    + b"\r\n"
+                )
+            conn.send(b"0\r\n" + trailers + b"\r\n")
+            conn.getresponse().read()
+        finally:
+            conn.close()
+
+
+def load_handler(handler):
+    """
+    Import a handler given as "module.function".
+    """
+    module_name, _, function_name = handler.rpartition(".")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def handle_invocation(client, handler):
+    """
+    Wait for the next event, run the handler on it and send back the result.
+    """
+    global _request_id
+    body, headers = client.next_invocation()
+    context = LambdaContext(headers)
+    _request_id = context.aws_request_id
+    trace_id = headers.get("Lambda-Runtime-Trace-Id")
+    if trace_id:
+        os.environ["_X_AMZN_TRACE_ID"] = trace_id
+    try:
+        event = json.loads(body) if body else {}
+        result = handler(event, context)
+        if isinstance(result, Iterator):
+            client.stream_response(context.aws_request_id, result)
+        else:
+            client.post_response(context.aws_request_id, result)
+    except Exception as e:
+        logging.exception("Error running the handler")
+        client.post_error(context.aws_request_id, e)
+    finally:
+        _request_id = None
+
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.aws_request_id = _request_id
+        return True
+
+
+def _configure_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(
+        logging.Formatter(
+            "[%(levelname)s]\t%(asctime)s.%(msecs)03dZ\t%(aws_request_id)s\t%(message)s",
+            "%Y-%m-%dT%H:%M:%S",
+        )
+    )
+    handler.formatter.converter = time.gmtime
+    handler.addFilter(_RequestIdFilter())
+    logging.getLogger().addHandler(handler)
+
+
+def main():
+    _configure_logging()
+    client = RuntimeClient(os.environ["AWS_LAMBDA_RUNTIME_API"])
+    try:
+        handler = load_handler(
+            sys.argv[1] if len(sys.argv) > 1 else os.environ["_HANDLER"]
+        )
+    except Exception as e:
+        logging.exception("Failed to load the handler")
+        client.post_init_error(e)
+        sys.exit(1)
+
+    while True:
+        handle_invocation(client, handler)
+
+
+if __name__ == "__main__":
+    main()
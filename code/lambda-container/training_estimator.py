@@ -0,0 +1,272 @@
+"""
+This script is to estimate the time and cost of a workload on every SageMaker instance at once.
+
+Questions such as "train Stable Diffusion within a budget of $100" need the
+price, memory and accelerators of every instance, which the agent otherwise
+gathers one pricing lookup at a time. The training_price and
+real_time_inference_price tables are loaded once into columnar numpy arrays.
+The pricing tables do not list accelerators, so the accelerator type, count and
+memory of each instance come from ACCELERATOR_FAMILIES and ACCELERATOR_COUNTS.
+
+A workload is sized in GPU-hours of REFERENCE_ACCELERATOR. On an instance it
+takes those GPU-hours divided by the instance's throughput relative to the
+reference accelerator, and costs that time times the hourly price. Every
+instance is scored in one vectorized pass, and the feasible ones are returned as
+a frontier ranked from the cheapest to the fastest.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from data_version import VersionedValue
+from pricing_data import get_pricing_tables, pricing_data_version
+
+REFERENCE_ACCELERATOR = "NVIDIA V100"
+# Throughput kept per doubling of the accelerators of one instance
+MULTI_ACCELERATOR_EFFICIENCY = float(
+    os.environ.get("ESTIMATOR_MULTI_ACCELERATOR_EFFICIENCY", "0.9")
+)
+ESTIMATOR_MAX_RESULTS = int(os.environ.get("ESTIMATOR_MAX_RESULTS", "8"))
+ESTIMATOR_TABLES = {
+    "training": "training_price",
+    "inference": "real_time_inference_price",
+}
+
+# Instance family -> (accelerator, memory per accelerator in GiB, training
+# throughput relative to REFERENCE_ACCELERATOR). The throughputs are rough
+# mixed-precision figures, good enough to rank instances, not to quote.
+ACCELERATOR_FAMILIES = {
+    "p2": ("NVIDIA K80", 12, 0.15),
+    "p3": ("NVIDIA V100", 16, 1.0),
+    "p3dn": ("NVIDIA V100", 32, 1.0),
+    "p4d": ("NVIDIA A100", 40, 2.5),
+    "p4de": ("NVIDIA A100", 80, 2.5),
+    "p5": ("NVIDIA H100", 80, 5.0),
+    "g4dn": ("NVIDIA T4", 16, 0.3),
+    "g5": ("NVIDIA A10G", 24, 0.8),
+    "trn1": ("AWS Trainium", 32, 1.5),
+    "trn1n": ("AWS Trainium", 32, 1.5),
+}
+# Instance family -> accelerators per instance size; other sizes have one
+ACCELERATOR_COUNTS = {
+    "p2": {"8xlarge": 8, "16xlarge": 16},
+    "p3": {"8xlarge": 4, "16xlarge": 8},
+    "p3dn": {"24xlarge": 8},
+    "p4d": {"24xlarge": 8},
+    "p4de": {"24xlarge": 8},
+    "p5": {"48xlarge": 8},
+    "g4dn": {"12xlarge": 4},
+    "g5": {"12xlarge": 4, "24xlarge": 4, "48xlarge": 8},
+    "trn1": {"32xlarge": 16},
+    "trn1n": {"32xlarge": 16},
+}
+
+
+def instance_accelerators(instance_type):
+    """
+    Look up the accelerators of an instance.
+
+    Input:
+        instance_type (str): e.g. "ml.g5.12xlarge"
+    Output:
+        (accelerator, count, memory_gib, relative_throughput), or None for an
+        instance without accelerators
+    """
+    parts = instance_type.split(".")
+    if len(parts) != 3:
+        return None
+    _, family, size = parts
+    spec = ACCELERATOR_FAMILIES.get(family)
+    if spec is None:
+        return None
+    accelerator, memory_gib, throughput = spec
+    count = ACCELERATOR_COUNTS.get(family, {}).get(size, 1)
+    return accelerator, count, memory_gib, throughput
+
+
+class InstanceTable:
+    """
+    Columns of one pricing table as numpy arrays, one row per instance.
+    """
+
+    def __init__(self, table):
+        columns = [name for name, _ in table["columns"]]
+        index = {name: columns.index(name) for name in columns}
+        rows = [
+            row
+            for row in table["rows"]
+            if row[index["instance_type"]] is not None
+            and row[index["price_per_hour"]] is not None
+        ]
+        self.instance_type = np.array([row[index["instance_type"]] for row in rows])
+        self.vcpu = np.array([row[index["vcpu"]] or 0 for row in rows], dtype=int)
+        self.memory_gib = np.array(
+            [row[index["memory"]] or 0 for row in rows], dtype=float
+        )
+        self.price_per_hour = np.array(
+            [row[index["price_per_hour"]] for row in rows], dtype=float
+        )
+        accelerators = [instance_accelerators(name) for name in self.instance_type]
+        self.accelerator = np.array([spec[0] if spec else "" for spec in accelerators])
+        self.cuda = np.char.startswith(self.accelerator, "NVIDIA")
+        self.accelerator_count = np.array(
+            [spec[1] if spec else 0 for spec in accelerators], dtype=int
+        )
+        self.accelerator_memory_gib = np.array(
+            [spec[2] if spec else 0 for spec in accelerators], dtype=float
+        )
+        per_accelerator = np.array(
+            [spec[3] if spec else 0 for spec in accelerators], dtype=float
+        )
+        # Multi-accelerator instances lose some throughput to communication
+        doublings = np.log2(np.maximum(self.accelerator_count, 1))
+        self.throughput = (
+            self.accelerator_count
+            * per_accelerator
+            * MULTI_ACCELERATOR_EFFICIENCY**doublings
+        )
+
+    def __len__(self):
+        return len(self.instance_type)
+
+
+def pareto_frontier(cost, hours):
+    """
+    Indexes of the instances no other instance beats on both cost and time,
+    from the cheapest to the fastest.
+    """
+    order = np.lexsort((hours, cost))
+    sorted_hours = hours[order]
+    best_before = np.concatenate(([np.inf], np.minimum.accumulate(sorted_hours)[:-1]))
+    return order[sorted_hours < best_before]
+
+
+class TrainingEstimator:
+    """
+    Time and cost of a workload on every instance of the pricing tables.
+    """
+
+    def __init__(self, tables):
+        self.tables = {
+            name: InstanceTable(tables[table])
+            for name, table in ESTIMATOR_TABLES.items()
+            if table in tables
+        }
+
+    def estimate(
+        self,
+        gpu_hours,
+        budget_usd=None,
+        deadline_hours=None,
+        min_accelerator_memory_gib=0.0,
+        min_memory_gib=0.0,
+        require_cuda=False,
+        pricing="training",
+        max_results=ESTIMATOR_MAX_RESULTS,
+    ):
+        """
+        Score a workload on every instance and rank the feasible ones.
+
+        Inputs:
+            gpu_hours (float): size of the workload in REFERENCE_ACCELERATOR
+                GPU-hours
+            budget_usd (float): most the workload may cost, or None
+            deadline_hours (float): most the workload may take, or None
+            min_accelerator_memory_gib (float): memory each accelerator needs
+            min_memory_gib (float): instance memory the workload needs
+            require_cuda (bool): only NVIDIA GPUs, for CUDA-only code
+            pricing (str): "training" or "inference", the prices to use
+            max_results (int): most instances returned
+        Output:
+            estimate (dict): the workload, the number of feasible instances and
+            the "frontier" of feasible instances from the cheapest to the
+            fastest. Without any feasible instance, "closest" ranks the
+            instances meeting the memory floors regardless of budget and
+            deadline.
+        """
+        if pricing not in self.tables:
+            raise ValueError(f"Unsupported pricing: {pricing}")
+        if not gpu_hours or gpu_hours <= 0:
+            raise ValueError("gpu_hours must be positive")
+        data = self.tables[pricing]
+
+        with np.errstate(divide="ignore"):
+            hours = np.where(data.throughput > 0, gpu_hours / data.throughput, np.inf)
+        cost = hours * data.price_per_hour
+        fits = (
+            (data.throughput > 0)
+            & (data.accelerator_memory_gib >= (min_accelerator_memory_gib or 0))
+            & (data.memory_gib >= (min_memory_gib or 0))
+        )
+        if require_cuda:
+            fits &= data.cuda
+        anything = np.ones(len(data), dtype=bool)
+        within_budget = anything if budget_usd is None else cost <= budget_usd
+        in_time = anything if deadline_hours is None else hours <= deadline_hours
+        feasible = fits & within_budget & in_time
+
+        estimate = {
+            "pricing": pricing,
+            "workload": {
+                "gpu_hours": gpu_hours,
+                "reference_accelerator": REFERENCE_ACCELERATOR,
+                "budget_usd": budget_usd,
+                "deadline_hours": deadline_hours,
+                "min_accelerator_memory_gib": min_accelerator_memory_gib,
+                "min_memory_gib": min_memory_gib,
+                "require_cuda": require_cuda,
+            },
+            "instances": len(data),
+            "feasible": int(feasible.sum()),
+        }
+        candidates = np.flatnonzero(feasible)
+        key = "frontier"
+        if not len(candidates):
+            candidates = np.flatnonzero(fits)
+            key = "closest"
+        frontier = candidates[pareto_frontier(cost[candidates], hours[candidates])]
+        estimate[key] = [
+            self._row(data, i, hours, cost, within_budget, in_time)
+            for i in frontier[:max_results]
+        ]
+        logging.info(
+            "Estimated %s GPU-hours on %d instances: %d feasible",
+            gpu_hours,
+            len(data),
+            estimate["feasible"],
+        )
+        return estimate
+
+    @staticmethod
+    def _row(data, i, hours, cost, within_budget, in_time):
+        row = {
+            "instance_type": str(data.instance_type[i]),
+            "accelerator": str(data.accelerator[i]),
+            "accelerator_count": int(data.accelerator_count[i]),
+            "accelerator_memory_gib": float(data.accelerator_memory_gib[i]),
+            "vcpu": int(data.vcpu[i]),
+            "memory_gib": float(data.memory_gib[i]),
+            "price_per_hour": float(data.price_per_hour[i]),
+            "hours": round(float(hours[i]), 2),
+            "cost_usd": round(float(cost[i]), 2),
+        }
+        if not within_budget[i]:
+            row["over_budget"] = True
+        if not in_time[i]:
+            row["over_deadline"] = True
+        return row
+
+
+_estimator = VersionedValue(
+    pricing_data_version, lambda: TrainingEstimator(get_pricing_tables())
+)
+
+
+def get_training_estimator():
+    """
+    Return the container-wide estimator, building it from the pricing data
+    again whenever its version changes.
+    """
+    return _estimator.get()
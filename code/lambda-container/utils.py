@@ -1,41 +1,40 @@
 import json
 import re
-from typing import List
-from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_core.messages import BaseMessage
-from pydantic import BaseModel, Field
+import time
+from contextlib import contextmanager
 
 
-class InMemoryHistory(BaseChatMessageHistory, BaseModel):
-    """In memory implementation of chat message history."""
-
-    messages: List[BaseMessage] = Field(default_factory=list)
-
-    class Config:
-        arbitrary_types_allowed = True
-
-    def add_messages(self, messages: List[BaseMessage]) -> None:
-        """Add a list of messages to the store"""
-        self.messages.extend(messages)
+@contextmanager
+def timed(timings, name):
+    """
+    Record the wall-clock duration of the enclosed block.
 
-    def clear(self) -> None:
-        self.messages = []
+    Input:
+        timings (dict): dict receiving the duration in seconds under `name`
+        name (str): phase name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
 
 
-def get_by_session_id(session_id: str) -> BaseChatMessageHistory:
+def normalize_question(query):
     """
-    Get a chat message history by session id.
+    Case-fold a question, drop every question mark and collapse its whitespace
+    and trailing punctuation.
 
-    Args:
-        session_id: The session id to get the history for.
+    Every cache keyed on questions (intents, answers, generated SQL, tool
+    results) uses it, so the same wording maps to the same key everywhere. The
+    intent prompt ignores question marks, wherever they are.
 
-    Returns:
-        The chat message history for the session id.
+    Input:
+        query (str): question from the user
+    Output:
+        normalized question as a str, used as a cache key
     """
-    store = {}
-    if session_id not in store:
-        store[session_id] = InMemoryHistory()
-    return store[session_id]
+    return " ".join(query.casefold().replace("?", " ").split()).rstrip(" .!")
 
 
 def _content_to_text(content):
@@ -0,0 +1,58 @@
+"""
+Build the manifest that maps Kendra source documents to their web page URLs.
+
+Every document in assets/kendra_documents/sm_dg.zip is a JSON object holding
+the page "Url" and "Topic". The manifest is written into the Lambda build
+context during synthesis, so the function resolves citation links from memory
+instead of reading each document back from S3.
+"""
+
+import json
+import zipfile
+
+
+def build_source_manifest(zip_path):
+    """
+    Map each document's S3 object key to its URL and title.
+
+    Input:
+        zip_path (str): zip file extracted to the Kendra data source bucket
+    Output:
+        manifest (dict): object key -> {"url": ..., "title": ...}
+    """
+    manifest = {}
+    with zipfile.ZipFile(zip_path) as archive:
+        for name in archive.namelist():
+            if name.endswith("/"):
+                continue
+            try:
+                document = json.loads(archive.read(name))
+            except ValueError:
+                continue
+            if not isinstance(document, dict) or not document.get("Url"):
+                continue
+            manifest[name] = {
+                "url": document["Url"],
+                "title": " ".join(str(document.get("Topic", "")).split()),
+            }
+    return manifest
+
+
+def write_source_manifest(zip_path, output_path):
+    """
+    Write the manifest, leaving the file untouched when it is up to date so the
+    container image asset hash stays stable.
+
+    Output:
+        True if the file was (re)written
+    """
+    content = json.dumps(build_source_manifest(zip_path), indent=1, sort_keys=True)
+    try:
+        with open(output_path) as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    with open(output_path, "w") as f:
+        f.write(content)
+    return True
@@ -15,6 +15,9 @@ logger.setLevel(Connections.log_level)
 
 lambda_client = Connections.lambda_client
 
+HUMAN_AVATAR = "https://api.dicebear.com/7.x/notionists-neutral/svg?seed=Felix"
+AI_AVATAR = "https://assets-global.website-files.com/62b1b25a5edaf66f5056b068/62d1345ba688202d5bfa6776_aws-sagemaker-eyecatch-e1614129391121.png"
+
 
 def get_response(user_input, session_id):
     """
@@ -41,6 +44,71 @@ def get_response(user_input, session_id):
     return response_output
 
 
+def iter_response_frames(user_input, session_id):
+    """
+    Get the response from genai Lambda as a stream of frames
+
+    The Lambda sends newline-delimited JSON frames: {"type": "delta", "text"}
+    chunks of the answer, then a final {"type": "source", "source"} frame, or
+    an {"type": "error", "message"} frame.
+    """
+    logger.debug(f"session id: {session_id}")
+    payload = {
+        "body": json.dumps(
+            {"query": user_input, "session_id": session_id, "stream": True}
+        )
+    }
+    response = lambda_client.invoke_with_response_stream(
+        FunctionName=Connections.lambda_function_name,
+        Payload=json.dumps(payload),
+    )
+
+    buffer = b""
+    for event in response["EventStream"]:
+        if "PayloadChunk" in event:
+            buffer += event["PayloadChunk"]["Payload"]
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+        elif "InvokeComplete" in event:
+            error_code = event["InvokeComplete"].get("ErrorCode")
+            if error_code:
+                error_msg = event["InvokeComplete"].get("ErrorDetails", error_code)
+                logger.error(f"Lambda error: {error_msg}")
+                yield {"type": "error", "message": f"Error: {error_msg}"}
+
+    if buffer.strip():
+        frame = json.loads(buffer)
+        if "type" not in frame:
+            # Buffered response of a function running without the streaming
+            # runtime
+            yield {"type": "delta", "text": frame.get("answer", "")}
+            frame = {"type": "source", "source": frame.get("source", " ")}
+        yield frame
+
+
+def stream_response(user_input, session_id):
+    """
+    Render the answer while it is streamed from genai Lambda
+    """
+    output = {"source": " ", "answer": ""}
+
+    def answer_chunks():
+        for frame in iter_response_frames(user_input, session_id):
+            if frame["type"] == "delta":
+                yield frame["text"]
+            elif frame["type"] == "source":
+                output["source"] = frame["source"]
+            elif frame["type"] == "error":
+                yield frame["message"]
+
+    st.markdown("**Answer**:")
+    answer = st.write_stream(answer_chunks())
+    output["answer"] = answer if isinstance(answer, str) else "".join(map(str, answer))
+    return output
+
+
 def header():
     """
     App Header setting
@@ -85,33 +153,35 @@ def show_message():
 
     if user_input:
         session_id = st.session_state.session_id
-        with st.spinner("Gathering info ..."):
-            vertical_space = show_empty_container()
-            vertical_space.empty()
-            output = get_response(user_input, session_id)
-            logger.debug(f"Output: {output}")
-            result = output["answer"]
-            st.write("-------")
-            source = output["source"]
-            if source.startswith("SELECT"):
-                source = f"_{source}_"
-            source_title = "\n\n **Source**:" + "\n\n" + source
-            answer = "**Answer**: \n\n" + result
-            st.session_state.questions.append(user_input)
-            st.session_state.answers.append(answer + source_title)
+        if Connections.response_streaming:
+            # Rendered while streaming, then replaced by the conversation below
+            streaming_placeholder = st.empty()
+            with streaming_placeholder.container():
+                with st.chat_message(name="ai", avatar=AI_AVATAR):
+                    output = stream_response(user_input, session_id)
+            streaming_placeholder.empty()
+        else:
+            with st.spinner("Gathering info ..."):
+                vertical_space = show_empty_container()
+                vertical_space.empty()
+                output = get_response(user_input, session_id)
+        logger.debug(f"Output: {output}")
+        result = output["answer"]
+        st.write("-------")
+        source = output["source"]
+        if source.startswith("SELECT"):
+            source = f"_{source}_"
+        source_title = "\n\n **Source**:" + "\n\n" + source
+        answer = "**Answer**: \n\n" + result
+        st.session_state.questions.append(user_input)
+        st.session_state.answers.append(answer + source_title)
 
     if st.session_state["answers"]:
         for i in range(len(st.session_state["answers"]) - 1, -1, -1):
-            with st.chat_message(
-                name="human",
-                avatar="https://api.dicebear.com/7.x/notionists-neutral/svg?seed=Felix",
-            ):
+            with st.chat_message(name="human", avatar=HUMAN_AVATAR):
                 st.markdown(st.session_state["questions"][i])
 
-            with st.chat_message(
-                name="ai",
-                avatar="https://assets-global.website-files.com/62b1b25a5edaf66f5056b068/62d1345ba688202d5bfa6776_aws-sagemaker-eyecatch-e1614129391121.png",
-            ):
+            with st.chat_message(name="ai", avatar=AI_AVATAR):
                 st.markdown(st.session_state["answers"][i])
 
 
@@ -8,6 +8,9 @@ class Connections:
     region_name = os.environ["AWS_REGION"]
     lambda_function_name = os.environ["LAMBDA_FUNCTION_NAME"]
     log_level = os.environ["LOG_LEVEL"]
+    # Stream answers with InvokeWithResponseStream instead of waiting for the
+    # complete response
+    response_streaming = os.environ.get("RESPONSE_STREAMING", "false").lower() == "true"
 
     lambda_client = boto3.client(
         "lambda",
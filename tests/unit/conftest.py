@@ -0,0 +1,24 @@
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LAMBDA_DIR = os.path.join(ROOT_DIR, "code", "lambda-container")
+PRICING_DATA_DIR = os.path.join(ROOT_DIR, "assets", "sagemaker_source")
+
+# The Lambda modules read their configuration from the environment at import
+# time; these placeholders let them import without an AWS deployment.
+for key, value in {
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "DATA_SOURCE_BUCKET_NAME": "test-kendra-data-source",
+    "PRICING_DATA_SOURCE_BUCKET_NAME": "test-sagemaker-pricing",
+    "KENDRA_INDEX_ID": "test-index",
+    "SAGEMAKER_PRICING_DATABASE": "test-pricing-db",
+    "LOG_LEVEL": "INFO",
+}.items():
+    os.environ.setdefault(key, value)
+
+if LAMBDA_DIR not in sys.path:
+    sys.path.insert(0, LAMBDA_DIR)
@@ -0,0 +1,142 @@
+import threading
+from typing import Any, List
+
+import pytest
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import sagemaker_agent
+
+FINAL = '{"text": "Use ml.p3.2xlarge.", "source": "[Guide](https://example.com)"}'
+
+
+class ScriptedAgentModel(BaseChatModel):
+    """Chat model issuing scripted tool calls, then a final answer."""
+
+    turns: List[Any] = []
+    calls: List[Any] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-agent"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _generate(self, messages: List[BaseMessage], stop=None, **kwargs):
+        self.calls.append(messages)
+        step = sum(isinstance(m, AIMessage) for m in messages)
+        tool_calls = self.turns[step] if step < len(self.turns) else []
+        if "run out of time" in str(messages[-1].content):
+            tool_calls = []
+        message = AIMessage(content="" if tool_calls else FINAL, tool_calls=tool_calls)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def docs_call(call_id, query="How do I train on GPUs?"):
+    return {
+        "name": "sagemaker_developer_guide",
+        "args": {"query": query},
+        "id": call_id,
+    }
+
+
+@pytest.fixture
+def doc_calls(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def doc_retrieval(query):
+        with lock:
+            calls.append(query)
+        return {"answer": "Use GPU instances.", "source": "guide"}
+
+    monkeypatch.setattr(sagemaker_agent, "doc_retrieval", doc_retrieval)
+    monkeypatch.setattr(sagemaker_agent, "_agents", {})
+    return calls
+
+
+def test_identical_tool_calls_run_once_per_request(doc_calls):
+    llm = ScriptedAgentModel(
+        turns=[
+            [docs_call("1"), docs_call("2")],
+            [docs_call("3", "how do i train on gpus")],
+        ],
+        calls=[],
+    )
+
+    output = sagemaker_agent.agent_call(llm, "Which instance should I train on?")
+
+    assert output["answer"] == "Use ml.p3.2xlarge."
+    assert len(doc_calls) == 1
+    assert len(llm.calls) == 3
+
+    sagemaker_agent.agent_call(llm, "Which instance should I train on?")
+    # The memo only lives for one request
+    assert len(doc_calls) == 2
+
+
+def test_agent_is_compiled_once(doc_calls, monkeypatch):
+    compiled = []
+    create_react_agent = sagemaker_agent.create_react_agent
+
+    def counting_create_react_agent(**kwargs):
+        compiled.append(kwargs)
+        return create_react_agent(**kwargs)
+
+    monkeypatch.setattr(
+        sagemaker_agent, "create_react_agent", counting_create_react_agent
+    )
+    llm = ScriptedAgentModel(turns=[], calls=[])
+
+    sagemaker_agent.agent_call(llm, "What is SageMaker?")
+    sagemaker_agent.agent_call(llm, "What is SageMaker?")
+
+    assert len(compiled) == 1
+
+
+def test_step_budget_forces_a_final_answer(doc_calls):
+    llm = ScriptedAgentModel(
+        turns=[[docs_call(str(i), f"question {i}")] for i in range(10)], calls=[]
+    )
+
+    output = sagemaker_agent.agent_call(llm, "Which instance?", max_steps=2)
+
+    assert output["answer"] == "Use ml.p3.2xlarge."
+    # Two agent steps, the tool calls of both, then the final answer
+    assert len(llm.calls) == 3
+    assert "Use GPU instances." in llm.calls[-1][-1].content
+    assert doc_calls == ["question 0", "question 1"]
+
+
+def test_tool_calls_of_the_last_allowed_step_are_run(doc_calls):
+    llm = ScriptedAgentModel(
+        turns=[[docs_call(str(i), f"question {i}")] for i in range(10)], calls=[]
+    )
+
+    output = sagemaker_agent.agent_call(llm, "Which instance?", max_steps=1)
+
+    assert output["answer"] == "Use ml.p3.2xlarge."
+    assert doc_calls == ["question 0"]
+    assert len(llm.calls) == 2
+    assert "Use GPU instances." in llm.calls[-1][-1].content
+
+
+def test_evidence_tools_return_raw_excerpts(doc_calls, monkeypatch):
+    monkeypatch.setattr(
+        sagemaker_agent,
+        "doc_evidence",
+        lambda query: [
+            {"rank": 1, "title": "GPU", "url": "https://g", "excerpt": "Use GPUs."}
+        ],
+    )
+    llm = ScriptedAgentModel(turns=[[docs_call("1")]], calls=[])
+
+    output = sagemaker_agent.agent_call(llm, "Which instance?", tool_mode="evidence")
+
+    assert output["answer"] == "Use ml.p3.2xlarge."
+    assert doc_calls == []
+    tool_message = llm.calls[-1][-1]
+    assert tool_message.name == "sagemaker_developer_guide"
+    assert '"url": "https://g"' in tool_message.content
@@ -0,0 +1,188 @@
+import pytest
+
+import answer_cache
+import index
+from answer_cache import SemanticAnswerCache
+
+# Hand-made embeddings: the first two questions are paraphrases
+VECTORS = {
+    "what is sagemaker studio?": [1.0, 0.0, 0.0],
+    "what's sagemaker studio": [0.98, 0.2, 0.0],
+    "how do i deploy a model?": [0.0, 1.0, 0.0],
+    "price of ml.p3.2xlarge": [0.0, 0.0, 1.0],
+    "price of ml.p4d.24xlarge": [0.0, 0.05, 1.0],
+}
+
+
+class FakeEmbedder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, text):
+        self.calls.append(text)
+        return VECTORS[text.lower()]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def cache():
+    return SemanticAnswerCache(FakeEmbedder(), threshold=0.9, maxsize=8, ttl=60)
+
+
+def test_similar_question_in_same_scope_hits(cache):
+    miss = cache.lookup("What is SageMaker Studio?", "UseCase1")
+    assert miss.answer is None
+    cache.store(
+        "What is SageMaker Studio?", "UseCase1", {"answer": "IDE"}, 2.5, miss.embedding
+    )
+
+    hit = cache.lookup("What's SageMaker Studio", "UseCase1")
+
+    assert hit.answer == {"answer": "IDE"}
+    assert hit.similarity > 0.9
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["latency_saved_seconds"] == 2.5
+    assert sum(stats["similarity_histogram"].values()) == 1
+
+
+def test_exact_repeat_hits_without_embedding(cache):
+    cache.store("What is SageMaker Studio?", "UseCase1", {"answer": "IDE"}, 1.0)
+    cache._embed.calls.clear()
+
+    hit = cache.lookup("what is sagemaker  studio", "UseCase1")
+
+    assert hit.answer == {"answer": "IDE"}
+    assert cache._embed.calls == []
+
+
+def test_lookup_uses_the_embedding_started_in_the_background(cache):
+    cache.store("What is SageMaker Studio?", "UseCase1", {"answer": "IDE"}, 1.0)
+    cache._embed.calls.clear()
+
+    future = answer_cache.start_embedding(cache, "What's SageMaker Studio")
+    hit = cache.lookup("What's SageMaker Studio", "UseCase1", future)
+
+    assert hit.answer == {"answer": "IDE"}
+    assert cache._embed.calls == ["What's SageMaker Studio"]
+    assert answer_cache.start_embedding(None, "What's SageMaker Studio") is None
+
+
+def test_scopes_and_threshold_are_respected(cache):
+    cache.store("What is SageMaker Studio?", "UseCase1", {"answer": "IDE"}, 1.0)
+
+    assert cache.lookup("What's SageMaker Studio", "UseCase3").answer is None
+    assert cache.lookup("How do I deploy a model?", "UseCase1").answer is None
+
+
+def test_questions_about_other_instances_do_not_hit(cache):
+    cache.store("Price of ml.p3.2xlarge", "UseCase2", {"answer": "$3.825"}, 1.0)
+
+    lookup = cache.lookup("Price of ml.p4d.24xlarge", "UseCase2")
+
+    assert lookup.similarity > 0.9
+    assert lookup.answer is None
+
+
+def test_entries_expire_and_follow_data_version():
+    clock = FakeClock()
+    version = ["v1"]
+    cache = SemanticAnswerCache(
+        FakeEmbedder(), ttl=60, version=lambda: version[0], clock=clock
+    )
+    cache.store("How do I deploy a model?", "UseCase1", {"answer": "a"}, 1.0)
+    cache.lookup("How do I deploy a model?", "UseCase1")
+    cache.store("How do I deploy a model?", "UseCase1", {"answer": "a"}, 1.0)
+    assert cache.lookup("How do I deploy a model?", "UseCase1").answer is not None
+
+    version[0] = "v2"
+    assert cache.lookup("How do I deploy a model?", "UseCase1").answer is None
+
+    cache.store("How do I deploy a model?", "UseCase1", {"answer": "a"}, 1.0)
+    clock.now = 61
+    assert cache.lookup("How do I deploy a model?", "UseCase1").answer is None
+
+
+def test_unknown_data_version_bypasses_the_cache():
+    version = [None]
+    cache = SemanticAnswerCache(FakeEmbedder(), version=lambda: version[0])
+
+    assert cache.lookup("How do I deploy a model?", "UseCase1") is None
+    assert (
+        answer_cache.lookup_answer(cache, "How do I deploy?", "UseCase1", None) is None
+    )
+    assert cache.stats()["bypassed"] == 2 and len(cache) == 0
+
+    version[0] = "v1"
+    assert cache.lookup("How do I deploy a model?", "UseCase1").answer is None
+
+
+def test_follow_ups_bypass_the_cache_only_with_history(cache, monkeypatch):
+    class History:
+        def __init__(self, messages):
+            self.messages = messages
+
+    histories = {"new": History([]), "chat": History(["earlier turn"])}
+    monkeypatch.setattr(answer_cache, "get_by_session_id", histories.get)
+    cache.store("Price of ml.p3.2xlarge", "UseCase2", {"answer": "$3.825"}, 1.0)
+
+    assert answer_cache.lookup_answer(
+        cache, "Price of ml.p3.2xlarge", "UseCase2", "chat"
+    )
+    assert (
+        answer_cache.lookup_answer(cache, "How much does it cost?", "UseCase2", "chat")
+        is None
+    )
+    assert cache.stats()["bypassed"] == 1
+    # The same wording opening a conversation is not a follow-up
+    assert answer_cache.lookup_answer(
+        cache, "How do I deploy a model?", "UseCase1", "new"
+    )
+    assert answer_cache.lookup_answer(cache, "x", "MaliciousQuery", "chat") is None
+
+
+def test_documentation_answers_with_history_skip_the_cache(cache, monkeypatch):
+    class History:
+        messages = ["earlier turn"]
+
+    monkeypatch.setattr(answer_cache, "get_by_session_id", lambda session: History())
+    cache.store("What is SageMaker Studio?", "UseCase1", {"answer": "IDE"}, 1.0)
+
+    # documentation answers follow the session history, whatever the wording
+    assert (
+        answer_cache.lookup_answer(
+            cache, "What is SageMaker Studio?", "UseCase1", "chat"
+        )
+        is None
+    )
+    assert answer_cache.lookup_answer(
+        cache, "What is SageMaker Studio?", "UseCase1", None
+    )
+    assert cache.stats()["bypassed"] == 1
+
+
+def test_get_response_serves_repeated_questions_from_cache(cache, monkeypatch):
+    calls = []
+
+    def query_pricing(query):
+        calls.append(query)
+        return {"source": "SELECT 1", "answer": "$3.825"}
+
+    monkeypatch.setattr(index, "get_cached_or_local_intent", lambda query: "UseCase2")
+    monkeypatch.setattr(index, "query_pricing", query_pricing)
+    monkeypatch.setattr(index, "get_answer_cache", lambda: cache)
+
+    first = index.get_response("Price of ml.p3.2xlarge", None)
+    second = index.get_response("price of ml.p3.2xlarge?", None)
+    streamed = list(index.get_response_stream("Price of ml.p3.2xlarge", None))
+
+    assert first == second == {"source": "SELECT 1", "answer": "$3.825"}
+    assert streamed[0] == {"type": "delta", "text": "$3.825"}
+    assert calls == ["Price of ml.p3.2xlarge"]
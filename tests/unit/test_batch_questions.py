@@ -0,0 +1,137 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+from tests.unit.conftest import ROOT_DIR  # noqa: F401  (sets up the environment)
+
+import batch_questions
+from benchmarks.run_benchmark import BenchmarkHarness, DEFAULT_CORPUS, load_corpus
+from benchmarks.stubs import LatencyModel
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_backs_off_on_throttles_and_recovers():
+    clock = FakeClock()
+    bucket = batch_questions.AdaptiveTokenBucket(
+        rate=2.0, max_rate=2.0, increase=0.5, clock=clock, sleep=clock.sleep
+    )
+
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.now == pytest.approx(1.0)
+
+    bucket.on_throttle()
+    bucket.on_throttle()  # same cooldown window, counted once
+    assert bucket.rate == 1.0
+    bucket.acquire()
+    assert clock.now == pytest.approx(2.0)
+
+    bucket.on_success()
+    bucket.on_success()
+    assert bucket.rate == 2.0
+
+
+def test_is_throttling_error_follows_the_exception_chain():
+    throttle = ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "slow down"}},
+        "InvokeModel",
+    )
+    try:
+        try:
+            raise throttle
+        except ClientError as e:
+            raise ValueError("Error raised by bedrock service") from e
+    except ValueError as e:
+        wrapped = e
+
+    assert batch_questions.is_throttling_error(throttle)
+    assert batch_questions.is_throttling_error(wrapped)
+    assert not batch_questions.is_throttling_error(ValueError("bad input"))
+
+
+@pytest.fixture
+def harness(tmp_path):
+    entries, _ = load_corpus(DEFAULT_CORPUS)
+    picked = {}
+    for entry in entries:
+        if "session" not in entry:
+            picked.setdefault(entry["intent"], entry)
+    harness = BenchmarkHarness(list(picked.values()), LatencyModel(scale=0))
+    harness.install()
+    questions = tmp_path / "questions.jsonl"
+    questions.write_text(
+        "".join(
+            json.dumps({"id": entry["id"], "query": entry["query"]}) + "\n"
+            for entry in harness.corpus
+        )
+    )
+    yield harness, str(questions)
+    harness.uninstall()
+
+
+def _runner():
+    return batch_questions.BatchRunner(
+        bucket=batch_questions.AdaptiveTokenBucket(rate=1000, max_rate=1000),
+        concurrency=2,
+        backoff=0,
+        sleep=lambda seconds: None,
+    )
+
+
+def test_batch_retries_throttled_questions_and_resumes(harness, tmp_path):
+    harness, questions = harness
+    from connections import Connections
+
+    output = tmp_path / "answers.jsonl"
+    # an interrupted earlier run: one answered question and a partial line
+    first_id = harness.corpus[0]["id"]
+    output.write_text(json.dumps({"id": first_id, "status": "ok"}) + '\n{"id": ')
+    # the throttles reach the batch instead of the Bedrock gateway's retries
+    Connections.bedrock_client.max_attempts = 1
+    Connections.bedrock_client.inject_throttles(2, operations=("InvokeModel",))
+
+    summary = batch_questions.run_batch(questions, str(output), _runner())
+
+    records = [json.loads(line) for line in output.read_text().splitlines()[2:]]
+    assert summary["total"] == 4 and summary["skipped"] == 1
+    assert (summary["ok"], summary["errors"], summary["complete"]) == (3, 0, True)
+    # a throttled answer cache lookup falls back to answering the question
+    assert Connections.bedrock_client.throttled_calls == 2
+    assert summary["throttles"] >= 1
+    assert sorted(r["id"] for r in records) == sorted(
+        entry["id"] for entry in harness.corpus[1:]
+    )
+    assert all(r["status"] == "ok" and r["latency_ms"] >= 0 for r in records)
+    assert sum(r["attempts"] - 1 for r in records) == summary["throttles"]
+
+    again = batch_questions.run_batch(questions, str(output), _runner())
+    assert (again["skipped"], again["ok"]) == (4, 0)
+
+
+def test_batch_event_stops_before_the_lambda_timeout(harness, tmp_path):
+    harness, questions = harness
+
+    class Context:
+        aws_request_id = "req-1"
+
+        def get_remaining_time_in_millis(self):
+            return 1000
+
+    output = tmp_path / "answers.jsonl"
+    summary = batch_questions.run_batch_event(
+        {"input": questions, "output": str(output)}, Context()
+    )
+
+    assert summary["complete"] is False
+    assert summary["ok"] == 0 and not output.read_text()
@@ -0,0 +1,132 @@
+import json
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import bedrock_gateway
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "InvokeModel")
+
+
+class FakeBedrock:
+    """
+    invoke_model answering after a delay per model id, or raising the queued
+    errors first.
+    """
+
+    def __init__(self, delays=None, errors=None):
+        self.delays = delays or {}
+        self.errors = list(errors or [])
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def invoke_model(self, **kwargs):
+        with self._lock:
+            self.calls.append(kwargs)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            error = self.errors.pop(0) if self.errors else None
+        try:
+            time.sleep(self.delays.get(kwargs["modelId"], 0))
+            if error:
+                raise error
+            return {"model": kwargs["modelId"]}
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def gateway(client, **kwargs):
+    return bedrock_gateway.BedrockGateway(
+        client, backoff=0, sleep=lambda seconds: None, **kwargs
+    )
+
+
+def test_retries_throttles_and_fails_fast_on_validation_errors():
+    client = FakeBedrock(errors=[client_error("ThrottlingException")] * 2)
+    assert gateway(client).invoke_model(modelId="haiku", body="{}") == {
+        "model": "haiku"
+    }
+    assert len(client.calls) == 3
+
+    client = FakeBedrock(errors=[client_error("ValidationException")])
+    with pytest.raises(ClientError):
+        gateway(client).invoke_model(modelId="haiku", body="{}")
+    assert len(client.calls) == 1
+
+
+def test_circuit_opens_routes_to_the_fallback_and_recovers():
+    now = [0.0]
+    client = FakeBedrock(errors=[client_error("ServiceUnavailableException")] * 3)
+    gw = gateway(
+        client,
+        max_attempts=1,
+        breaker_failures=3,
+        breaker_reset_seconds=30,
+        fallback_models={"sonnet": "haiku"},
+        clock=lambda: now[0],
+    )
+    for _ in range(3):
+        with pytest.raises(ClientError):
+            gw.invoke_model(modelId="sonnet", body="{}")
+
+    assert gw.stats()["sonnet"] == "open"
+    assert gw.invoke_model(modelId="sonnet", body="{}") == {"model": "haiku"}
+    for _ in range(3):
+        gw.breaker("other").record_failure()
+    with pytest.raises(bedrock_gateway.CircuitOpenError):
+        gw.invoke_model(modelId="other", body="{}")
+    now[0] = 31.0
+    assert gw.invoke_model(modelId="sonnet", body="{}") == {"model": "sonnet"}
+    assert gw.stats()["sonnet"] == "closed"
+
+
+def test_concurrency_is_limited_per_model_and_attempts_time_out():
+    client = FakeBedrock(delays={"haiku": 0.05, "slow": 1.0})
+    gw = gateway(client, model_concurrency={"haiku": 2}, max_attempts=1)
+    threads = [
+        threading.Thread(
+            target=gw.invoke_model, kwargs={"modelId": "haiku", "body": "{}"}
+        )
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.max_active == 2
+
+    gw.call_timeout = 0.05
+    start = time.perf_counter()
+    with pytest.raises(bedrock_gateway.CallTimeoutError):
+        gw.invoke_model(modelId="slow", body="{}")
+    assert time.perf_counter() - start < 0.5
+
+
+def test_slow_calls_are_hedged_to_the_fallback_model():
+    client = FakeBedrock()
+    gw = gateway(
+        client,
+        fallback_models={"sonnet": "haiku"},
+        hedging=True,
+        hedge_min_samples=5,
+        models_without_sampling_params={"haiku"},
+    )
+    body = json.dumps({"max_tokens": 256, "temperature": 0})
+    for _ in range(5):
+        gw.invoke_model(modelId="sonnet", body=body)
+    assert gw.hedge_delay("sonnet", 256) is not None
+
+    client.delays["sonnet"] = 1.0
+    start = time.perf_counter()
+    assert gw.invoke_model(modelId="sonnet", body=body) == {"model": "haiku"}
+    assert time.perf_counter() - start < 0.5
+    hedge = client.calls[-1]
+    assert hedge["modelId"] == "haiku"
+    assert json.loads(hedge["body"]) == {"max_tokens": 256}
@@ -0,0 +1,61 @@
+import json
+
+from tests.unit.conftest import ROOT_DIR  # noqa: F401  (sets up the environment)
+
+from benchmarks.run_benchmark import DEFAULT_CORPUS, compare, load_corpus, run_benchmark
+
+
+def _small_corpus(tmp_path):
+    entries, _ = load_corpus(DEFAULT_CORPUS)
+    picked = {}
+    for entry in entries:
+        if "session" not in entry:
+            picked.setdefault(entry["intent"], entry)
+    path = tmp_path / "queries.jsonl"
+    path.write_text("".join(json.dumps(entry) + "\n" for entry in picked.values()))
+    return str(path)
+
+
+def test_benchmark_replays_every_intent(tmp_path):
+    results = run_benchmark(_small_corpus(tmp_path), latency_scale=0)
+
+    summary = results["summary"]
+    assert summary["requests"] == 4
+    assert summary["errors"] == 0
+    assert set(summary["latency_ms"]) == {"p50", "p95", "p99", "mean", "count"}
+    assert set(summary["latency_ms_by_intent"]) == {
+        "UseCase1",
+        "UseCase2",
+        "UseCase3",
+        "MaliciousQuery",
+    }
+    assert {"intent", "retrieval", "synthesis", "agent_step"} <= set(
+        summary["stages_ms"]
+    )
+    assert summary["llm"]["calls"] > 0
+    assert results["corpus"]["version"].startswith("queries.jsonl@")
+    assert results["config"]["query_engine_build_s"]
+    json.dumps(results)
+
+
+def test_compare_reports_relative_change():
+    baseline = {
+        "latency_ms": {"p50": 100, "p95": 200, "p99": 400},
+        "stages_ms": {"synthesis": {"p50": 50, "p95": 50, "p99": 50}},
+        "llm": {"calls": 4, "input_tokens": 1000, "output_tokens": 0},
+    }
+    summary = {
+        "latency_ms": {"p50": 50, "p95": 200, "p99": 500},
+        "stages_ms": {"synthesis": {"p50": 25, "p95": 50, "p99": 75}},
+        "llm": {"calls": 2, "input_tokens": 1500, "output_tokens": 10},
+    }
+
+    report = compare(summary, baseline)
+
+    assert report["latency_ms"] == {"p50": -50.0, "p95": 0.0, "p99": 25.0}
+    assert report["stages_ms"]["synthesis"] == {"p50": -50.0, "p95": 0.0, "p99": 50.0}
+    assert report["llm"] == {
+        "calls": -50.0,
+        "input_tokens": 50.0,
+        "output_tokens": None,
+    }
@@ -1,14 +1,17 @@
 import aws_cdk as core
 import aws_cdk.assertions as assertions
+import pytest
 
 from aws_cdk.assertions import Match
-from code.code_stack import CodeStack
+from code.code_stack import CodeStack, check_table_index
 
 
 STACK = CodeStack(
     core.App(
         context={
             "logging": {"lambda_log_level": "INFO", "streamlit_log_level": "INFO"},
+            # the prebuilt table index needs Bedrock credentials to build
+            "require_table_index": False,
         }
     ),
     "code",
@@ -85,6 +88,30 @@ def test_lambda_created():
                 "Timeout": 900,
                 "Architectures": ["arm64"],
                 "FunctionName": {"Fn::Join": ["", [Match.any_value(), "-chat-lambda"]]},
+                "ImageConfig": {
+                    "EntryPoint": ["python3", "-m", "streaming_runtime"]
+                },
+            }
+        ),
+    )
+
+
+def test_session_table_created():
+    template = assertions.Template.from_stack(STACK)
+
+    template.resource_count_is("AWS::DynamoDB::Table", 1)
+    template.has_resource_properties(
+        "AWS::DynamoDB::Table",
+        Match.object_like(
+            {
+                "KeySchema": [{"AttributeName": "session_id", "KeyType": "HASH"}],
+                "TimeToLiveSpecification": {
+                    "AttributeName": "expires_at",
+                    "Enabled": True,
+                },
+                "PointInTimeRecoverySpecification": {
+                    "PointInTimeRecoveryEnabled": True
+                },
             }
         ),
     )
@@ -137,3 +164,12 @@ def test_streamlit_app_created():
         "AWS::ElasticLoadBalancingV2::Listener",
         Match.object_like({"Port": 8080, "Protocol": "HTTP"}),
     )
+
+
+def test_synth_fails_without_the_prebuilt_table_index(tmp_path):
+    with pytest.raises(FileNotFoundError, match="build_table_index.py"):
+        check_table_index(str(tmp_path))
+
+    (tmp_path / "table_index").mkdir()
+    (tmp_path / "table_index" / "manifest.json").write_text('{"fingerprint": "f"}')
+    check_table_index(str(tmp_path))
@@ -0,0 +1,113 @@
+import threading
+
+from data_version import DataVersion, VersionedValue
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class DeferredExecutor:
+    """
+    Runs the submitted refreshes when the test says so.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def submit(self, fn):
+        self.pending.append(fn)
+
+    def run(self):
+        pending, self.pending = self.pending, []
+        for fn in pending:
+            fn()
+
+
+def test_versions_are_refreshed_in_the_background():
+    clock, executor = FakeClock(), DeferredExecutor()
+    versions = iter(["v1", "v2"])
+    version = DataVersion(
+        "test", lambda: next(versions), ttl=60, clock=clock, executor=executor
+    )
+
+    # unknown until the first background refresh ran, and refreshed only once
+    assert version.get() is None and version.get() is None
+    assert len(executor.pending) == 1
+    executor.run()
+    assert version.get() == "v1"
+
+    # the expired version is served while it is recomputed
+    clock.now = 61
+    assert version.get() == "v1"
+    executor.run()
+    assert version.get() == "v2" and not executor.pending
+
+
+def test_failed_refreshes_keep_the_version_and_retry_sooner():
+    clock, executor = FakeClock(), DeferredExecutor()
+    results = ["v1", RuntimeError("S3 is down"), RuntimeError("S3 is down")]
+
+    def compute():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    version = DataVersion(
+        "test", compute, ttl=300, retry=30, clock=clock, executor=executor
+    )
+    assert version.refresh() == "v1"
+
+    clock.now = 300
+    version.get()
+    executor.run()
+    assert version.get() == "v1" and not executor.pending
+    clock.now = 330
+    assert version.get() == "v1" and len(executor.pending) == 1
+
+    failing = DataVersion("test", compute, clock=clock, executor=executor)
+    executor.pending.clear()
+    failing.get()
+    executor.run()
+    # a version that was never computed stays unknown, not "unknown"
+    assert failing.get() is None
+
+
+def test_get_does_not_wait_for_a_slow_refresh():
+    release = threading.Event()
+
+    def compute():
+        release.wait(5)
+        return "v1"
+
+    version = DataVersion("test", compute)
+    assert version.get() is None
+    release.set()
+
+
+class StubVersion:
+    def __init__(self, version):
+        self.version = version
+
+    def get(self):
+        return self.version
+
+
+def test_versioned_values_are_rebuilt_when_the_version_changes():
+    version = StubVersion(None)
+    builds = iter(["built 1", "built 2", "built 3"])
+    value = VersionedValue(version, lambda: next(builds))
+
+    # built once while the version is unknown, then kept
+    assert value.get() == "built 1" and value.get() == "built 1"
+    version.version = "v1"
+    assert value.get() == "built 2" and value.get() == "built 2"
+    version.version = None
+    assert value.get() == "built 2"
+    version.version = "v2"
+    assert value.get() == "built 3"
@@ -0,0 +1,155 @@
+import time
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.messages import ToolMessage
+from sqlalchemy import create_engine, text
+
+import bedrock_gateway
+import deadline
+import sagemaker_agent
+import sagemaker_dg_rag
+import sagemaker_pricing
+from connections import Connections
+
+
+class LambdaContext:
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def test_the_earliest_deadline_wins():
+    assert deadline.remaining() is None
+    with deadline.request_deadline(100, LambdaContext(30_000)):
+        assert 20 < deadline.remaining() <= 30 - deadline.DEADLINE_MARGIN_SECONDS
+        with deadline.request_deadline(1000):
+            assert deadline.remaining() <= 25
+        assert deadline.bounded(5) == 5
+        with pytest.raises(deadline.DeadlineExceeded):
+            deadline.check("synthesis", reserve=60)
+    assert deadline.remaining() is None
+
+
+def test_sql_statements_are_cancelled_at_the_deadline():
+    engine = deadline.cancel_sql_on_deadline(create_engine("sqlite://"))
+    slow_query = text(
+        "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) "
+        "SELECT count(*) FROM n"
+    )
+    start = time.perf_counter()
+    with deadline.request_deadline(0.2), engine.connect() as conn:
+        with pytest.raises(deadline.DeadlineExceeded):
+            conn.execute(slow_query)
+    assert time.perf_counter() - start < 5
+
+    with deadline.request_deadline(10), engine.connect() as conn:
+        assert conn.execute(text("SELECT 1")).scalar() == 1
+
+
+def test_gateway_attempts_stop_at_the_deadline():
+    class SlowBedrock:
+        calls = 0
+
+        def invoke_model(self, **kwargs):
+            SlowBedrock.calls += 1
+            time.sleep(1)
+
+    gateway = bedrock_gateway.BedrockGateway(SlowBedrock(), backoff=0)
+    with deadline.request_deadline(0.1):
+        with pytest.raises(deadline.DeadlineExceeded):
+            gateway.invoke_model(modelId="sonnet", body="{}")
+        with pytest.raises(deadline.DeadlineExceeded):
+            gateway.invoke_model(modelId="sonnet", body="{}")
+    assert SlowBedrock.calls == 1
+    assert gateway.stats()["sonnet"] == "closed"
+
+
+def test_rag_answers_with_the_excerpts_when_out_of_time(monkeypatch):
+    def no_llm(**kwargs):
+        raise AssertionError("no time for an LLM call")
+
+    monkeypatch.setattr(Connections, "get_bedrock_llm", staticmethod(no_llm))
+    monkeypatch.setattr(
+        sagemaker_dg_rag,
+        "resolve_source_links",
+        lambda sources: {source: "https://docs/page" for source in sources},
+    )
+    docs = [
+        Document(
+            page_content="",
+            metadata={
+                "title": "Studio",
+                "source": "s3://studio",
+                "excerpt": "Studio is an IDE.",
+            },
+        )
+    ]
+
+    with deadline.request_deadline(1):
+        output = sagemaker_dg_rag.doc_retrieval("What is Studio?", docs=docs)
+        frames = list(
+            sagemaker_dg_rag.doc_retrieval_stream("What is Studio?", docs=docs)
+        )
+
+    assert output["degraded"] is True
+    assert output["answer"].startswith(sagemaker_dg_rag.EXCERPTS_INTRO)
+    assert "1. **Studio**: Studio is an IDE." in output["answer"]
+    assert frames[0]["text"] == output["answer"]
+    assert frames[-1]["degraded"] is True
+
+
+def test_pricing_answers_with_the_rows_when_out_of_time(monkeypatch):
+    evidence = {
+        "sql": "SELECT instance_type, price FROM training_price LIMIT 2",
+        "columns": ["instance_type", "price"],
+        "rows": [["ml.m5.large", 0.115], ["ml.g5.xlarge", 1.408]],
+        "row_count": 3,
+    }
+    monkeypatch.setattr(sagemaker_pricing, "resolve_price_lookup", lambda q: None)
+    monkeypatch.setattr(sagemaker_pricing, "query_pricing_evidence", lambda q: evidence)
+
+    with deadline.request_deadline(1):
+        output = sagemaker_pricing.query_pricing("Cheapest training instances?")
+
+    assert output["degraded"] is True
+    assert output["source"] == evidence["sql"]
+    assert "| ml.g5.xlarge | 1.408 |" in output["answer"]
+    assert output["answer"].endswith("First 2 of 3 rows.")
+
+
+def test_pricing_rows_answer_tells_empty_results_from_lack_of_time():
+    empty = {"sql": "SELECT 1", "columns": [], "rows": [], "row_count": 0}
+    failed = {**empty, "error": "Error: SQL query cancelled at the request deadline"}
+
+    with deadline.request_deadline(1):
+        assert sagemaker_pricing.rows_answer(empty)["answer"] == (
+            "No matching pricing rows were found."
+        )
+    with deadline.request_deadline(0):
+        assert "not enough time" in sagemaker_pricing.rows_answer(failed)["answer"]
+    assert sagemaker_pricing.rows_answer(failed)["answer"] == (
+        "The pricing data could not be looked up."
+    )
+
+
+def test_agent_returns_the_tool_results_when_out_of_time(monkeypatch):
+    def steps(llm, messages, max_steps, max_seconds, tool_mode):
+        messages.append(
+            ToolMessage(
+                content="ml.m5.large costs $0.115/hr",
+                name="sagemaker_pricing_data_retrieval",
+                tool_call_id="toolu_0",
+            )
+        )
+        raise deadline.DeadlineExceeded("no time left")
+
+    monkeypatch.setattr(sagemaker_agent, "_run_agent_steps", steps)
+
+    output = sagemaker_agent.agent_call(llm=None, query="Price of ml.m5.large?")
+
+    assert output["degraded"] is True
+    assert output["answer"].startswith(sagemaker_agent.PARTIAL_ANSWER_INTRO)
+    assert "ml.m5.large costs $0.115/hr" in output["answer"]
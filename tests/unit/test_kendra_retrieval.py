@@ -0,0 +1,64 @@
+import pytest
+
+import sagemaker_dg_rag
+from connections import Connections
+
+
+class FakeKendra:
+    def __init__(self):
+        self.calls = []
+
+    def retrieve(self, **kwargs):
+        self.calls.append(kwargs)
+        return {
+            "QueryId": "q-1",
+            "ResultItems": [
+                {
+                    "Id": "1",
+                    "DocumentId": "doc-1",
+                    "DocumentURI": "https://s3.us-east-1.amazonaws.com/b/sm_dg/a.txt",
+                    "DocumentTitle": "Title",
+                    "Content": "SageMaker is a managed service.",
+                    "ScoreAttributes": {"ScoreConfidence": "HIGH"},
+                    "DocumentAttributes": [],
+                }
+            ]
+        }
+
+
+@pytest.fixture
+def kendra(monkeypatch):
+    fake = FakeKendra()
+    monkeypatch.setattr(Connections, "kendra_client", fake)
+    monkeypatch.setattr(sagemaker_dg_rag, "_retrievers", {})
+    sagemaker_dg_rag.retrieval_cache.invalidate()
+    yield fake
+    sagemaker_dg_rag.retrieval_cache.invalidate()
+
+
+def test_retriever_is_reused_with_the_shared_client(kendra):
+    retriever = sagemaker_dg_rag.get_kendra_retriever(K=5)
+
+    assert sagemaker_dg_rag.get_kendra_retriever(K=5) is retriever
+    assert sagemaker_dg_rag.get_kendra_retriever(K=3) is not retriever
+    assert retriever.client is kendra
+
+
+def test_repeated_queries_are_served_from_the_cache(kendra):
+    first = sagemaker_dg_rag.retrieve_documents("What is SageMaker?")
+    second = sagemaker_dg_rag.retrieve_documents("What is SageMaker?")
+
+    assert len(kendra.calls) == 1
+    assert [d.page_content for d in first] == [d.page_content for d in second]
+    assert first[0].metadata["source"].endswith("sm_dg/a.txt")
+
+    sagemaker_dg_rag.retrieve_documents("What is SageMaker?", K=3)
+    assert len(kendra.calls) == 2
+
+
+def test_invalidation_forces_a_new_kendra_call(kendra):
+    sagemaker_dg_rag.retrieve_documents("What is SageMaker?")
+    sagemaker_dg_rag.invalidate_retrieval_cache()
+    sagemaker_dg_rag.retrieve_documents("What is SageMaker?")
+
+    assert len(kendra.calls) == 2
@@ -0,0 +1,102 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+
+from llm_usage import UsageCallback, record_usage, track_usage
+from output_budget import OutputBudget, response_stage
+
+
+def test_usage_is_added_to_every_enclosing_scope():
+    with track_usage() as request:
+        record_usage("intent", 100, 5)
+        with track_usage() as agent:
+            record_usage("agent", 1000, 200)
+            with ThreadPoolExecutor() as executor:
+                # Tool threads inherit the scope through the copied context
+                executor.submit(
+                    contextvars.copy_context().run, record_usage, "rag", 500, 50
+                ).result()
+
+    total = agent.summary()["total"]
+    assert (total["calls"], total["input_tokens"], total["output_tokens"]) == (
+        2,
+        1500,
+        250,
+    )
+    assert request.summary()["stages"]["intent"]["calls"] == 1
+    assert request.summary()["total"]["input_tokens"] == 1600
+
+
+def test_usage_outside_a_scope_is_ignored():
+    record_usage("intent", 100, 5)
+    with track_usage() as usage:
+        pass
+    assert usage.summary()["total"]["calls"] == 0
+
+
+def test_callback_records_cache_thinking_truncation_and_cost():
+    message = AIMessage(
+        content=[
+            {"type": "thinking", "thinking": "x" * 400},
+            {"type": "text", "text": "UseCase1"},
+        ],
+        usage_metadata={
+            "input_tokens": 1000,
+            "output_tokens": 200,
+            "total_tokens": 1200,
+            "input_token_details": {"cache_read": 4000, "cache_creation": 0},
+        },
+        response_metadata={"stop_reason": "max_tokens"},
+    )
+    result = LLMResult(generations=[[ChatGeneration(message=message)]])
+    callback = UsageCallback(
+        "intent", "global.anthropic.claude-haiku-4-5-20251001-v1:0"
+    )
+
+    with track_usage() as usage:
+        callback.on_llm_end(result)
+
+    summary = usage.summary()
+    intent = summary["stages"]["intent"]
+    assert intent["cache_read_tokens"] == 4000
+    assert intent["thinking_tokens"] == 100
+    assert intent["truncated"] == 1
+    # 1000 * $1 + 200 * $5 + 4000 * $0.1 per million tokens
+    assert intent["cost_usd"] == 0.0024
+    assert summary["total"]["cost_usd"] == 0.0024
+    assert summary["models"] == {"global.anthropic.claude-haiku-4-5-20251001-v1:0": 1}
+
+
+def test_output_budget_follows_observed_lengths():
+    budget = OutputBudget(enabled=True, min_samples=10, headroom=1.25, floor=16)
+    assert budget.max_tokens("rag", 4096) == 4096
+
+    for tokens in [150, 180, 200, 220, 300] * 2:
+        budget.observe("rag", tokens)
+    # p99 of ~296 tokens with 25 % headroom, rounded up to a power of two
+    assert budget.max_tokens("rag", 4096) == 512
+    # The caller's max_tokens stays the ceiling
+    assert budget.max_tokens("rag", 256) == 256
+
+    budget.observe("rag", 512, truncated=True)
+    assert budget.max_tokens("rag", 4096) == 4096
+    assert budget.stats()["rag"]["truncations"] == 1
+
+
+def test_agent_tool_calls_and_final_answers_have_separate_budgets():
+    budget = OutputBudget(enabled=True, min_samples=10, headroom=1.25, floor=16)
+    for _ in range(30):
+        budget.observe(response_stage("agent", tool_calls=True), 60)
+    for tokens in [600, 700, 800, 900, 1000]:
+        budget.observe(response_stage("agent", tool_calls=False), tokens)
+    # too few final answers yet: the caller's max_tokens
+    assert budget.max_tokens("agent", 4096) == 4096
+
+    for tokens in [600, 700, 800, 900, 1000]:
+        budget.observe(response_stage("agent"), tokens)
+    # sized from the final answers only, not lowered by the short tool calls
+    assert budget.max_tokens("agent", 4096) == 2048
+    assert budget.stats()["agent_step"]["samples"] == 30
+    assert budget.stats()["agent_final"]["p99"] > 900
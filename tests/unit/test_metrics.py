@@ -0,0 +1,145 @@
+import contextvars
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import StaticPool
+
+import metrics
+from caching import LRUTTLCache
+from llm_usage import record_usage
+
+
+@pytest.fixture
+def warm(monkeypatch):
+    monkeypatch.setattr(metrics, "_state", {"cold_start": False, "init_seconds": 1.5})
+
+
+def test_request_emits_one_emf_record(warm):
+    @metrics.span("source_link")
+    def link_and_answer():
+        record_usage("rag", 100, 10, "model-a")
+
+    cache = LRUTTLCache(name="kendra")
+    cache.set("q", "docs")
+
+    with metrics.capture_metrics() as records:
+        with metrics.request_metrics("lambda_handler", sample_rate=1.0):
+            metrics.set_dimension("Intent", "UseCase1")
+            with metrics.span("doc_retrieval"):
+                cache.get("q")
+                cache.get("other")
+            with ThreadPoolExecutor() as executor:
+                # Tool threads report into the request through the copied context
+                for _ in range(2):
+                    executor.submit(
+                        contextvars.copy_context().run, link_and_answer
+                    ).result()
+
+    (record,) = records
+    definition = record["_aws"]["CloudWatchMetrics"][0]
+    names = {metric["Name"]: metric["Unit"] for metric in definition["Metrics"]}
+    assert names["lambda_handler"] == "Milliseconds"
+    assert names["kendra_cache_hits"] == "Count"
+    assert definition["Dimensions"] == [["Intent"], ["ColdStart"]]
+    assert record["Intent"] == "UseCase1"
+    assert record["ColdStart"] == "false"
+    assert isinstance(record["doc_retrieval"], float)
+    assert len(record["source_link"]) == 2
+    assert record["kendra_cache_hits"] == 1
+    assert record["kendra_cache_misses"] == 1
+    assert record["llm_calls"] == 2
+    assert record["input_tokens"] == 200
+    assert record["model_ids"] == ["model-a"]
+    assert "init" not in record
+    json.dumps(record)
+
+
+def test_sampling_skips_warm_requests_but_not_cold_starts(monkeypatch):
+    monkeypatch.setattr(metrics, "_state", {"cold_start": True, "init_seconds": 1.5})
+
+    with metrics.capture_metrics() as records:
+        for _ in range(3):
+            with metrics.request_metrics(sample_rate=0.0) as request:
+                with metrics.span("get_response"):
+                    pass
+
+    assert request is None
+    (record,) = records
+    assert record["ColdStart"] == "true"
+    assert record["init"] == 1500.0
+    assert "get_response" in record
+
+
+def test_spans_outside_a_request_do_nothing():
+    with metrics.capture_metrics() as records:
+        with metrics.span("get_response"):
+            metrics.increment("answer_cache_hits")
+    assert records == []
+
+
+def test_lambda_handler_measures_the_request(warm, monkeypatch):
+    import genai_chat_app
+
+    @metrics.span("get_response")
+    def get_response(query, session_id, include_usage=None):
+        metrics.set_dimension("Intent", "UseCase2")
+        return {"source": "s", "answer": "a"}
+
+    monkeypatch.setattr(genai_chat_app, "get_response", get_response)
+    event = {"body": json.dumps({"query": "q", "session_id": "s"})}
+
+    with metrics.capture_metrics() as records:
+        output = genai_chat_app.lambda_handler(
+            event, SimpleNamespace(aws_request_id="req-1")
+        )
+
+    assert output == {"source": "s", "answer": "a"}
+    (record,) = records
+    assert record["request_id"] == "req-1"
+    assert record["Intent"] == "UseCase2"
+    assert record["lambda_handler"] >= record["get_response"]
+
+
+def test_overlapping_sql_statements_are_timed_separately():
+    # One connection shared by every thread: statements of other threads wait
+    # for the running one
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+
+    @event.listens_for(engine, "connect")
+    def add_sleep(dbapi_connection, connection_record):
+        dbapi_connection.create_function("sleep", 1, time.sleep)
+
+    metrics.instrument_sql_engine(engine)
+    durations = {}
+
+    def request(statement, delay):
+        time.sleep(delay)
+        with metrics.capture_metrics() as records:
+            with metrics.request_metrics(statement, sample_rate=1.0):
+                with engine.connect() as conn:
+                    conn.execute(text(statement)).fetchall()
+        (durations[statement],) = [
+            record["sql_execution"] for record in records if statement in record
+        ]
+
+    # the second statement starts after the first and waits for it to end
+    threads = [
+        threading.Thread(target=request, args=("SELECT sleep(0.4)", 0)),
+        threading.Thread(target=request, args=("SELECT 1", 0.1)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert durations["SELECT sleep(0.4)"] >= 380
+    assert durations["SELECT 1"] < 380
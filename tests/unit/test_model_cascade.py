@@ -0,0 +1,116 @@
+import pytest
+from langchain_core.documents import Document
+from langchain_core.language_models import FakeListChatModel
+
+import model_cascade
+import sagemaker_dg_rag
+from connections import Connections
+from metrics import capture_metrics, request_metrics
+
+
+def test_run_keeps_verified_answers_and_escalates_rejected_ones():
+    cascade = model_cascade.ModelCascade("rag")
+    fallback_calls = []
+
+    def fallback():
+        fallback_calls.append(1)
+        return "fallback"
+
+    with capture_metrics() as records:
+        with request_metrics(sample_rate=1.0):
+            assert cascade.run(lambda: "good", fallback, lambda a: a == "good") == (
+                "good"
+            )
+            assert cascade.run(lambda: "bad", fallback, lambda a: a == "good") == (
+                "fallback"
+            )
+            assert cascade.run(lambda: 1 / 0, fallback, bool) == "fallback"
+
+    stats = cascade.stats()
+    assert len(fallback_calls) == 2
+    assert (stats["calls"], stats["escalations"]) == (3, 2)
+    assert stats["escalation_rate"] == pytest.approx(2 / 3)
+    assert stats["latency_saved_seconds"] is not None
+    assert records[-1]["rag_cascade_calls"] == 3
+    assert records[-1]["rag_cascade_escalations"] == 2
+
+
+def test_stream_holds_the_beginning_until_it_is_verified():
+    cascade = model_cascade.ModelCascade("rag")
+    chunks = ["I do not have ", "enough context ", "to answer."]
+
+    escalated = list(
+        cascade.stream(
+            lambda: iter(chunks),
+            lambda: iter(["Sonnet answer"]),
+            model_cascade.is_refusal,
+            hold_chars=20,
+        )
+    )
+    accepted = list(
+        cascade.stream(
+            lambda: iter(["SageMaker ", "is a service."]),
+            lambda: iter(["unused"]),
+            model_cascade.is_refusal,
+            hold_chars=5,
+        )
+    )
+
+    assert escalated == ["Sonnet answer"]
+    assert accepted == ["SageMaker ", "is a service."]
+    assert (cascade.calls, cascade.escalations) == (2, 1)
+
+
+@pytest.mark.parametrize(
+    "answer, refused",
+    [
+        ("I don't have enough context to answer this question.", True),
+        ("The context provided does not mention Canvas pricing.", True),
+        ("SageMaker Studio is a web-based IDE.", False),
+    ],
+)
+def test_is_refusal(answer, refused):
+    assert model_cascade.is_refusal(answer) is refused
+
+
+def test_sql_result_verified():
+    assert model_cascade.sql_result_verified({"result": [("ml.m5.large", 0.115)]})
+    assert not model_cascade.sql_result_verified({"result": []})
+    assert not model_cascade.sql_result_verified({})
+
+
+def test_rag_answers_escalate_refusals_to_the_fallback_model(monkeypatch):
+    models = {
+        "ClaudeHaiku": FakeListChatModel(
+            responses=["I do not have enough context.", "Studio is an IDE."]
+        ),
+        "ClaudeSonnet": FakeListChatModel(responses=["SageMaker is a service."]),
+    }
+    monkeypatch.setattr(
+        Connections,
+        "get_bedrock_llm",
+        staticmethod(lambda model_name, **kwargs: models[model_name]),
+    )
+    monkeypatch.setattr(model_cascade, "MODEL_CASCADE_STAGES", frozenset({"rag"}))
+    monkeypatch.setitem(
+        model_cascade._cascades, "rag", model_cascade.ModelCascade("rag")
+    )
+    monkeypatch.setattr(
+        sagemaker_dg_rag,
+        "resolve_source_links",
+        lambda sources: {source: "https://docs/page" for source in sources},
+    )
+    docs = [
+        Document(
+            page_content="",
+            metadata={"title": "Page", "source": "s3://page", "excerpt": "Excerpt."},
+        )
+    ]
+
+    first = sagemaker_dg_rag.doc_retrieval("What is SageMaker?", docs=docs)
+    second = sagemaker_dg_rag.doc_retrieval("What is Studio?", docs=docs)
+
+    assert first["answer"] == "SageMaker is a service."
+    assert second["answer"] == "Studio is an IDE."
+    stats = model_cascade.get_cascade("rag").stats()
+    assert (stats["calls"], stats["escalations"]) == (2, 1)
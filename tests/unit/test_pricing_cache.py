@@ -0,0 +1,119 @@
+import pytest
+from llama_index.core.embeddings import MockEmbedding
+
+import pricing_data
+import sagemaker_pricing
+from connections import Connections
+from pricing_cache import PricingQueryCache, normalize_sql
+from tests.unit.conftest import PRICING_DATA_DIR
+from tests.unit.test_pricing_data import ScriptedLLM
+
+SQL = (
+    "SELECT instance_type, price_per_hour FROM training_price "
+    "WHERE instance_type = 'ml.p3.2xlarge'"
+)
+
+
+class FakeVersion:
+    def __init__(self):
+        self.version = "v1"
+
+    def get(self):
+        return self.version
+
+    def refresh(self):
+        return self.version
+
+
+def test_normalize_sql_keeps_string_literals():
+    assert normalize_sql("SELECT  *\nFROM T WHERE a = 'ML.P3  X';") == (
+        "select * from t where a = 'ML.P3  X'"
+    )
+
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    llm = ScriptedLLM(sql=SQL, prompts=[])
+    cache = PricingQueryCache(version=FakeVersion())
+    monkeypatch.setattr(Connections, "pricing_sql_backend", "sqlite")
+    monkeypatch.setattr(Connections, "pricing_data_dir", PRICING_DATA_DIR)
+    monkeypatch.setattr(sagemaker_pricing, "BedrockConverse", lambda **kwargs: llm)
+    monkeypatch.setattr(
+        sagemaker_pricing, "create_embed_model", lambda: MockEmbedding(embed_dim=8)
+    )
+    monkeypatch.setattr(sagemaker_pricing, "TABLE_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(sagemaker_pricing, "pricing_query_cache", cache)
+    pricing_data._pricing_tables.invalidate()
+
+    query_engine, _ = sagemaker_pricing.create_query_engine(memoize=True)
+    return query_engine, llm, cache
+
+
+def sql_prompts(llm):
+    return [prompt for prompt in llm.prompts if "<SQL Response>" not in prompt]
+
+
+def test_repeated_question_reuses_sql_and_rows(engine):
+    query_engine, llm, cache = engine
+
+    first = query_engine.query("How much is ml.p3.2xlarge per hour for training?")
+    second = query_engine.query("how much is ml.p3.2xlarge per hour for training")
+
+    assert len(sql_prompts(llm)) == 1
+    assert second.metadata["sql_query"] == first.metadata["sql_query"] == SQL
+    assert second.metadata["result"] == [("ml.p3.2xlarge", 3.825)]
+    sql_stats, result_stats = cache.stats()
+    assert sql_stats["hits"] == 1
+    assert result_stats["hits"] == 1
+
+
+def test_new_question_with_known_sql_skips_execution(engine):
+    query_engine, llm, cache = engine
+
+    query_engine.query("How much is ml.p3.2xlarge per hour for training?")
+    query_engine.query("Training price of ml.p3.2xlarge?")
+
+    assert len(sql_prompts(llm)) == 2
+    assert cache.stats()[1]["hits"] == 1
+
+
+def test_data_version_change_flushes_both_caches(engine):
+    query_engine, llm, cache = engine
+    query_engine.query("How much is ml.p3.2xlarge per hour for training?")
+
+    cache.data_version.version = "v2"
+    query_engine.query("How much is ml.p3.2xlarge per hour for training?")
+
+    assert len(sql_prompts(llm)) == 2
+    assert cache.stats()[1]["hits"] == 0
+
+    cache.refresh()
+    assert len(cache.sql) == len(cache.results) == 0
+
+
+def test_unknown_data_version_bypasses_both_caches(engine):
+    query_engine, llm, cache = engine
+    cache.data_version.version = None
+
+    query_engine.query("How much is ml.p3.2xlarge per hour for training?")
+    query_engine.query("How much is ml.p3.2xlarge per hour for training?")
+
+    assert len(sql_prompts(llm)) == 2
+    assert len(cache.sql) == len(cache.results) == 0
+
+
+def test_pricing_evidence_returns_sql_and_rows_without_synthesis(engine, monkeypatch):
+    query_engine, llm, _ = engine
+    monkeypatch.setattr(sagemaker_pricing, "get_query_engine", lambda: query_engine)
+
+    evidence = sagemaker_pricing.query_pricing_evidence(
+        "Which training instance should I pick?"
+    )
+
+    assert evidence == {
+        "sql": SQL,
+        "columns": ["instance_type", "price_per_hour"],
+        "rows": [["ml.p3.2xlarge", 3.825]],
+        "row_count": 1,
+    }
+    assert all("<SQL Response>" not in prompt for prompt in llm.prompts)
@@ -0,0 +1,332 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import pytest
+from llama_index.core import Settings, SQLDatabase
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.llms import (
+    CompletionResponse,
+    CompletionResponseGen,
+    CustomLLM,
+    LLMMetadata,
+)
+from llama_index.core.objects import SQLTableNodeMapping
+
+import pricing_data
+import sagemaker_pricing
+from connections import Connections
+from pricing_data import (
+    PRICING_TABLES,
+    create_pricing_sqlite_engine,
+    create_sqlite_engine,
+    load_pricing_tables,
+    parse_pricing_csv,
+)
+from tests.unit.conftest import PRICING_DATA_DIR
+
+
+@pytest.fixture(scope="module")
+def tables():
+    return load_pricing_tables(data_dir=PRICING_DATA_DIR)
+
+
+@pytest.fixture(scope="module")
+def sql_database(tables):
+    return SQLDatabase(create_sqlite_engine(tables), sample_rows_in_table_info=2)
+
+
+def test_tables_match_glue_schema(tables):
+    assert set(tables) == set(PRICING_TABLES)
+    assert tables["training_price"]["columns"] == [
+        ("instance_type", "string"),
+        ("vcpu", "bigint"),
+        ("memory", "double"),
+        ("memory_unit", "string"),
+        ("price_per_hour", "double"),
+        ("price_unit", "string"),
+        ("instance_category", "string"),
+    ]
+    assert [name for name, _ in tables["inference_accelerator_price"]["columns"]] == [
+        "accelerator",
+        "price_per_hour",
+        "price_unit",
+    ]
+    row_count = sum(len(table["rows"]) for table in tables.values())
+    assert row_count == 349
+
+
+def test_sqlite_engine_serves_concurrent_queries(tables):
+    engine = create_sqlite_engine(tables)
+    sql = "SELECT price_per_hour FROM training_price WHERE instance_type = ?"
+    instances = [row[0] for row in tables["training_price"]["rows"][:8]]
+    expected = {row[0]: row[4] for row in tables["training_price"]["rows"][:8]}
+    # every thread holds its connection at the same time
+    barrier = threading.Barrier(len(instances), timeout=5)
+
+    def query(instance):
+        with engine.connect() as conn:
+            barrier.wait()
+            for _ in range(20):
+                rows = conn.exec_driver_sql(sql, (instance,)).fetchall()
+            return instance, rows[0][0], id(conn.connection.dbapi_connection)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(query, instances))
+
+    assert all(price == expected[instance] for instance, price, _ in results)
+    assert len({connection for _, _, connection in results}) == len(instances)
+
+
+class StubVersion:
+    def __init__(self, version):
+        self.version = version
+
+    def get(self):
+        return self.version
+
+
+def test_sqlite_engine_is_reloaded_when_the_data_version_changes(tables, monkeypatch):
+    current = {"version": StubVersion("v1"), "tables": tables}
+    monkeypatch.setattr(pricing_data, "pricing_data_version", current["version"])
+    monkeypatch.setattr(pricing_data, "get_pricing_tables", lambda: current["tables"])
+    sql = "SELECT price_per_hour FROM training_price WHERE instance_type = ?"
+    engine = create_pricing_sqlite_engine()
+
+    def price():
+        with engine.connect() as conn:
+            return conn.exec_driver_sql(sql, ("ml.p3.2xlarge",)).scalar()
+
+    assert price() == 3.825
+    training = tables["training_price"]
+    index = [name for name, _ in training["columns"]].index("price_per_hour")
+    current["tables"] = {
+        **tables,
+        "training_price": {
+            **training,
+            "rows": [
+                [*row[:index], 1.0, *row[index + 1 :]] for row in training["rows"]
+            ],
+        },
+    }
+    # still the loaded data while the new version is unknown
+    current["version"].version = None
+    assert price() == 3.825
+
+    current["version"].version = "v2"
+    assert price() == 1.0
+
+
+def test_parse_pricing_csv_handles_bom_and_empty_cells():
+    table = parse_pricing_csv(
+        ["\ufeffInstance_Type,Memory\nml.a.large,\nml.b.large,4\n"]
+    )
+
+    assert table["columns"] == [("instance_type", "string"), ("memory", "bigint")]
+    assert table["rows"] == [("ml.a.large", None), ("ml.b.large", 4)]
+
+
+def test_sqlite_engine_answers_price_lookup(sql_database):
+    _, metadata = sql_database.run_sql(
+        "SELECT instance_type, price_per_hour FROM training_price "
+        "WHERE instance_type = 'ml.p3.2xlarge'"
+    )
+
+    assert metadata["result"] == [("ml.p3.2xlarge", 3.825)]
+    assert set(sql_database.get_usable_table_names()) == set(PRICING_TABLES)
+
+
+class ScriptedLLM(CustomLLM):
+    """Completion LLM answering text-to-SQL and synthesis prompts offline."""
+
+    sql: str = ""
+    prompts: list = []
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata()
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        self.prompts.append(prompt)
+        if "<SQL Response>" not in prompt:
+            return CompletionResponse(text=self.sql)
+        return CompletionResponse(text="The price is \\$3.825 per hour.")
+
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        yield self.complete(prompt, formatted=formatted, **kwargs)
+
+
+def test_query_engine_runs_offline_with_sqlite_backend(monkeypatch, tmp_path):
+    llm = ScriptedLLM(
+        sql="SELECT instance_type, price_per_hour FROM training_price "
+        "WHERE instance_type = 'ml.p3.2xlarge'",
+        prompts=[],
+    )
+    monkeypatch.setattr(Connections, "pricing_sql_backend", "sqlite")
+    monkeypatch.setattr(Connections, "pricing_data_dir", PRICING_DATA_DIR)
+    monkeypatch.setattr(sagemaker_pricing, "BedrockConverse", lambda **kwargs: llm)
+    monkeypatch.setattr(
+        sagemaker_pricing, "create_embed_model", lambda: MockEmbedding(embed_dim=8)
+    )
+    monkeypatch.setattr(sagemaker_pricing, "TABLE_INDEX_DIR", str(tmp_path))
+    pricing_data._pricing_tables.invalidate()
+
+    query_engine, _ = sagemaker_pricing.create_query_engine()
+    response = query_engine.query("How much is ml.p3.2xlarge per hour for training?")
+
+    assert response.metadata["sql_query"] == llm.sql
+    assert response.metadata["result"] == [("ml.p3.2xlarge", 3.825)]
+    assert "sqlite" in llm.prompts[0]
+    assert response.response == "The price is \\$3.825 per hour."
+
+
+def test_sql_cascade_runs_through_its_own_query_engine(monkeypatch, tmp_path):
+    llm = ScriptedLLM(
+        sql="SELECT instance_type, price_per_hour FROM training_price "
+        "WHERE instance_type = 'ml.p3.2xlarge'",
+        prompts=[],
+    )
+    monkeypatch.setattr(Connections, "pricing_sql_backend", "sqlite")
+    monkeypatch.setattr(Connections, "pricing_data_dir", PRICING_DATA_DIR)
+    monkeypatch.setattr(sagemaker_pricing, "BedrockConverse", lambda **kwargs: llm)
+    monkeypatch.setattr(
+        sagemaker_pricing, "create_embed_model", lambda: MockEmbedding(embed_dim=8)
+    )
+    monkeypatch.setattr(sagemaker_pricing, "is_cascade_enabled", lambda stage: True)
+    monkeypatch.setattr(sagemaker_pricing, "TABLE_INDEX_DIR", str(tmp_path))
+    pricing_data._pricing_tables.invalidate()
+
+    query_engine, _ = sagemaker_pricing.create_query_engine(memoize=False)
+    response = query_engine.query("How much is ml.p3.2xlarge per hour for training?")
+
+    assert isinstance(
+        query_engine.sql_retriever, sagemaker_pricing.CascadeNLSQLRetriever
+    )
+    assert response.metadata["result"] == [("ml.p3.2xlarge", 3.825)]
+    assert response.response == "The price is \\$3.825 per hour."
+
+
+@pytest.fixture
+def table_index(tables, monkeypatch):
+    monkeypatch.setattr(Settings, "embed_model", MockEmbedding(embed_dim=8))
+    sql_database = SQLDatabase(create_sqlite_engine(tables))
+    mapping = SQLTableNodeMapping(sql_database)
+    schema = sagemaker_pricing.table_schema(sql_database)
+    return sagemaker_pricing.build_table_index(sql_database, mapping), mapping, schema
+
+
+def test_table_index_fingerprint_changes_with_the_schema(table_index):
+    _, _, schema = table_index
+    fingerprint = sagemaker_pricing.table_index_fingerprint(schema)
+
+    assert sorted(schema) == sorted(PRICING_TABLES)
+    assert "price_per_hour" in schema["training_price"]
+    assert sagemaker_pricing.table_index_fingerprint(dict(schema)) == fingerprint
+    changed = {**schema, "training_price": schema["training_price"] + ["region"]}
+    assert sagemaker_pricing.table_index_fingerprint(changed) != fingerprint
+
+
+def test_persisted_table_index_round_trips(table_index, tmp_path):
+    obj_index, mapping, schema = table_index
+    sagemaker_pricing.persist_table_index(obj_index, schema, str(tmp_path))
+
+    loaded = sagemaker_pricing.load_table_index(mapping, schema, str(tmp_path))
+
+    assert loaded is not None
+    assert sorted(obj.table_name for obj in loaded.as_retriever().retrieve("p3")) == (
+        sorted(obj.table_name for obj in obj_index.as_retriever().retrieve("p3"))
+    )
+
+
+def test_stale_table_index_is_rebuilt(table_index, tmp_path, monkeypatch):
+    obj_index, mapping, schema = table_index
+    sagemaker_pricing.persist_table_index(obj_index, schema, str(tmp_path))
+    changed = {**schema, "training_price": ["instance_type"]}
+
+    assert sagemaker_pricing.load_table_index(mapping, changed, str(tmp_path)) is None
+    assert sagemaker_pricing.load_table_index(mapping, schema, "/missing") is None
+
+    # the query engine falls back to embedding the table descriptions
+    built = []
+    build = sagemaker_pricing.build_table_index
+    monkeypatch.setattr(
+        sagemaker_pricing,
+        "build_table_index",
+        lambda *args: built.append(args) or build(*args),
+    )
+    monkeypatch.setattr(sagemaker_pricing, "table_schema", lambda db: changed)
+    monkeypatch.setattr(sagemaker_pricing, "TABLE_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(Connections, "pricing_sql_backend", "sqlite")
+    monkeypatch.setattr(Connections, "pricing_data_dir", PRICING_DATA_DIR)
+    monkeypatch.setattr(
+        sagemaker_pricing, "create_embed_model", lambda: MockEmbedding(embed_dim=8)
+    )
+    pricing_data._pricing_tables.invalidate()
+
+    sagemaker_pricing.create_query_engine()
+    assert len(built) == 1
+
+
+class StubBuilder:
+    """
+    Query engine builder failing on the first fail_times calls.
+    """
+
+    def __init__(self, fail_times=0, delay=0.0):
+        self.calls = 0
+        self.fail_times = fail_times
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def __call__(self, timings):
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.delay)
+        if call <= self.fail_times:
+            raise RuntimeError("Athena is unavailable")
+        timings["sql_engine"] = 0.5
+        return f"query engine {call}", f"obj index {call}"
+
+
+def test_query_engine_is_built_once_under_concurrent_first_use():
+    builder = StubBuilder(delay=0.1)
+    provider = sagemaker_pricing.QueryEngineProvider(builder)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        engines = list(executor.map(lambda _: provider.get(), range(8)))
+
+    assert engines == ["query engine 1"] * 8
+    assert builder.calls == 1
+    assert provider.get_obj_index() == "obj index 1"
+
+
+def test_failed_query_engine_build_is_retried_on_the_next_call():
+    builder = StubBuilder(fail_times=1)
+    provider = sagemaker_pricing.QueryEngineProvider(builder)
+
+    with pytest.raises(RuntimeError):
+        provider.get()
+    assert not provider.is_built and provider.build_timings == {}
+
+    assert provider.get() == "query engine 2"
+    assert provider.is_built and builder.calls == 2
+    assert provider.build_timings["sql_engine"] == 0.5
+    assert provider.build_timings["total"] >= 0
+
+
+def test_cached_sql_prompt_keeps_the_question_out_of_the_system_message():
+    prompt = sagemaker_pricing.create_cached_sql_prompt(
+        sagemaker_pricing.SQL_TEMPLATE_STR
+    )
+
+    system, user = prompt.format_messages(
+        dialect="sqlite", schema="Table 'training_price'", query_str="p3 price?"
+    )
+
+    assert "Table 'training_price'" in system.content
+    assert "p3 price?" not in system.content
+    assert user.content == "Question: p3 price?\nSQLQuery: "
@@ -0,0 +1,83 @@
+import pytest
+
+from pricing_data import load_pricing_tables
+from pricing_lookup import PriceLookupResolver, detect_table
+from tests.unit.conftest import PRICING_DATA_DIR
+
+
+@pytest.fixture(scope="module")
+def resolver():
+    return PriceLookupResolver(load_pricing_tables(data_dir=PRICING_DATA_DIR))
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "How much is ml.p3.2xlarge per hour for training?",
+        "how much is p3.2xlarge per hour?",
+        "what's the price of p32xlarge",
+        "p3 2xlarge training cost per hour",
+    ],
+)
+def test_canonicalizes_instance_variants(resolver, query):
+    output = resolver.resolve(query)
+
+    assert output is not None
+    assert "FROM training_price" in output["source"]
+    assert "'ml.p3.2xlarge'" in output["source"]
+    assert "**ml.p3.2xlarge** is \\$3.825 per hour" in output["answer"]
+
+
+def test_resolves_multiple_instances(resolver):
+    output = resolver.resolve(
+        "how much does p32xlarge, p3 8xlarge and p3.16xlarge cost per hour?"
+    )
+
+    assert "IN ('ml.p3.2xlarge', 'ml.p3.8xlarge', 'ml.p3.16xlarge')" in output["source"]
+    assert output["answer"].count("per hour\n") == 2
+
+
+@pytest.mark.parametrize(
+    "query, table",
+    [
+        ("price of ml.g4dn.xlarge for training", "training_price"),
+        ("price of ml.g4dn.xlarge", "training_price"),
+        ("price of ml.g4dn.xlarge for inference", "real_time_inference_price"),
+        ("async inference price of ml.g4dn.xlarge", "asynchronous_inference_price"),
+        ("inference accelerator price", "inference_accelerator_price"),
+        ("training and inference price of ml.g4dn.xlarge", None),
+    ],
+)
+def test_detect_table(query, table):
+    assert detect_table(query) == table
+
+
+def test_accelerator_instances_use_accelerator_table(resolver):
+    output = resolver.resolve("How much is ml.eia2.medium per hour?")
+
+    assert "FROM inference_accelerator_price" in output["source"]
+    assert "\\$0.168" in output["answer"]
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "What is the cheapest GPU instance?",
+        "How much does it cost to use an P3 instance for 10 hours?",
+        "How much is ml.p3.2xlarge for 3 hours of training?",
+        "Compare the price per hour of c5.4xlarge and trn1n.32xlarge for inference.",
+        "What is ec2 instance c7g.8xlarge?",
+        "How much is c7g.8xlarge per hour?",
+        "How much memory does ml.p3.2xlarge have?",
+        "price of ml.p3.2xlarge for training and inference",
+        "How much is ml.p3.2xlarge per hour with savings plan?",
+        "spot price of ml.p3.2xlarge for training",
+        "price of ml.g5.xlarge in eu-west-1",
+        "price of ml.g5.xlarge in Frankfurt",
+        "ml.p3.2xlarge price with a 1-year commitment",
+        "reserved price of ml.p3.2xlarge",
+        "discounted price of ml.p3.2xlarge",
+    ],
+)
+def test_falls_through_when_not_confident(resolver, query):
+    assert resolver.resolve(query) is None
@@ -0,0 +1,33 @@
+import logging
+
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+
+import prompt_cache
+
+
+def test_checkpoints_follow_the_enabled_stages(monkeypatch):
+    monkeypatch.setattr(prompt_cache, "PROMPT_CACHE_STAGES", frozenset({"intent"}))
+
+    assert prompt_cache.cache_checkpoint("static", "intent") == [
+        {"type": "text", "text": "static", "cache_control": {"type": "ephemeral"}}
+    ]
+    assert prompt_cache.cache_checkpoint("static", "agent") == "static"
+
+
+def test_cache_tokens_are_logged(caplog):
+    message = AIMessage(
+        content="UseCase1",
+        usage_metadata={
+            "input_tokens": 1200,
+            "output_tokens": 3,
+            "total_tokens": 1203,
+            "input_token_details": {"cache_read": 1100, "cache_creation": 0},
+        },
+    )
+    result = LLMResult(generations=[[ChatGeneration(message=message)]])
+
+    with caplog.at_level(logging.INFO):
+        prompt_cache.PromptCacheUsageLogger("intent").on_llm_end(result)
+
+    assert "Prompt cache for intent: 1200 input tokens, 1100 read" in caplog.text
@@ -0,0 +1,85 @@
+from langchain_core.documents import Document
+from langchain_core.language_models import FakeListChatModel
+
+import rag_context
+import sagemaker_dg_rag
+from connections import Connections
+
+
+def doc(title, excerpt):
+    return Document(
+        page_content="",
+        metadata={"title": title, "source": f"s3://{title}", "excerpt": excerpt},
+    )
+
+
+STUDIO = (
+    "Amazon SageMaker Studio is a web-based IDE for machine learning. Use Studio "
+    "notebooks to prepare data, train models and deploy them."
+)
+DOCS = [
+    doc("Training jobs", "A training job runs your algorithm on managed instances."),
+    doc("Studio", STUDIO),
+    doc("Studio (copy)", STUDIO.replace("IDE", "IDE ")),
+    doc("Studio notebooks", "Studio notebooks are Jupyter notebooks in Studio."),
+    doc("Canvas", "Canvas builds models without code."),
+]
+
+
+def test_near_duplicates_are_dropped_keeping_the_higher_ranked():
+    kept = rag_context.drop_near_duplicates(DOCS)
+
+    assert [d.metadata["title"] for d in kept] == [
+        "Training jobs",
+        "Studio",
+        "Studio notebooks",
+        "Canvas",
+    ]
+
+
+def test_ranking_is_cut_at_the_score_gap():
+    assert rag_context.cut_at_score_gap([9.0, 8.0, 1.0, 0.5]) == 2
+    assert rag_context.cut_at_score_gap([9.0, 8.0, 7.0, 6.0]) == 4
+    # at least min_kept documents are kept
+    assert rag_context.cut_at_score_gap([9.0, 1.0, 0.5], min_kept=2) == 2
+    assert rag_context.cut_at_score_gap([0.0, 0.0, 0.0]) == 3
+
+
+def test_context_is_reranked_labelled_and_within_budget():
+    context, packed = rag_context.build_context("What is SageMaker Studio?", DOCS)
+
+    assert [d.metadata["title"] for d in packed] == ["Studio", "Studio notebooks"]
+    assert context.startswith("[1] Studio\nAmazon SageMaker Studio is")
+    assert "\n\n[2] Studio notebooks\n" in context
+
+    context, packed = rag_context.pack_excerpts([doc("Long", "word " * 500)] + DOCS, 60)
+    assert rag_context.estimate_tokens(context) <= 60
+    assert context.endswith(" ...") and len(packed) == 1
+
+
+def test_rag_prompt_uses_the_built_context(monkeypatch):
+    prompts = []
+
+    class RecordingChatModel(FakeListChatModel):
+        def _call(self, messages, stop=None, run_manager=None, **kwargs):
+            prompts.append(messages)
+            return super()._call(messages, stop, run_manager, **kwargs)
+
+    llm = RecordingChatModel(responses=["Studio is an IDE."])
+    monkeypatch.setattr(
+        Connections, "get_bedrock_llm", staticmethod(lambda **kwargs: llm)
+    )
+    monkeypatch.setattr(
+        sagemaker_dg_rag,
+        "resolve_source_links",
+        lambda sources: {source: f"https://docs/{source[5:]}" for source in sources},
+    )
+
+    output = sagemaker_dg_rag.doc_retrieval("What is SageMaker Studio?", docs=DOCS)
+
+    assert "[1] Studio\n" in prompts[0][-1].content
+    assert "Canvas" not in prompts[0][-1].content
+    assert output["source"] == (
+        "1. [Studio](https://docs/Studio)\n\n"
+        "2. [Studio notebooks](https://docs/Studio notebooks)\n\n"
+    )
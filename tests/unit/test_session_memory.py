@@ -0,0 +1,101 @@
+from typing import Any, List
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+
+import sagemaker_dg_rag
+import session_memory
+from connections import Connections
+
+
+class FakeDynamoDB:
+    """Stand-in for the DynamoDB client calls used by the session store."""
+
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        item = self.items.get((TableName, Key["session_id"]["S"]))
+        return {"Item": item} if item else {}
+
+    def put_item(self, TableName, Item):
+        self.items[(TableName, Item["session_id"]["S"])] = Item
+
+    def delete_item(self, TableName, Key):
+        self.items.pop((TableName, Key["session_id"]["S"]), None)
+
+
+class RecordingChatModel(FakeListChatModel):
+    prompts: List[Any] = []
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        self.prompts.append(messages)
+        return super()._call(messages, stop, run_manager, **kwargs)
+
+
+def turn(i):
+    return [HumanMessage(f"question {i} " * 20), AIMessage(f"answer {i} " * 20)]
+
+
+@pytest.mark.parametrize(
+    "store",
+    [
+        session_memory.InMemorySessionStore(),
+        session_memory.DynamoDBSessionStore("sessions", client=FakeDynamoDB()),
+    ],
+)
+def test_history_round_trips_and_stays_within_budget(store):
+    history = session_memory.SessionHistory("s1", store, max_tokens=200)
+    sizes = []
+    for i in range(10):
+        history.add_messages(turn(i))
+        sizes.append(len(history.messages))
+
+    messages = history.messages
+    assert isinstance(messages[0], HumanMessage)
+    assert messages[-1].content == turn(9)[1].content
+    assert max(sizes) <= 6 and sizes[-1] == sizes[-2]
+    assert session_memory.SessionHistory("s2", store).messages == []
+
+    history.clear()
+    assert history.messages == []
+
+
+def test_expired_dynamodb_sessions_are_ignored():
+    store = session_memory.DynamoDBSessionStore(
+        "sessions", client=FakeDynamoDB(), ttl=-1
+    )
+    store.save("s1", turn(0))
+
+    assert store.load("s1") == []
+
+
+def test_rag_answers_follow_the_session_history(monkeypatch):
+    llm = RecordingChatModel(responses=["first answer", "second answer"])
+    monkeypatch.setattr(
+        Connections, "get_bedrock_llm", staticmethod(lambda **kwargs: llm)
+    )
+    monkeypatch.setattr(session_memory, "_store", session_memory.InMemorySessionStore())
+    monkeypatch.setattr(
+        sagemaker_dg_rag,
+        "resolve_source_links",
+        lambda sources: {source: "https://docs/page" for source in sources},
+    )
+    docs = [
+        Document(
+            page_content="",
+            metadata={"title": "Page", "source": "s3://page", "excerpt": "Excerpt."},
+        )
+    ]
+
+    sagemaker_dg_rag.doc_retrieval("What is SageMaker?", docs=docs, session_id="a")
+    sagemaker_dg_rag.doc_retrieval("And Studio?", docs=docs, session_id="a")
+    sagemaker_dg_rag.doc_retrieval("What is Canvas?", docs=docs, session_id="b")
+
+    first, second, other = llm.prompts
+    assert "What is SageMaker?" in first[-1].content
+    assert [m.content for m in second[1:3]] == ["What is SageMaker?", "first answer"]
+    assert "And Studio?" in second[-1].content
+    assert len(other) == 2
@@ -0,0 +1,86 @@
+import json
+import os
+
+import pytest
+
+import sagemaker_dg_rag
+from tests.unit.conftest import ROOT_DIR
+from code.source_manifest import build_source_manifest, write_source_manifest
+
+KENDRA_ZIP = os.path.join(ROOT_DIR, "assets", "kendra_documents", "sm_dg.zip")
+SOURCE = "https://s3.us-east-1.amazonaws.com/test-kendra-data-source/sm_dg/{}.txt"
+
+
+class FakeObject:
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    def get(self, Range=None):
+        self.store.requests.append((self.key, Range))
+        body = json.dumps({"Url": f"https://docs.example.com/{self.key}", "Topic": "t"})
+        if Range:
+            end = int(Range.rpartition("-")[2])
+            body = body[: end + 1]
+        return {"Body": type("Body", (), {"read": lambda _: body.encode()})()}
+
+
+class FakeS3:
+    def __init__(self):
+        self.requests = []
+
+    def Object(self, bucket, key):
+        return FakeObject(self, key)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(sagemaker_dg_rag, "s3_resource", fake)
+    sagemaker_dg_rag.source_link_cache.invalidate()
+    return fake
+
+
+def test_manifest_maps_every_document_key_to_its_url():
+    manifest = build_source_manifest(KENDRA_ZIP)
+
+    assert len(manifest) == 1403
+    assert all(key.startswith("sm_dg/") and key.endswith(".txt") for key in manifest)
+    assert all(entry["url"].startswith("https://") for entry in manifest.values())
+
+
+def test_manifest_is_only_rewritten_when_it_changes(tmp_path):
+    output = str(tmp_path / "source_manifest.json")
+
+    assert write_source_manifest(KENDRA_ZIP, output)
+    assert not write_source_manifest(KENDRA_ZIP, output)
+
+
+def test_manifest_hits_do_not_read_s3(s3, monkeypatch):
+    monkeypatch.setattr(
+        sagemaker_dg_rag,
+        "load_source_manifest",
+        lambda: {"sm_dg/Known Page.txt": {"url": "https://docs/known", "title": "K"}},
+    )
+
+    links = sagemaker_dg_rag.resolve_source_links(
+        [SOURCE.format("Known Page"), SOURCE.format("Known%20Page")]
+    )
+
+    assert set(links.values()) == {"https://docs/known"}
+    assert s3.requests == []
+
+
+def test_misses_read_the_object_head_once(s3, monkeypatch):
+    monkeypatch.setattr(sagemaker_dg_rag, "load_source_manifest", lambda: {})
+    sources = [SOURCE.format(name) for name in ("a", "b", "a")]
+
+    first = sagemaker_dg_rag.resolve_source_links(sources)
+    second = sagemaker_dg_rag.resolve_source_links(sources)
+
+    assert first == second
+    assert first[sources[0]] == "https://docs.example.com/sm_dg/a.txt"
+    assert sorted(s3.requests) == [
+        ("sm_dg/a.txt", "bytes=0-4095"),
+        ("sm_dg/b.txt", "bytes=0-4095"),
+    ]
@@ -0,0 +1,105 @@
+import base64
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import streaming_runtime
+
+
+class FakeRuntimeApi(BaseHTTPRequestHandler):
+    """Serves one event and records what the runtime posts back."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps(self.server.event).encode()
+        self.send_response(200)
+        self.send_header("Lambda-Runtime-Aws-Request-Id", "req-1")
+        self.send_header("Lambda-Runtime-Deadline-Ms", "9999999999999")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        chunks, trailers = [], {}
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            while (line := self.rfile.readline().strip()) != b"":
+                name, _, value = line.decode().partition(": ")
+                trailers[name] = value
+        else:
+            chunks.append(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.posts.append((self.path, dict(self.headers), chunks, trailers))
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def runtime_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeRuntimeApi)
+    server.event = {"body": "{}"}
+    server.posts = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def invoke(runtime_api, handler):
+    client = streaming_runtime.RuntimeClient("127.0.0.1:%d" % runtime_api.server_port)
+    streaming_runtime.handle_invocation(client, handler)
+    return runtime_api.posts
+
+
+def test_dict_results_are_buffered(runtime_api):
+    posts = invoke(runtime_api, lambda event, context: {"answer": "a"})
+
+    path, headers, chunks, _ = posts[0]
+    assert path.endswith("/invocation/req-1/response")
+    assert "Lambda-Runtime-Function-Response-Mode" not in headers
+    assert json.loads(b"".join(chunks)) == {"answer": "a"}
+
+
+def test_iterator_results_are_streamed_chunk_by_chunk(runtime_api):
+    def handler(event, context):
+        assert context.get_remaining_time_in_millis() > 0
+        return iter([b'{"type": "delta"}\n', "", '{"type": "source"}\n'])
+
+    posts = invoke(runtime_api, handler)
+
+    path, headers, chunks, trailers = posts[0]
+    assert headers["Lambda-Runtime-Function-Response-Mode"] == "streaming"
+    assert chunks == [b'{"type": "delta"}\n', b'{"type": "source"}\n']
+    assert trailers == {}
+
+
+def test_errors_mid_stream_are_sent_as_trailers(runtime_api):
+    def frames():
+        yield b"partial"
+        raise RuntimeError("boom")
+
+    posts = invoke(runtime_api, lambda event, context: frames())
+
+    _, _, chunks, trailers = posts[0]
+    assert chunks == [b"partial"]
+    assert trailers["Lambda-Runtime-Function-Error-Type"] == "RuntimeError"
+    error = json.loads(base64.b64decode(trailers["Lambda-Runtime-Function-Error-Body"]))
+    assert error["errorMessage"] == "boom"
+
+
+def test_handler_exceptions_are_reported(runtime_api):
+    def handler(event, context):
+        raise ValueError("bad event")
+
+    path, headers, chunks, _ = invoke(runtime_api, handler)[0]
+    assert path.endswith("/invocation/req-1/error")
+    assert json.loads(b"".join(chunks))["errorType"] == "ValueError"
@@ -0,0 +1,103 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import sagemaker_agent
+import training_estimator
+from pricing_data import load_pricing_tables
+from tests.unit.conftest import PRICING_DATA_DIR
+
+
+@pytest.fixture(scope="module")
+def estimator():
+    return training_estimator.TrainingEstimator(
+        load_pricing_tables(data_dir=PRICING_DATA_DIR)
+    )
+
+
+def test_maps_instances_to_their_accelerators():
+    assert training_estimator.instance_accelerators("ml.g5.12xlarge") == (
+        "NVIDIA A10G",
+        4,
+        24,
+        0.8,
+    )
+    assert training_estimator.instance_accelerators("ml.p3.2xlarge")[1] == 1
+    assert training_estimator.instance_accelerators("ml.m5.large") is None
+
+
+def test_pareto_frontier_ranks_from_the_cheapest_to_the_fastest():
+    cost = np.array([10.0, 5.0, 20.0, 5.0, 30.0])
+    hours = np.array([2.0, 4.0, 1.0, 6.0, 1.0])
+
+    assert training_estimator.pareto_frontier(cost, hours).tolist() == [1, 0, 2]
+
+
+def test_frontier_respects_the_budget_and_the_memory_floor(estimator):
+    estimate = estimator.estimate(
+        20, budget_usd=100, min_accelerator_memory_gib=16, require_cuda=True
+    )
+
+    frontier = estimate["frontier"]
+    assert estimate["feasible"] >= len(frontier) > 1
+    assert all(row["cost_usd"] <= 100 for row in frontier)
+    assert all(row["accelerator"].startswith("NVIDIA") for row in frontier)
+    assert all(row["accelerator_memory_gib"] >= 16 for row in frontier)
+    assert [row["cost_usd"] for row in frontier] == sorted(
+        row["cost_usd"] for row in frontier
+    )
+    assert [row["hours"] for row in frontier] == sorted(
+        (row["hours"] for row in frontier), reverse=True
+    )
+    # ml.g5.xlarge: 20 / 0.8 hours at $1.408
+    g5 = next(row for row in frontier if row["instance_type"] == "ml.g5.xlarge")
+    assert g5["hours"] == 25.0 and g5["cost_usd"] == pytest.approx(35.2)
+
+
+def test_infeasible_workloads_return_the_closest_instances(estimator):
+    estimate = estimator.estimate(2000, budget_usd=100, deadline_hours=10)
+
+    assert estimate["feasible"] == 0 and "frontier" not in estimate
+    assert estimate["closest"][0]["over_budget"] is True
+    with pytest.raises(ValueError):
+        estimator.estimate(0)
+
+
+def test_agent_tool_returns_the_estimate_as_json(estimator, monkeypatch):
+    monkeypatch.setattr(sagemaker_agent, "get_training_estimator", lambda: estimator)
+
+    result = sagemaker_agent.sagemaker_training_estimator.invoke(
+        {"gpu_hours": 5, "pricing": "inference"}
+    )
+
+    estimate = json.loads(result)
+    assert estimate["pricing"] == "inference"
+    assert estimate["instances"] == 148
+    assert sagemaker_agent.sagemaker_training_estimator in (
+        sagemaker_agent.TOOLS["evidence"]
+    )
+
+
+def test_estimator_is_built_once_under_concurrent_first_use(monkeypatch):
+    builds = []
+
+    def slow_tables():
+        builds.append(1)
+        time.sleep(0.05)
+        return load_pricing_tables(data_dir=PRICING_DATA_DIR)
+
+    training_estimator._estimator.invalidate()
+    monkeypatch.setattr(training_estimator, "get_pricing_tables", slow_tables)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        estimators = list(
+            executor.map(
+                lambda _: training_estimator.get_training_estimator(), range(8)
+            )
+        )
+
+    assert len(builds) == 1
+    assert all(e is estimators[0] for e in estimators)